@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Local stand-in for the parts of the MrP REST API the client uses, with
+    catalogs of any size and an optional delay on every request. It counts
+    requests and bytes both ways so benchmarks can report them.
+
+    Run it on its own to poke at the client by hand:
+        python3 benchmarks/mock_server.py --port 8765 --images 10000
+
+    The counters are served (uncounted) on GET /_mock/stats and cleared by
+    POST /_mock/reset.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+
+IMAGE_TYPES = ["Kernel", "Initrd", "bootloader"]
+
+def parse_query(text):
+    """ Parses the subset of MrP's q= s-expressions the client sends:
+        (= field "value"), (and ...), (or ...) """
+    tokens = re.findall(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+', text)
+    position = [0]
+
+    def read():
+        token = tokens[position[0]]
+        position[0] += 1
+        if token == '(':
+            expression = []
+            while tokens[position[0]] != ')':
+                expression.append(read())
+            position[0] += 1
+            return expression
+        if token.startswith('"'):
+            return json.loads(token)
+        return token
+
+    return read()
+
+def predicate(expression):
+    """ Compiles a parsed query into a function of a row, so filtering a
+        large catalog costs about what a database scan would """
+    operator, operands = expression[0], expression[1:]
+    if operator == '=':
+        field, value = operands[0], str(operands[1])
+        return lambda row: str(row.get(field)) == value
+    tests = [predicate(operand) for operand in operands]
+    if operator == 'and':
+        return lambda row: all(test(row) for test in tests)
+    if operator == 'or':
+        return lambda row: any(test(row) for test in tests)
+    raise ValueError("Unknown operator %s" % operator)
+
+
+class Catalog(object):
+    """ Server side state. Everything is generated up front so request
+        handling cost does not depend on the catalog sizes more than a real
+        server's would """
+
+    def __init__(self, images=10000, preseeds=5000, machines=2000, interfaces=4,
+                 preseed_size=2048, arch='arm64'):
+        self.lock = threading.Lock()
+        self.images = [self.image(i, arch) for i in range(images)]
+        self.preseeds = [self.preseed(i, preseed_size) for i in range(preseeds)]
+        self.machines = [self.machine(i) for i in range(machines)]
+        self.interfaces = {machine['id']: [{'id': machine['id'] * 100 + j,
+                                            'identifier': 'eth%d' % j,
+                                            'mac': '02:00:%02x:%02x:%02x:%02x' % (
+                                                   (machine['id'] >> 16) & 0xff,
+                                                   (machine['id'] >> 8) & 0xff,
+                                                   machine['id'] & 0xff, j),
+                                            'lease_ipv4': '10.%d.%d.%d' % (
+                                                   j, machine['id'] >> 8 & 0xff,
+                                                   machine['id'] & 0xff),
+                                            'netmaskv4': '255.255.0.0'}
+                                           for j in range(interfaces)]
+                           for machine in self.machines}
+        self.reset_stats()
+
+    # Records are a function of their position, so benchmarks can name the
+    # ones they look up without holding a catalog of their own
+
+    @staticmethod
+    def image(i, arch='arm64'):
+        return {'id': i + 1, 'description': 'image-%d' % i,
+                'type': IMAGE_TYPES[i % len(IMAGE_TYPES)], 'arch': arch,
+                'public': False, 'known_good': True, 'user': 'bench',
+                'filename': 'image-%d.bin' % i, 'upload_date': '2018-01-01'}
+
+    @staticmethod
+    def preseed(i, preseed_size=2048):
+        return {'id': i + 1, 'name': 'preseed-%d' % i, 'type': 'preseed',
+                'description': 'benchmark preseed', 'public': False,
+                'known_good': True, 'user': 'bench',
+                'content': ('d-i preseed %d\n' % i).ljust(preseed_size, '#')}
+
+    @staticmethod
+    def machine(i):
+        return {'id': i + 1, 'name': 'machine-%d' % i, 'kernel_id': None,
+                'initrd_id': None, 'preseed_id': None, 'subarch': None,
+                'kernel_opts': '', 'netboot_enabled': False, 'state': 'up'}
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.endpoints = {}
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent, 'endpoints': dict(self.endpoints)}
+
+    def count(self, method, path, received, sent):
+        template = re.sub(r'/\d+', '/{id}', urlparse(path).path)
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+            key = '%s %s' % (method, template)
+            self.endpoints[key] = self.endpoints.get(key, 0) + 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, keep-alive
+    # clients would wait for delayed ACKs on every request
+    disable_nagle_algorithm = True
+    catalog = None
+    token = 'benchmark-token'
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def __read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = bytearray()
+        while len(body) < length:
+            chunk = self.rfile.read(min(1 << 20, length - len(body)))
+            if not chunk:
+                break
+            body += chunk
+        return bytes(body)
+
+    def __reply(self, method, received, status, payload=None, headers=None, count=True):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        # Counted before the client can see the reply, so a benchmark reading
+        # the stats right after its last request finds it there
+        if count:
+            self.catalog.count(method, self.path, received, len(body))
+        self.wfile.write(body)
+
+    def __handle(self, method):
+        body = self.__read_body() if method in ('POST', 'PUT') else b''
+        received = len(self.requestline) + len(str(self.headers)) + len(body)
+
+        if self.path == '/_mock/stats':
+            return self.__reply(method, received, 200, self.catalog.stats(), count=False)
+        if self.path == '/_mock/reset':
+            self.catalog.reset_stats()
+            return self.__reply(method, received, 200, {}, count=False)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.headers.get('Authorization') != self.token:
+            return self.__reply(method, received, 401, {'message': 'Unauthorized'})
+
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part][2:]
+        catalog = self.catalog
+        collections = {'image': catalog.images, 'preseed': catalog.preseeds,
+                       'machine': catalog.machines}
+
+        if not parts or parts[0] not in collections:
+            return self.__reply(method, received, 404, {'message': 'Not found'})
+        rows = collections[parts[0]]
+
+        if len(parts) == 1:
+            if method == 'GET':
+                query = parse_qs(url.query).get('q')
+                if query:
+                    try:
+                        test = predicate(parse_query(query[0]))
+                        rows = [row for row in rows if test(row)]
+                    except (ValueError, IndexError):
+                        return self.__reply(method, received, 400, {'message': 'Bad query'})
+                return self.__reply(method, received, 200, rows)
+            if method == 'POST':
+                if parts[0] == 'image':
+                    fields = re.search(rb'name="q"\r\n\r\n(.*?)\r\n--', body, re.S)
+                    record = json.loads(fields.group(1).decode('utf-8'))
+                else:
+                    record = json.loads(body.decode('utf-8'))
+                with catalog.lock:
+                    record['id'] = rows[-1]['id'] + 1 if rows else 1
+                    rows.append(record)
+                return self.__reply(method, received, 201, record)
+            return self.__reply(method, received, 405, {'message': 'Method not allowed'})
+
+        try:
+            record = next(row for row in rows if row['id'] == int(parts[1]))
+        except (StopIteration, ValueError):
+            return self.__reply(method, received, 404, {'message': 'Not found'})
+
+        if parts[0] == 'machine' and parts[2:] == ['interface']:
+            return self.__reply(method, received, 200, catalog.interfaces.get(record['id'], []))
+        if parts[0] == 'machine' and parts[2:] == ['state']:
+            if method == 'POST':
+                record['state'] = json.loads(body.decode('utf-8'))['state']
+                # Provisioning completes right away, waiters see it on next poll
+                state, record['state'] = record['state'], 'up'
+                return self.__reply(method, received, 202, {'state': state})
+            return self.__reply(method, received, 200, {'state': record.get('state')})
+
+        if method == 'GET':
+            return self.__reply(method, received, 200, record)
+        if method == 'PUT':
+            record.update(json.loads(body.decode('utf-8')))
+            return self.__reply(method, received, 200, record)
+        if method == 'DELETE':
+            with catalog.lock:
+                rows.remove(record)
+            return self.__reply(method, received, 200, {})
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+
+class MockServer(object):
+    """ Threaded mock MrP listening on localhost, use as a context manager """
+
+    def __init__(self, catalog, port=0, latency=0.0, token=MockHandler.token):
+        handler = type('Handler', (MockHandler,), {'catalog': catalog, 'latency': latency,
+                                                   'token': token})
+        self.catalog = catalog
+        self.token = token
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        return self.catalog.stats()
+
+    def reset_stats(self):
+        self.catalog.reset_stats()
+
+
+class MockProcess(object):
+    """ The mock in a process of its own, so that neither its CPU time nor
+        its allocations show in the measurements of the process using it.
+        Same interface as MockServer; sizes are Catalog's arguments """
+
+    def __init__(self, latency=0.0, token=MockHandler.token, **sizes):
+        self.token = token
+        self.argv = [sys.executable, os.path.abspath(__file__), '--port', '0',
+                     '--latency', str(latency), '--token', token]
+        for name, value in sizes.items():
+            self.argv += ['--' + name.replace('_', '-'), str(value)]
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE)
+        # First line: "Mock MrP on <url>, token <token>"
+        self.url = self.process.stdout.readline().decode('utf-8').split()[3].rstrip(',')
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __control(self, path, method='GET'):
+        with urlopen(Request(self.url + path, method=method)) as reply:
+            return json.loads(reply.read().decode('utf-8'))
+
+    def stats(self):
+        return self.__control('/_mock/stats')
+
+    def reset_stats(self):
+        self.__control('/_mock/reset', 'POST')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock MrP server for benchmarks')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--preseeds', type=int, default=5000)
+    parser.add_argument('--machines', type=int, default=2000)
+    parser.add_argument('--interfaces', type=int, default=4)
+    parser.add_argument('--preseed-size', type=int, default=2048)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--token', type=str, default=MockHandler.token)
+    args = parser.parse_args()
+
+    catalog = Catalog(args.images, args.preseeds, args.machines, args.interfaces,
+                      args.preseed_size)
+    with MockServer(catalog, args.port, args.latency, args.token) as server:
+        print('Mock MrP on %s, token %s' % (server.url, server.token), flush=True)
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
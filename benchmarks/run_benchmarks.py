@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Runs the client's CLI flows and library calls against the local mock
+    MrP and reports, per flow: wall time, HTTP requests, bytes each way and
+    peak memory, as JSON.
+
+    python3 benchmarks/run_benchmarks.py --output before.json
+    python3 benchmarks/run_benchmarks.py --compare before.json
+
+    The mock runs in a process of its own. CLI flows run as subprocesses
+    (peak memory is their maximum RSS); library flows run in this process
+    (peak memory is the tracemalloc peak).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import Catalog, MockProcess, IMAGE_TYPES
+
+# Runs the CLI in-process and records its peak RSS on exit. getrusage() can't
+# be used from the parent: ru_maxrss survives exec, so a child forked from
+# this (large) process would report our memory, not the client's
+CLI_WRAPPER = """
+import atexit, runpy, sys
+
+out_path = sys.argv[1]
+
+def peak_rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                with open(out_path, 'w') as out:
+                    out.write(str(int(line.split()[1]) * 1024))
+
+atexit.register(peak_rss)
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+class Benchmark(object):
+    def __init__(self, server, repeat, workdir):
+        self.server = server
+        self.repeat = repeat
+        self.workdir = workdir
+        self.runs = 0
+        self.results = {}
+
+    def unique(self, prefix):
+        """ A fresh name per run, so uploads always create """
+        self.runs += 1
+        return '%s-%d-%d' % (prefix, os.getpid(), self.runs)
+
+    def __record(self, name, kind, samples):
+        walls = sorted(sample['wall'] for sample in samples)
+        last = samples[-1]
+        self.results[name] = {
+            'kind': kind,
+            'runs': len(samples),
+            'wall_median_s': walls[len(walls) // 2],
+            'wall_min_s': walls[0],
+            'requests': last['stats']['requests'],
+            'bytes_sent': last['stats']['bytes_received'],
+            'bytes_received': last['stats']['bytes_sent'],
+            'peak_memory_bytes': max(sample['memory'] for sample in samples),
+            'rc': last.get('rc', 0),
+            'endpoints': last['stats']['endpoints'],
+        }
+
+    def cli(self, name, args_factory):
+        """ args_factory() returns the subcommand arguments for one run """
+        samples = []
+        env = dict(os.environ, XDG_CACHE_HOME=self.workdir)
+        env.pop('MRP_CLIENT_SOCKET', None)
+        memory_file = os.path.join(self.workdir, 'peak_rss')
+        for _ in range(self.repeat):
+            argv = [sys.executable, '-c', CLI_WRAPPER, memory_file,
+                    os.path.join(REPO_DIR, 'mrp_client.py'),
+                    '--mrp-url', self.server.url, '--mrp-token', self.server.token]
+            argv += args_factory()
+            self.server.reset_stats()
+            start = time.perf_counter()
+            rc = subprocess.call(argv, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL, env=env)
+            wall = time.perf_counter() - start
+            with open(memory_file, 'r') as fd:
+                memory = int(fd.read())
+            samples.append({'wall': wall, 'memory': memory,
+                            'stats': self.server.stats(), 'rc': rc})
+        self.__record(name, 'cli', samples)
+
+    def library(self, name, setup, call):
+        """ setup() builds fresh state outside the measurement, call(state)
+            is measured """
+        samples = []
+        for _ in range(self.repeat):
+            state = setup()
+            self.server.reset_stats()
+            tracemalloc.start()
+            start = time.perf_counter()
+            call(state)
+            wall = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            samples.append({'wall': wall, 'memory': peak,
+                            'stats': self.server.stats()})
+        self.__record(name, 'library', samples)
+
+
+def run(args):
+    from library.common import URLhandler, get_machine_ids
+    from library.ImageControl import ImageControl
+    from library.PreseedControl import PreseedControl
+    from library.NetworkControl import NetworkInventory
+    from library.BulkStateControl import BulkStateControl
+
+    def last_image(image_type):
+        i = args.images - 1
+        while IMAGE_TYPES[i % len(IMAGE_TYPES)] != image_type:
+            i -= 1
+        return Catalog.image(i)
+
+    last_images = [Catalog.image(i) for i in range(args.images - args.batch, args.images)]
+    last_preseeds = [Catalog.preseed(i, 0) for i in range(args.preseeds - args.batch,
+                                                          args.preseeds)]
+    last_image, kernel, initrd = last_images[-1], last_image('Kernel'), last_image('Initrd')
+    preseed = last_preseeds[-1]
+    machine = Catalog.machine(args.machines - 1)
+    machines = [Catalog.machine(i)['name'] for i in range(args.batch)]
+
+    with tempfile.TemporaryDirectory() as workdir, \
+         MockProcess(latency=args.latency, images=args.images, preseeds=args.preseeds,
+                     machines=args.machines, interfaces=args.interfaces,
+                     preseed_size=args.preseed_size) as server:
+        image_path = os.path.join(workdir, 'image.bin')
+        with open(image_path, 'wb') as fd:
+            for _ in range(args.image_size // (1 << 20)):
+                fd.write(os.urandom(1 << 20))
+        preseed_path = os.path.join(workdir, 'preseed.cfg')
+        with open(preseed_path, 'w') as fd:
+            fd.write('d-i benchmark\n' * 200)
+
+        bench = Benchmark(server, args.repeat, workdir)
+
+        def handler():
+            return URLhandler(server.url, server.token)
+
+        bench.cli('cli_image_check', lambda: [
+                  'image', '--action', 'check', '--image-type', last_image['type'],
+                  '--description', last_image['description'], '--arch', last_image['arch']])
+        bench.cli('cli_image_upload', lambda: [
+                  'image', '--action', 'upload', '--image-type', 'Kernel',
+                  '--description', bench.unique('upload'), '--arch', 'arm64',
+                  '--image-path', image_path])
+        bench.cli('cli_preseed_upload', lambda: [
+                  'preseed', '--action', 'upload', '--preseed-name', bench.unique('preseed'),
+                  '--preseed-path', preseed_path, '--type', 'preseed'])
+        bench.cli('cli_state_provision', lambda: [
+                  'state', '--action', 'provision', '--machine', machine['name'],
+                  '--arch', 'arm64', '--subarch', 'generic',
+                  '--kernel-desc', kernel['description'], '--initrd-desc', initrd['description'],
+                  '--preseed-name', preseed['name']])
+        bench.cli('cli_net_getip', lambda: [
+                  'net', '--action', 'getip', '--machine', machine['name'],
+                  '--interface', 'eth0'])
+
+        bench.library('lib_image_lookups',
+                      lambda: ImageControl(handler()),
+                      lambda images: [images.get_image(image['type'], image['description'],
+                                                       image['arch'])
+                                      for image in last_images])
+        bench.library('lib_preseed_lookups',
+                      lambda: PreseedControl(handler()),
+                      lambda preseeds: [preseeds.get_preseed(p['name'], p['type'])
+                                        for p in last_preseeds])
+        bench.library('lib_machine_ids', handler,
+                      lambda urlhandler: get_machine_ids(urlhandler, machines))
+        bench.library('lib_network_inventory', handler,
+                      lambda urlhandler: list(NetworkInventory(urlhandler).rows(machines)))
+        bench.library('lib_bulk_provision', handler,
+                      lambda urlhandler: BulkStateControl(urlhandler, machines).provision(
+                                         'arm64', 'generic', initrd['description'],
+                                         kernel['description'], '', preseed['name']))
+
+    return {'commit': git_commit(), 'created': time.time(),
+            'parameters': {key: value for key, value in vars(args).items()
+                           if key not in ('output', 'compare')},
+            'results': bench.results}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(before, after):
+    """ Prints after/before ratios of the headline numbers of every flow """
+    fields = ['wall_median_s', 'requests', 'bytes_received', 'peak_memory_bytes']
+    print('%-24s' % 'flow' + ''.join('%22s' % field for field in fields))
+    for name, result in after['results'].items():
+        old = before['results'].get(name)
+        cells = []
+        for field in fields:
+            if old is None or not old[field]:
+                cells.append('%22s' % result[field])
+            else:
+                cells.append('%22s' % ('%.4g (x%.2f)' % (result[field],
+                                                         result[field] / old[field])))
+        print('%-24s' % name + ''.join(cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark mrp_client against a mock MrP')
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--preseeds', type=int, default=5000)
+    parser.add_argument('--machines', type=int, default=2000)
+    parser.add_argument('--interfaces', type=int, default=4)
+    parser.add_argument('--preseed-size', type=int, default=2048,
+                        help='bytes of content in every preseed')
+    parser.add_argument('--image-size', type=int, default=16 << 20,
+                        help='bytes of the uploaded image')
+    parser.add_argument('--batch', type=int, default=200,
+                        help='lookups / machines handled by library flows')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the mock adds to every request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=str, default='',
+                        help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', type=str, default='',
+                        help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as fd:
+            compare(json.load(fd), results)
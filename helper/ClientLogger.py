@@ -15,6 +15,46 @@
 """
 
 import logging
+import sys
+import threading
+
+class StderrHandler(logging.StreamHandler):
+    """ Writes to sys.stderr as it is when a record is emitted, so output
+        redirected per command (as the client daemon does) gets its logs """
+
+    def __init__(self):
+        super(StderrHandler, self).__init__()
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+class ThreadLevelFilter(logging.Filter):
+    """ Passes the records at or above the level set by the command running
+        in the current thread, so commands run side by side (batch lines,
+        daemon requests) each get their own verbosity """
+
+    def __init__(self, default=logging.WARNING):
+        super(ThreadLevelFilter, self).__init__()
+        self.default = default
+        self.local = threading.local()
+
+    def level(self):
+        return getattr(self.local, 'level', self.default)
+
+    def set_level(self, level):
+        self.local.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level()
+
+LEVELS = ThreadLevelFilter()
+HANDLER = StderrHandler()
+HANDLER.addFilter(LEVELS)
 
 class ClientLogger(object):
     def __init__(self, name, parser=None, verbosity=0):
@@ -25,6 +65,16 @@ class ClientLogger(object):
         silent = min(verbosity*10, 20)
         self.parser = parser
 
+        # The level applies to the library's loggers as well as ours, and
+        # to this thread only; the root logger is left to the application
+        LEVELS.set_level(start - silent)
+        for logger_name in (name, 'library', 'helper'):
+            logger = logging.getLogger(logger_name)
+            if HANDLER not in logger.handlers:
+                logger.addHandler(HANDLER)
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+
     def fatal(self, err):
         self.logger.fatal(err, exc_info=True)
 
@@ -44,4 +94,4 @@ class ClientLogger(object):
         self.logger.debug(trace)
 
     def silent(self):
-        return self.logger.getEffectiveLevel() > logging.INFO
+        return LEVELS.level() > logging.INFO
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import sys
+import threading
+
+from contextlib import contextmanager
+
+class ThreadStream(object):
+    """ Stands for sys.stdout or sys.stderr: what a thread writes goes to
+        the buffer it captures into, if any, else to the real stream """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self.__target().write(text)
+
+    def flush(self):
+        self.__target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.__target(), name)
+
+
+class OutputCapture(object):
+    """ Captures stdout and stderr per thread, for commands run side by
+        side in one process. Use it as a context manager around the threads'
+        work; each thread wraps its command in capture() """
+
+    def __enter__(self):
+        self.saved = sys.stdout, sys.stderr
+        self.stdout, self.stderr = ThreadStream(sys.stdout), ThreadStream(sys.stderr)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout, sys.stderr = self.saved
+
+    @contextmanager
+    def capture(self):
+        """ Yields (stdout, stderr) StringIO buffers """
+        buffers = io.StringIO(), io.StringIO()
+        self.stdout.local.buffer, self.stderr.local.buffer = buffers
+        try:
+            yield buffers
+        finally:
+            self.stdout.local.buffer = self.stderr.local.buffer = None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from library.BandwidthLimiter import BandwidthLimiter
+
+# Answers meaning MrP (or the proxy in front of it) is overloaded
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+
+# An endpoint is slow when its recent latency is this many times its usual
+# latency, and at least LATENCY_FLOOR seconds: jitter on fast requests is not
+# congestion
+LATENCY_TOLERANCE = 2.0
+LATENCY_FLOOR = 0.05
+
+# Requests with bodies larger than this take as long as their upload does,
+# their latency says nothing about the server's load
+LATENCY_MAX_BODY = 64 * 1024
+
+# Requests seen on an endpoint before its latency is judged
+LATENCY_WARMUP = 5
+
+# Weight of a request in the moving averages of its endpoint's recent and
+# usual latency; the slow one lets a server lastingly slower be taken as it
+# is after a while
+LATENCY_RECENT_WEIGHT = 0.25
+LATENCY_USUAL_WEIGHT = 0.02
+
+class AdmissionController(object):
+    """ Admits the requests of a URLhandler to MrP: at most limit of them in
+        flight at once, and, if rate is set, no more than rate per second
+        (a token bucket allowing bursts of a tenth of a second's worth).
+        Requests over the limit wait their turn in acquire().
+
+        With adaptive=True the limit follows the server AIMD-style, as TCP
+        does: it halves, down to min_limit, when a request meets an overload
+        answer, a connection error, transport retries or when its endpoint
+        answers well slower than usual; and grows by one per limit requests
+        answered in time, up to max_limit, while requests are waiting for
+        it. Only requests sent after the last decrease lower it again, so a
+        burst of failures from one overload halves it once. """
+
+    def __init__(self, max_limit, min_limit=1, rate=None, adaptive=True,
+                 decrease_factor=0.5):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.adaptive = adaptive
+        self.decrease_factor = decrease_factor
+        self.bucket = BandwidthLimiter(rate) if rate else None
+        self.limit = float(self.max_limit)
+        self.lowest = self.max_limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.decreases = 0
+        self.decreased_at = 0.0
+        self.latencies = {}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ Blocks until the request may go, returns the ticket to hand to
+            release() """
+        with self.condition:
+            self.waiting += 1
+        try:
+            if self.bucket is not None:
+                self.bucket.consume(1)
+            with self.condition:
+                while self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                self.in_flight += 1
+        finally:
+            with self.condition:
+                self.waiting -= 1
+        return time.monotonic()
+
+    def release(self, ticket, event):
+        """ Frees the request's slot; event is its RequestEvent, or None if
+            it failed on the client's side """
+        with self.condition:
+            self.in_flight -= 1
+            if self.adaptive and event is not None:
+                if self.__congested(event):
+                    if ticket >= self.decreased_at:
+                        self.__decrease()
+                elif self.waiting or self.in_flight + 1 >= int(self.limit):
+                    self.limit = min(self.max_limit, self.limit + 1.0 / int(self.limit))
+            self.condition.notify_all()
+
+    def __congested(self, event):
+        if event.status is None or event.status in OVERLOAD_STATUS_CODES or event.retries:
+            return True
+        if event.request_bytes > LATENCY_MAX_BODY:
+            return False
+
+        key = (event.method, event.endpoint)
+        count, recent, usual = self.latencies.get(key, (0, event.latency, event.latency))
+        recent += (event.latency - recent) * LATENCY_RECENT_WEIGHT
+        # The usual latency is the plain average until the warm-up is over
+        usual += (event.latency - usual) * max(LATENCY_USUAL_WEIGHT, 1.0 / (count + 1))
+        self.latencies[key] = (count + 1, recent, usual)
+        return count >= LATENCY_WARMUP and recent > max(LATENCY_FLOOR, usual * LATENCY_TOLERANCE)
+
+    def __decrease(self):
+        self.limit = max(float(self.min_limit), int(self.limit) * self.decrease_factor)
+        self.lowest = min(self.lowest, int(self.limit))
+        self.decreases += 1
+        self.decreased_at = time.monotonic()
+
+    def gauges(self):
+        """ (name, type, help, read) of the values RequestMetrics exports """
+        return [('admission_limit', 'gauge', 'Requests currently allowed in flight to MrP',
+                 lambda: int(self.limit)),
+                ('admission_limit_lowest', 'gauge', 'Lowest in-flight limit reached',
+                 lambda: self.lowest),
+                ('admission_in_flight', 'gauge', 'Requests to MrP in flight',
+                 lambda: self.in_flight),
+                ('admission_queue_depth', 'gauge', 'Requests waiting to be sent to MrP',
+                 lambda: self.waiting),
+                ('admission_decreases_total', 'counter', 'Times the in-flight limit was lowered',
+                 lambda: self.decreases)]
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from library.common import *
+from library.ImageControl import ImageControl
+from library.PreseedControl import PreseedControl
+from library.Records import Machine
+
+# Keys of a machine's desired state, named as the state options are
+DESIRED_KEYS = ('arch', 'subarch', 'kernel_desc', 'initrd_desc', 'kernel_opts',
+                'preseed_name', 'netboot')
+
+def read_desired_state(path):
+    """ Desired machine parameters from a JSON or YAML file (YAML needs
+        PyYAML):
+            {"defaults": {<key>: <value>, ...},
+             "machines": {"<name>": {<key>: <value>, ...} or null, ...}}
+        keys being DESIRED_KEYS; "machines" may also be a list of names or
+        of {"name", <key>...} objects. A machine's keys override the
+        defaults, only the keys given are enforced. Returns a name -> desired
+        dict, in file order """
+    try:
+        with open(path, 'r') as fd:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise ClientError("Reading {} needs the PyYAML package".format(path))
+                document = yaml.safe_load(fd)
+            else:
+                document = json.load(fd)
+    except (OSError, ValueError) + ((yaml.YAMLError,) if yaml is not None else ()) as err:
+        raise ClientError("Cannot read desired state {}: {}".format(path, err))
+
+    try:
+        defaults = document.get('defaults') or {}
+        machines = document.get('machines') or {}
+        if isinstance(machines, list):
+            machines = dict((entry, {}) if isinstance(entry, str) else
+                            (entry['name'], {key: value for key, value in entry.items()
+                                             if key != 'name'})
+                            for entry in machines)
+        desired = {}
+        for name, overrides in machines.items():
+            desired[name] = dict(defaults, **(overrides or {}))
+    except (AttributeError, KeyError, TypeError) as err:
+        raise ClientError("Invalid desired state {}: bad entry ({})".format(path, err))
+
+    check_desired_state(desired, path)
+    return desired
+
+def check_desired_state(desired, source='given'):
+    """ Raises ClientError unless desired maps names to dicts of
+        DESIRED_KEYS """
+    for name, state in desired.items():
+        unknown = [key for key in state if key not in DESIRED_KEYS]
+        if unknown:
+            raise ClientError("Invalid desired state {}: unknown keys {} for {}, must be "
+                              "among {}".format(source, ', '.join(unknown), name,
+                                                ', '.join(DESIRED_KEYS)))
+        if 'netboot' in state and not isinstance(state['netboot'], bool):
+            raise ClientError("Invalid desired state {}: netboot of {} must be true or "
+                              "false".format(source, name))
+
+def differs(current, wanted):
+    """ An empty kernel_opts or preseed reads back as '' or null alike """
+    if current in (None, '') and wanted in (None, ''):
+        return False
+    return current != wanted
+
+
+class ApplyControl(object):
+    """ Brings machines' provisioning parameters to a desired state,
+        writing only what differs. plan() reads every machine's current
+        state, with the machine queries that resolve the names (one request
+        per MACHINE_QUERY_BATCH machines) and a GET for those whose record
+        leaves out a parameter; apply() then sends one PUT per machine that
+        needs changes, with only the changed fields.
+
+        plan() returns one dict per machine, in input order: {'machine',
+        'changes', 'error'}, changes mapping each field to write to its
+        (current, wanted) values. apply() returns the plan entries with
+        'ok', 'result' (UPDATED or UNCHANGED) and 'elapsed' added, as
+        BulkStateControl does """
+
+    def __init__(self, urlhandler, desired, concurrency=8, image_controller=None,
+                 preseed_controller=None):
+        self.urlhandler = urlhandler
+        self.desired = desired
+        self.concurrency = max(1, concurrency)
+        self.image_controller = image_controller or ImageControl(urlhandler)
+        self.preseed_controller = preseed_controller or PreseedControl(urlhandler)
+        self.machine_ids = {}
+        # Requests plan() made to read the current state and resolve names;
+        # plan_thread marks the threads making them, as other commands may
+        # be using the urlhandler at the same time
+        self.plan_requests = 0
+        self.plan_thread = threading.local()
+
+    def __resolve(self, state):
+        """ Machine parameters, as MrP names them, of a desired state """
+        parameters = {}
+        for key, image_type, field in (('kernel_desc', 'Kernel', 'kernel_id'),
+                                       ('initrd_desc', 'Initrd', 'initrd_id')):
+            if key in state:
+                if not state.get('arch'):
+                    raise ClientError("{} needs an arch".format(key))
+                parameters[field] = self.image_controller.get_image_id(state[key], image_type,
+                                                                       state['arch'])
+        if 'preseed_name' in state:
+            parameters['preseed_id'] = None
+            if state['preseed_name']:
+                parameters['preseed_id'] = self.preseed_controller.get_preseed_id(
+                                           state['preseed_name'])
+                if parameters['preseed_id'] is None:
+                    raise ProvisionerError("Preseed '{0}' unknown".format(state['preseed_name']))
+        if 'subarch' in state:
+            parameters['subarch'] = state['subarch']
+        if 'kernel_opts' in state:
+            parameters['kernel_opts'] = state['kernel_opts']
+        if 'netboot' in state:
+            parameters['netboot_enabled'] = state['netboot']
+        return parameters
+
+    def __query(self, names):
+        """ Machine records by name from the machine queries, None if MrP
+            can't filter machines """
+        records = {}
+        try:
+            for path in machine_query_paths(names):
+                for machine in Machine.from_list(self.urlhandler.get(path)):
+                    records.setdefault(machine.get('name'), machine)
+        except URLhandlerHTTPError as err:
+            if err.status_code != 400:
+                raise
+            return None
+        remember_machine_ids(self.urlhandler.machine_ids, records.values())
+        return records
+
+    def __current(self, wanted):
+        """ Current records of the machines in wanted (name -> parameters) """
+        records = self.__query(list(wanted)) or {}
+        self.machine_ids = get_machine_ids(self.urlhandler, list(wanted), strict=False)
+
+        def fetch(name):
+            return name, Machine.from_json(self.urlhandler.get(
+                                 "/api/v1/machine/{}".format(self.machine_ids[name])))
+
+        missing = [name for name, parameters in wanted.items()
+                   if name in self.machine_ids and
+                   (name not in records or not set(parameters) <= set(records[name]))]
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                initializer=self.__plan_thread) as pool:
+            records.update(pool.map(fetch, missing))
+        return records
+
+    def __plan_thread(self, planning=True):
+        self.plan_thread.planning = planning
+
+    def plan(self):
+        lock = threading.Lock()
+        def count(event):
+            if getattr(self.plan_thread, 'planning', False):
+                with lock:
+                    self.plan_requests += 1
+        self.__plan_thread()
+        hook = self.urlhandler.metrics.add_hook(count)
+        try:
+            return self.__plan()
+        finally:
+            self.urlhandler.metrics.remove_hook(hook)
+            self.__plan_thread(False)
+
+    def __plan(self):
+        wanted = {}
+        errors = {}
+        for name, state in self.desired.items():
+            try:
+                wanted[name] = self.__resolve(state)
+            except (ClientError, ProvisionerError) as err:
+                errors[name] = str(err)
+
+        records = self.__current(wanted) if wanted else {}
+
+        plan = []
+        for name in self.desired:
+            if name in errors or name not in records:
+                plan.append({'machine': name, 'changes': {},
+                             'error': errors.get(name, "Machine {0} unknown to MrP".format(name))})
+                continue
+            current = records[name]
+            changes = {field: (current.get(field), value)
+                       for field, value in wanted[name].items()
+                       if differs(current.get(field), value)}
+            plan.append({'machine': name, 'changes': changes, 'error': None})
+        return plan
+
+    def apply(self, plan):
+        def run_one(entry):
+            start = time.monotonic()
+            result = dict(entry, ok=entry['error'] is None, result=None)
+            if result['ok'] and entry['changes']:
+                url = "/api/v1/machine/{}".format(self.machine_ids[entry['machine']])
+                data = json.dumps({field: wanted for field, (_, wanted)
+                                   in entry['changes'].items()})
+                try:
+                    self.urlhandler.put(url, data)
+                    result['result'] = UPDATED
+                except Exception as err:
+                    result['ok'], result['error'] = False, str(err)
+            elif result['ok']:
+                result['result'] = UNCHANGED
+            result['elapsed'] = time.monotonic() - start
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(run_one, plan))
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    asyncio counterparts of URLhandler and the *Control classes, for callers
+    running an event loop. They follow the blocking API method for method,
+    as coroutines, and raise the same errors.
+
+    Requires aiohttp, which the blocking client does not need.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from urllib.parse import urljoin
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from library.common import *
+from library.ImageControl import IMAGE_TYPES
+from library.PreseedControl import read_preseed_file, preseed_changes
+
+# Methods safe to send again after a connection error or a gateway error
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+
+class AsyncURLhandler(object):
+    """ One aiohttp session (and so one keep-alive connection pool) per
+        handler, shared by every async controller. At most concurrency
+        requests are in flight at once, however many coroutines use it.
+
+        Use it as an async context manager, or await open() and close() """
+
+    def __init__(self, mrp_url, mrp_token, pool_size=100, concurrency=100, retries=3,
+                 backoff_factor=0.5, validate=False, metrics=None):
+        if aiohttp is None:
+            raise ClientError("The asyncio client needs the aiohttp package")
+
+        self.base_url = mrp_url
+        self.headers = {'Authorization': mrp_token}
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        self.machine_ids = {}
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+        self.validate = validate
+
+    async def open(self):
+        """ Credentials are checked as URLhandler does: by every request,
+            or right away with validate=True """
+        self.session = aiohttp.ClientSession(
+                           headers=self.headers,
+                           connector=aiohttp.TCPConnector(limit=self.pool_size))
+        if self.validate:
+            try:
+                await self.get(VALIDATION_PATH)
+            except Exception as err:
+                await self.close()
+                raise ClientError("Invalid URL or token for MrP") from err
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def __request(self, method, path, **kwargs):
+        url = urljoin(self.base_url, path)
+        attempts = self.retries + 1 if method in IDEMPOTENT_METHODS else 1
+        data = kwargs.get('data')
+        sent = body_length(data) if isinstance(data, (str, bytes)) else 0
+        start = time.perf_counter()
+
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, **kwargs) as req:
+                        status = req.status
+                        body = await req.read()
+                        text = body.decode(req.get_encoding())
+            except (aiohttp.ClientConnectionError, aiohttp.InvalidURL) as err:
+                if attempt + 1 == attempts:
+                    self.metrics.record(RequestEvent(method, endpoint_template(path), path,
+                                                     None, time.perf_counter() - start,
+                                                     0, 0, attempt, str(err)))
+                    if isinstance(err, aiohttp.InvalidURL):
+                        raise ClientError("Invalid URL or token for MrP") from err
+                    raise URLhandlerConnectionError(method, url, err) from err
+                continue
+            if status not in RETRY_STATUS_CODES or attempt + 1 == attempts:
+                break
+
+        self.metrics.record(RequestEvent(method, endpoint_template(path), path, status,
+                                         time.perf_counter() - start, sent, len(body),
+                                         attempt, None))
+
+        if status >= 400:
+            error = URLhandlerHTTPError(method, url, status, text)
+            if status in (401, 403):
+                raise ClientError("Invalid URL or token for MrP") from error
+            raise error
+
+        try:
+            return json.loads(text)
+        except ValueError as jsonerr:
+            raise URLhandlerJSONError(method, url, text) from jsonerr
+
+    async def get(self, path, cached=False):
+        # The on-disk catalog cache is a blocking-client feature; cached is
+        # accepted so controllers read the same either way
+        return await self.__request("GET", path)
+
+    async def put(self, path, data):
+        return await self.__request("PUT", path, data=data)
+
+    async def post(self, path, data, headers=None):
+        return await self.__request("POST", path, data=data, headers=headers)
+
+    async def delete(self, path):
+        return await self.__request("DELETE", path)
+
+
+async def async_get_machine_id(urlhandler, machine_name):
+    """ Look up machine by name """
+    return (await async_get_machine_ids(urlhandler, [machine_name]))[machine_name]
+
+async def async_get_machine_ids(urlhandler, machine_names, strict=True):
+    """ get_machine_ids, with the batch queries sent concurrently """
+    known = urlhandler.machine_ids
+    missing = [name for name in dict.fromkeys(machine_names) if name not in known]
+
+    try:
+        for machines in await asyncio.gather(*[urlhandler.get(path, cached=True)
+                                               for path in machine_query_paths(missing)]):
+            remember_machine_ids(known, machines)
+    except URLhandlerHTTPError as err:
+        if err.status_code != 400:
+            raise
+        remember_machine_ids(known, await urlhandler.get(MACHINE_LIST_PATH, cached=True))
+
+    return machine_ids_result(known, machine_names, missing, strict)
+
+
+class AsyncImageControl(object):
+    def __init__(self, urlhandler, manifest=None):
+        self.urlhandler = urlhandler
+        self.manifest = manifest
+        self.index = None
+        self.lock = asyncio.Lock()
+
+    async def __catalog(self):
+        # Concurrent first lookups share a single catalog fetch
+        async with self.lock:
+            if self.index is None:
+                url = "/api/v1/image?show_all=true"
+                index = {}
+                for image in await self.urlhandler.get(url, cached=True):
+                    index.setdefault((image['type'], image['description'], image['arch']),
+                                     image)
+                self.index = index
+
+        return self.index
+
+    def refresh(self):
+        self.index = None
+
+    async def get_image(self, img_type, desc, arch):
+        if img_type not in IMAGE_TYPES:
+            raise ProvisionerError("Error: Image type is '{}'; must be one of {}".format(
+                                img_type, IMAGE_TYPES))
+
+        return (await self.__catalog()).get((img_type, desc, arch))
+
+    async def get_image_id(self, desc, image_type, arch):
+        image = await self.get_image(image_type, desc, arch)
+        if image is not None and 'id' in image and image['id']:
+            return image['id']
+
+        raise ProvisionerError('No image of description {} for architecture {}'
+                                .format(desc, arch))
+
+    async def upload_image(self, img_type, desc, arch, path, public, good, replace=False):
+        """ Same rules as ImageControl.upload_image; aiohttp streams the file
+            from disk in chunks """
+        key = (img_type, desc, arch)
+        image = await self.get_image(img_type, desc, arch)
+        loop = asyncio.get_running_loop()
+        digest = None
+        replaced = None
+
+        recorded = self.manifest.lookup(image['id']) \
+                   if None not in (self.manifest, image) else None
+        if recorded is not None:
+            digest = await loop.run_in_executor(None, file_digest, path)
+            if digest != recorded:
+                if not replace:
+                    raise ProvisionerError("Image {0} {1} {2} (id {3}) differs from {4}; "
+                                           "replace it to upload the new content".format(
+                                           img_type, desc, arch, image['id'], path))
+                replaced, image = image, None
+
+        if image is not None:
+            return image
+
+        if replaced is not None:
+            # An earlier run may have stored the new content, then failed to
+            # delete the image it replaced
+            for other in await self.urlhandler.get("/api/v1/image?show_all=true"):
+                if (other['type'], other['description'], other['arch']) == key and \
+                   other['id'] != replaced['id'] and \
+                   self.manifest.lookup(other['id']) == digest:
+                    image = other
+                    break
+
+        if image is None:
+            if self.manifest is not None and digest is None:
+                digest = await loop.run_in_executor(None, file_digest, path)
+            with open(path, 'rb') as fd:
+                data = aiohttp.FormData()
+                data.add_field('q', json.dumps({
+                                   'description': desc,
+                                   'type': img_type,
+                                   'arch': arch,
+                                   'known_good': good,
+                                   'public': public,
+                               }))
+                data.add_field('file', fd, filename=os.path.basename(path),
+                               content_type='application/octet-stream')
+                image = await self.urlhandler.post("/api/v1/image", data=data)
+            if self.manifest is not None:
+                self.manifest.record(image['id'], digest)
+
+        if replaced is not None:
+            try:
+                await self.urlhandler.delete("/api/v1/image/{}".format(replaced['id']))
+            except URLhandlerError as err:
+                log.warning("Image {0} was replaced by {1} but cannot be deleted: {2}".format(
+                            replaced['id'], image['id'], err))
+            else:
+                self.manifest.forget(replaced['id'])
+
+        if self.index is not None:
+            self.index[key] = image
+
+        return image
+
+
+class AsyncPreseedControl(object):
+    def __init__(self, urlhandler):
+        self.urlhandler = urlhandler
+        self.by_name = None
+        self.by_name_type = None
+        self.lock = asyncio.Lock()
+
+    async def __index(self):
+        async with self.lock:
+            if self.by_name is not None:
+                return
+            by_name = {}
+            by_name_type = {}
+            for preseed in await self.urlhandler.get('/api/v1/preseed?show_all=true',
+                                                     cached=True):
+                by_name.setdefault(preseed['name'], preseed)
+                by_name_type.setdefault((preseed['name'], preseed['type']), preseed)
+            self.by_name_type = by_name_type
+            self.by_name = by_name
+
+    def refresh(self):
+        self.by_name = None
+        self.by_name_type = None
+
+    async def get_preseed(self, name, preseed_type):
+        if self.by_name is None:
+            await self.__index()
+
+        if preseed_type is None:
+            return self.by_name.get(name)
+        return self.by_name_type.get((name, preseed_type))
+
+    async def get_preseed_id(self, name):
+        preseed = await self.get_preseed(name, None)
+
+        if preseed is not None and 'id' in preseed and preseed['id']:
+            return preseed['id']
+        else:
+            return None
+
+    async def upload_preseed(self, name, preseed_file, preseed_type, preseed_desc,
+                             public, knowngood):
+        return (await self.sync_preseed(name, preseed_file, preseed_type, preseed_desc,
+                                        public, knowngood))[1]
+
+    async def sync_preseed(self, name, preseed_file, preseed_type, preseed_desc, public,
+                           knowngood):
+        """ (CREATED, UPDATED or UNCHANGED, the preseed's record) """
+        url = '/api/v1/preseed'
+        preseed = read_preseed_file(name, preseed_file, preseed_type, preseed_desc,
+                                    public, knowngood)
+        existing = await self.get_preseed(name, None)
+
+        if existing is not None and existing.get('id') and \
+           not preseed_changes(existing, preseed):
+            return UNCHANGED, existing
+
+        self.refresh()
+
+        if existing is None or not existing.get('id'):
+            return CREATED, await self.urlhandler.post(url, data=json.dumps(preseed))
+        else:
+            url = url + '/' + str(existing['id'])
+            return UPDATED, await self.urlhandler.put(url, data=json.dumps(preseed))
+
+
+class AsyncStateControl(object):
+    """ The machine is looked up on first use rather than in the
+        constructor, which cannot await """
+
+    def __init__(self, urlhandler, machine_name, image_controller=None,
+                 preseed_controller=None, machine_id=None):
+        self.urlhandler = urlhandler
+        self.machine_name = machine_name
+        self.machine_id = machine_id
+        self.image_controller = image_controller or AsyncImageControl(urlhandler)
+        self.preseed_controller = preseed_controller or AsyncPreseedControl(urlhandler)
+
+    async def __machine_url(self):
+        if self.machine_id is None:
+            self.machine_id = await async_get_machine_id(self.urlhandler, self.machine_name)
+        return "/api/v1/machine/{}".format(self.machine_id)
+
+    async def provision(self, arch, subarch, initrd_desc, kernel_desc,
+                        kernel_opts="", preseed_name=None):
+        parameters = await self.resolve_parameters(arch, subarch, initrd_desc, kernel_desc,
+                                                   kernel_opts, preseed_name, True)
+        return await self.provision_with(parameters)
+
+    async def provision_with(self, parameters):
+        await self.apply_parameters(parameters)
+
+        url = await self.__machine_url() + "/state"
+        data = json.dumps({'state': 'provision'})
+
+        return await self.urlhandler.post(url, data)
+
+    async def get_provisioning_state(self):
+        return await self.urlhandler.get(await self.__machine_url())
+
+    async def set_provisioning_state(self, arch, subarch, initrd_desc, kernel_desc,
+                                     kernel_opts="", preseed_name=None, netboot=None):
+        parameters = await self.resolve_parameters(arch, subarch, initrd_desc, kernel_desc,
+                                                   kernel_opts, preseed_name, netboot)
+        return await self.apply_parameters(parameters)
+
+    async def resolve_parameters(self, arch, subarch, initrd_desc, kernel_desc,
+                                 kernel_opts="", preseed_name=None, netboot=None):
+        if arch == '' or subarch == '' or initrd_desc == '' or kernel_desc == '':
+            raise ClientError("Missing arguments for setting machine's state")
+
+        if not (initrd_desc and kernel_desc):
+            raise ClientError("Invalid Initrd and Kernel description")
+
+        initrd_id, kernel_id = await asyncio.gather(
+            self.image_controller.get_image_id(initrd_desc, "Initrd", arch),
+            self.image_controller.get_image_id(kernel_desc, "Kernel", arch))
+
+        parameters = dict()
+
+        if preseed_name is not None:
+            preseed_id = await self.preseed_controller.get_preseed_id(preseed_name)
+            if preseed_name and preseed_id is None:
+                raise ProvisionerError("Preseed '{0}' unknown".format(preseed_name))
+            parameters['preseed_id'] = preseed_id
+
+        if kernel_opts:
+            parameters['kernel_opts'] = kernel_opts
+
+        parameters['kernel_id'] = kernel_id
+        parameters['initrd_id'] = initrd_id
+        parameters['subarch'] = subarch
+
+        if netboot is not None:
+            parameters['netboot_enabled'] = netboot
+
+        return parameters
+
+    async def apply_parameters(self, parameters):
+        return await self.urlhandler.put(await self.__machine_url(), json.dumps(parameters))
+
+
+class AsyncNetworkControl(object):
+    """ The interface is fetched on first use rather than in the
+        constructor, which cannot await """
+
+    def __init__(self, urlhandler, machine_id, interface_name):
+        self.urlhandler = urlhandler
+        self.machine_id = machine_id
+        self.interface_name = interface_name
+        self.interface = None
+
+    async def get_interface(self, interface_name):
+        url = "/api/v1/machine/{}/interface".format(self.machine_id)
+        interfaces = await self.urlhandler.get(url)
+
+        if not interfaces:
+            raise ProvisionerError("No interfaces for machine id %s" %
+                                   self.machine_id)
+
+        for i in interfaces:
+            if 'identifier' in i and str(i['identifier']) == interface_name:
+                return i
+
+        raise ProvisionerError("Couldn't find interface %s for machine ID %s" %
+                               (interface_name, self.machine_id))
+
+    async def __field(self, field):
+        if self.interface is None:
+            self.interface = await self.get_interface(self.interface_name)
+        return self.interface.get(field, '')
+
+    async def get_ip(self):
+        return await self.__field('lease_ipv4')
+
+    async def get_mac(self):
+        return await self.__field('mac')
+
+    async def get_netmask(self):
+        return await self.__field('netmaskv4')
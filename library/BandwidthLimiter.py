@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+class BandwidthLimiter(object):
+    """ Token bucket shared by concurrent transfers: together they send at
+        most rate bytes per second, after an initial burst of up to burst
+        bytes (a tenth of a second's worth by default). consume() blocks the
+        calling thread until its bytes fit in the budget """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate / 10.0)
+        self.allowance = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.burst, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            # Taking the bytes at once and sleeping off the debt outside the
+            # lock lets every waiting thread queue behind the others in turn
+            self.allowance -= amount
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
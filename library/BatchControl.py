@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import shlex
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Resource of a line that may touch anything: it runs alone, in its place
+EVERYTHING = ('*', '*')
+EVERYTHING_RESOURCES = (set(), {EVERYTHING})
+
+def read_batch_lines(stream):
+    """ (line number, argv) of every command line in stream; blank lines
+        and # comments are left out. A line shlex can't split gives its
+        ValueError in place of argv """
+    for number, line in enumerate(stream, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as err:
+            yield number, err
+            continue
+        if argv:
+            yield number, argv
+
+def line_resources(args, read_machines=None):
+    """ (reads, writes): sets of (kind, key) a parsed command line touches,
+        key '*' standing for every key of its kind. read_machines turns a
+        --machines-file into names """
+    subcommand = args.subcommand
+    if subcommand == 'image':
+        image = ('image', (args.image_type.lower(), args.description, args.arch))
+        return ({image}, set()) if args.action == 'check' else (set(), {image})
+    if subcommand == 'preseed':
+        preseed = ('preseed', args.preseed_name)
+        return ({preseed}, set()) if args.action == 'check' else (set(), {preseed})
+    if subcommand == 'state':
+        if args.machine is not None:
+            names = [args.machine]
+        elif args.machines:
+            names = [name.strip() for name in args.machines.split(',') if name.strip()]
+        else:
+            names = read_machines(args.machines_file)
+        machines = {('machine', name) for name in names}
+        if args.action == 'getparams':
+            return machines, set()
+        reads = {('image', ('kernel', args.kernel_desc, args.arch)),
+                 ('image', ('initrd', args.initrd_desc, args.arch))}
+        if args.preseed_name:
+            reads.add(('preseed', args.preseed_name))
+        return reads, machines
+    if subcommand == 'net':
+        if args.action == 'getall':
+            names = [name.strip() for name in args.machine.split(',') if name.strip()] \
+                    if args.machine else ['*']
+        else:
+            names = [args.machine]
+        return {('machine', name) for name in names}, set()
+    if subcommand == 'multi':
+        # Only reads, with handlers of its own
+        return set(), set()
+    if subcommand == 'sync':
+        return set(), {('image', '*'), ('preseed', '*')}
+    return set(), {EVERYTHING}
+
+def overlap(resources, others):
+    for kind, key in resources:
+        for other_kind, other_key in others:
+            if (kind == other_kind or EVERYTHING in ((kind, key), (other_kind, other_key))) and \
+               (key == other_key or '*' in (key, other_key)):
+                return True
+    return False
+
+def depends(earlier, later):
+    """ Whether the later of two (reads, writes) must wait for the earlier """
+    reads, writes = earlier
+    later_reads, later_writes = later
+    return overlap(writes, later_reads | later_writes) or overlap(reads, later_writes)
+
+
+class BatchControl(object):
+    """ Runs a list of jobs from a pool of jobs threads, each as soon as
+        the earlier jobs it depends on are done: a job's resources are
+        (reads, writes) as line_resources returns, and it waits for every
+        earlier job writing what it touches or reading what it writes.
+        Independent jobs run in parallel, dependent ones in input order.
+
+        run(job) returns (ok, result). After a failure, jobs not started
+        yet are skipped unless keep_going. results() yields one dict per
+        job, in input order, as soon as it and those before it are done:
+        {'job', 'ok', 'skipped', 'result', 'elapsed'} """
+
+    def __init__(self, jobs=4, keep_going=False):
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+        self.failed = threading.Event()
+
+    def results(self, jobs, resources, run):
+        """ jobs and resources are parallel lists; a job whose resources
+            are None runs alone """
+        resources = [EVERYTHING_RESOURCES if touched is None else touched
+                     for touched in resources]
+
+        def run_one(index, waits):
+            for future in waits:
+                future.result()
+            if self.failed.is_set() and not self.keep_going:
+                return {'job': jobs[index], 'ok': False, 'skipped': True, 'result': None,
+                        'elapsed': 0.0}
+            start = time.monotonic()
+            try:
+                ok, result = run(jobs[index])
+            except Exception as err:
+                ok, result = False, err
+            if not ok:
+                self.failed.set()
+            return {'job': jobs[index], 'ok': ok, 'skipped': False, 'result': result,
+                    'elapsed': time.monotonic() - start}
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = []
+            for index, touched in enumerate(resources):
+                # Jobs are queued in input order, so every job waited for is
+                # already running or done by the time a worker picks this one
+                waits = [futures[earlier] for earlier in range(index)
+                         if depends(resources[earlier], touched)]
+                futures.append(pool.submit(run_one, index, waits))
+            for future in futures:
+                yield future.result()
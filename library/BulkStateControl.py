@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from library.common import *
+from library.ImageControl import ImageControl
+from library.PreseedControl import PreseedControl
+from library.StateControl import StateControl
+
+class BulkStateControl(object):
+    """ Runs the same StateControl action on many machines from a bounded
+        pool of worker threads. Machine names are resolved in one batch and
+        the kernel, initrd and preseed ids once for the whole run; a failure
+        on one machine is reported for it and does not stop the others.
+
+        Every action returns one result dict per machine, in input order:
+        {'machine', 'ok', 'result', 'error', 'elapsed'} """
+
+    def __init__(self, urlhandler, machine_names, concurrency=8, image_controller=None,
+                 preseed_controller=None):
+        self.urlhandler = urlhandler
+        self.machine_names = list(dict.fromkeys(machine_names))
+        self.concurrency = max(1, concurrency)
+        self.image_controller = image_controller or ImageControl(urlhandler)
+        self.preseed_controller = preseed_controller or PreseedControl(urlhandler)
+        self.machine_ids = get_machine_ids(urlhandler, self.machine_names, strict=False)
+
+    def __state(self, machine_name):
+        if machine_name not in self.machine_ids:
+            raise ProvisionerError("Machine {0} unknown to MrP".format(machine_name))
+        return StateControl(self.urlhandler, machine_name, self.image_controller,
+                            self.preseed_controller, self.machine_ids[machine_name])
+
+    def __run(self, action):
+        def run_one(machine_name):
+            start = time.monotonic()
+            try:
+                result = action(self.__state(machine_name))
+                error = None
+            except Exception as err:
+                result = None
+                error = str(err)
+            return {'machine': machine_name, 'ok': error is None, 'result': result,
+                    'error': error, 'elapsed': time.monotonic() - start}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(run_one, self.machine_names))
+
+    def __resolve(self, *args):
+        """ Resolves the shared parameters once for every machine """
+        state = StateControl(self.urlhandler, None, self.image_controller,
+                             self.preseed_controller)
+        return state.resolve_parameters(*args)
+
+    def get_provisioning_state(self):
+        return self.__run(lambda state: state.get_provisioning_state())
+
+    def set_provisioning_state(self, arch, subarch, initrd_desc, kernel_desc,
+                               kernel_opts="", preseed_name=None, netboot=None):
+        parameters = self.__resolve(arch, subarch, initrd_desc, kernel_desc,
+                                    kernel_opts, preseed_name, netboot)
+        return self.__run(lambda state: state.apply_parameters(parameters))
+
+    def provision(self, arch, subarch, initrd_desc, kernel_desc,
+                  kernel_opts="", preseed_name=None):
+        parameters = self.__resolve(arch, subarch, initrd_desc, kernel_desc,
+                                    kernel_opts, preseed_name, True)
+        return self.__run(lambda state: state.provision_with(parameters))
+
+
+def read_machine_list(path):
+    """ One machine name per line, blank lines and # comments ignored """
+    with open(path, 'r') as fd:
+        names = [line.split('#', 1)[0].strip() for line in fd]
+    return [name for name in names if name]
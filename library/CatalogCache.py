@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from library.common import *
+
+CacheEntry = namedtuple('CacheEntry', ['data', 'etag', 'last_modified', 'fresh'])
+
+class CatalogCache(object):
+    """ On-disk cache of catalog listings (images, preseeds, machines) shared
+        by every client run on this host. Entries are keyed by server URL,
+        a hash of the token (so users with different visibility don't see
+        each other's listings) and request path.
+
+        SQLite in WAL mode with a busy timeout takes care of concurrent
+        readers and writers from parallel processes. """
+
+    def __init__(self, server, token, path=None, ttl=300):
+        self.server = server
+        self.token = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        self.path = path or os.path.join(user_cache_dir(), 'catalog.sqlite')
+        self.ttl = ttl
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.__connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS catalog ('
+                       'server TEXT, token TEXT, path TEXT, body TEXT, '
+                       'etag TEXT, last_modified TEXT, fetched REAL, '
+                       'PRIMARY KEY (server, token, path))')
+
+    @contextmanager
+    def __connect(self):
+        # One short-lived connection per operation keeps this usable from
+        # several threads as well as several processes
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def lookup(self, path):
+        with self.__connect() as db:
+            row = db.execute('SELECT body, etag, last_modified, fetched FROM catalog '
+                             'WHERE server = ? AND token = ? AND path = ?',
+                             (self.server, self.token, path)).fetchone()
+        if row is None:
+            return None
+
+        body, etag, last_modified, fetched = row
+        return CacheEntry(json.loads(body), etag, last_modified,
+                          time.time() - fetched < self.ttl)
+
+    def store(self, path, body, etag=None, last_modified=None):
+        with self.__connect() as db:
+            db.execute('INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (self.server, self.token, path, body, etag, last_modified,
+                        time.time()))
+
+    def touch(self, path):
+        """ Marks an entry the server confirmed unchanged as fresh again """
+        with self.__connect() as db:
+            db.execute('UPDATE catalog SET fetched = ? '
+                       'WHERE server = ? AND token = ? AND path = ?',
+                       (time.time(), self.server, self.token, path))
+
+    def invalidate(self, prefix):
+        """ Drops every cached listing under prefix, for all tokens, since a
+            write through one token is visible to the others """
+        with self.__connect() as db:
+            db.execute("DELETE FROM catalog WHERE server = ? AND "
+                       "substr(path, 1, length(?)) = ?",
+                       (self.server, prefix, prefix))
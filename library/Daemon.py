@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Long-lived client daemon serving CLI invocations over a Unix socket, so
+    they share one warm URLhandler, its connections and catalog indexes.
+
+    The protocol is one JSON object per line each way. The request carries
+    the command line, the working directory, and the server URL and a hash
+    of the token; the reply carries the exit status and captured output.
+    A daemon bound to another server or token answers with an error and the
+    caller runs the command itself. While a command runs, the daemon sends
+    an empty line every HEARTBEAT_INTERVAL seconds, so the caller can tell
+    a long command from a daemon that went away.
+
+    forward() only needs the standard library, it is what the front end
+    calls before loading anything else.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+# Seconds forward() waits for the daemon to accept the connection
+CONNECT_TIMEOUT = 5
+
+# Seconds between the empty lines sent while a command runs, and how long
+# the caller waits without any before giving up on the daemon
+HEARTBEAT_INTERVAL = 10
+REPLY_TIMEOUT = 6 * HEARTBEAT_INTERVAL
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def forward(socket_path, argv, mrp_url, mrp_token):
+    """ Runs argv on the daemon listening on socket_path. Returns the reply
+        ({'rc', 'stdout', 'stderr'}), or None when no daemon accepts the
+        connection or it serves another server or token: the caller then
+        runs the command itself.
+
+        Once the command is sent it may have run, so a daemon failing to
+        answer is reported as a failed command (rc 1), never as None """
+    request = {'argv': argv, 'cwd': os.getcwd(), 'mrp_url': mrp_url,
+               'token': token_digest(mrp_token)}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+
+        try:
+            sock.settimeout(REPLY_TIMEOUT)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as stream:
+                for line in stream:
+                    if line.strip():
+                        break
+                else:
+                    raise EOFError('connection closed without a reply')
+            reply = json.loads(line.decode('utf-8'))
+        except (OSError, ValueError, EOFError) as err:
+            return {'rc': 1, 'stdout': '',
+                    'stderr': 'The client daemon on {0} failed during the command, which may '
+                              'or may not have run: {1}\n'.format(socket_path, err)}
+
+    if 'error' in reply:
+        return None
+    return reply
+
+
+class ClientDaemon(object):
+    """ Serves each connection from a thread of its own, so a long command
+        (an upload, a provision with --wait) holds up no other caller.
+
+        handler(argv, cwd) runs one command line, with relative paths taken
+        from cwd, the caller's working directory, and returns (rc, stdout,
+        stderr). It is called from many threads at once """
+
+    def __init__(self, socket_path, mrp_url, mrp_token, handler):
+        self.socket_path = socket_path
+        self.mrp_url = mrp_url
+        self.token = token_digest(mrp_token)
+        self.handler = handler
+
+    def handle(self, request):
+        if request.get('mrp_url') != self.mrp_url or request.get('token') != self.token:
+            return {'error': 'daemon serves another server or token'}
+
+        rc, stdout, stderr = self.handler(request['argv'], request['cwd'])
+
+        return {'rc': rc, 'stdout': stdout, 'stderr': stderr}
+
+    def serve_forever(self):
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                except ValueError:
+                    return
+
+                lock = threading.Lock()
+                done = threading.Event()
+
+                def heartbeat():
+                    while not done.wait(HEARTBEAT_INTERVAL):
+                        try:
+                            with lock:
+                                self.wfile.write(b'\n')
+                        except OSError:
+                            return
+
+                beating = threading.Thread(target=heartbeat, daemon=True)
+                beating.start()
+                try:
+                    reply = daemon.handle(request)
+                except Exception:
+                    reply = {'rc': 1, 'stdout': '', 'stderr': traceback.format_exc()}
+                finally:
+                    done.set()
+                    beating.join()
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        # Only the user running the daemon may talk to it
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+            server.daemon_threads = True
+        finally:
+            os.umask(umask)
+
+        # Let SIGTERM unwind through the finally below and remove the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
@@ -1,29 +1,76 @@
 #!/usr/bin/env python3
 
 import json
+import random
+import threading
+import time
 
 from library.common import *
+from library.LazyIndex import LazyIndex
+from library.MultipartStream import MultipartStream
+from library.Records import Image, as_records
+
+IMAGE_TYPES = ["Kernel", "Initrd", "bootloader"]
+
+# Times an interrupted image upload is tried again, and the base of the
+# exponential backoff between tries, in seconds
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 2.0
 
 class ImageControl(object):
-    def __init__(self, urlhandler):
+    def __init__(self, urlhandler, manifest=None, ttl=None, upload_retries=UPLOAD_RETRIES,
+                 upload_backoff=UPLOAD_BACKOFF):
         self.urlhandler = urlhandler
+        self.manifest = manifest
+        self.ttl = ttl
+        self.index = None
+        self.upload_retries = upload_retries
+        self.upload_backoff = upload_backoff
+        # Totals over every upload of this controller: tries after the first,
+        # images that appeared while a try failed (maybe stored by it), bytes
+        # sent by failed tries
+        self.retry_stats = {'retries': 0, 'suspects': 0, 'extra_bytes': 0}
+        self.stats_lock = threading.Lock()
 
-    def get_image(self, img_type, desc, arch):
-        url = "/api/v1/image?show_all=true"
-        allowed_types = ["Kernel", "Initrd", "bootloader"]
-        if img_type not in allowed_types:
-            raise ProvisionerError("Error: Image type is '{}'; must be one of {}".format(
-                                img_type, allowed_types))
+    def __catalog(self):
+        """ Index of the image catalog by (type, description, arch), reused
+            by every lookup on this controller, for at most ttl seconds if one
+            is set. The first lookups are answered by filtered queries; past
+            QUERY_LIMIT of them, or if the server can't filter, it is filled
+            from one streamed listing as lookups need it. The first image
+            listed wins, as with the former linear scan """
+        if self.index is not None and self.ttl is not None and self.index.age() > self.ttl:
+            self.refresh()
 
-        images = self.urlhandler.get(url)
+        if self.index is None:
+            url = "/api/v1/image?show_all=true"
+            self.index = LazyIndex(lambda: as_records(Image,
+                                                      self.urlhandler.stream_list(url, cached=True)),
+                                   {'image': lambda image: (image['type'], image['description'],
+                                                            image['arch'])})
+        return self.index
 
-        for image in images:
-            if (image['description'] == desc and
-                image['type'] == img_type and
-                image['arch'] == arch):
-                return image
+    def preload(self):
+        """ Reads the whole catalog listing now, rather than querying MrP
+            image by image, for callers about to look up many images """
+        self.__catalog().load()
 
-        return None
+    def refresh(self):
+        """ Drops the catalog index, the next lookup fetches it again """
+        if self.index is not None:
+            self.index.close()
+        self.index = None
+
+    def get_image(self, img_type, desc, arch):
+        if img_type not in IMAGE_TYPES:
+            raise ProvisionerError("Error: Image type is '{}'; must be one of {}".format(
+                                img_type, IMAGE_TYPES))
+
+        fields = [('type', img_type), ('description', desc), ('arch', arch)]
+        return self.__catalog().lookup('image', (img_type, desc, arch),
+                                       lambda: Image.from_list(
+                                               query_collection(self.urlhandler, 'image',
+                                                                fields)))
 
     def get_image_id(self, desc, image_type, arch):
         image = self.get_image(image_type, desc, arch)
@@ -33,20 +80,156 @@ class ImageControl(object):
         raise ProvisionerError('No image of description {} for architecture {}'
                                 .format(desc, arch))
 
-    def upload_image(self, img_type, desc, arch, path, public, good):
+    def upload_image(self, img_type, desc, arch, path, public, good, progress=None,
+                     manifest=None, replace=False):
+        """ Uploads the image unless MrP already has it. With a manifest, an
+            existing image whose recorded digest differs from the local file
+            is reported as changed, and with replace=True replaced by a new
+            upload, the old image being deleted once the new one is stored.
+            Without a manifest, or when this client never uploaded it, a
+            matching description is taken as the same image. manifest, if
+            given, is used instead of the controller's, so that callers
+            sharing a controller can each bring their own """
+        return self.sync_image(img_type, desc, arch, path, public, good, progress,
+                               manifest=manifest, replace=replace)[1]
+
+    def sync_image(self, img_type, desc, arch, path, public, good, progress=None,
+                   limiter=None, manifest=None, replace=False):
+        """ upload_image, also telling what it did:
+            (CREATED, UPDATED or UNCHANGED, the image's record). limiter, a
+            BandwidthLimiter, caps the upload rate """
+        if manifest is None:
+            manifest = self.manifest
+        key = (img_type, desc, arch)
         image = self.get_image(img_type, desc, arch)
+        digest = None
+        replaced = None
+
+        # The file is only hashed when there is a recorded digest to compare
+        # it with, or a new upload to record
+        recorded = manifest.lookup(image['id']) if None not in (manifest, image) else None
+        if recorded is not None:
+            digest = file_digest(path)
+            if digest != recorded:
+                if not replace:
+                    raise ProvisionerError("Image {0} {1} {2} (id {3}) differs from {4}; "
+                                           "replace it to upload the new content".format(
+                                           img_type, desc, arch, image['id'], path))
+                replaced, image = image, None
+
         if image is not None:
-            return image
-
-        url = "/api/v1/image"
-        files = {'file': open(path, 'rb')}
-        data = {'q': json.dumps({
-                     'description': desc,
-                     'type': img_type,
-                     'arch': arch,
-                     'known_good': good,
-                     'public': public,
-                 })
-               }
-
-        return self.urlhandler.post(url, files=files, data=data)
+            return UNCHANGED, image
+
+        if replaced is not None:
+            # An earlier run may have stored the new content, then failed to
+            # delete the image it replaced
+            image = self.__recorded_copy(key, digest, manifest, replaced['id'])
+
+        if image is None:
+            if manifest is not None and digest is None:
+                digest = file_digest(path)
+            url = "/api/v1/image"
+            data = {'q': json.dumps({
+                         'description': desc,
+                         'type': img_type,
+                         'arch': arch,
+                         'known_good': good,
+                         'public': public,
+                     })
+                   }
+
+            known = {replaced['id']} if replaced is not None else set()
+            image = self.__post_image(url, data, path, key, known, progress, limiter)
+            if manifest is not None:
+                manifest.record(image['id'], digest)
+
+        if replaced is not None:
+            self.__delete_replaced(replaced, image, manifest)
+
+        if self.index is not None:
+            self.index.set(image, replaces=replaced)
+
+        return (CREATED if replaced is None else UPDATED), image
+
+    def __recorded_copy(self, key, digest, manifest, replaced_id):
+        """ An image matching key, other than replaced_id, that the manifest
+            says has this digest """
+        for image in self.__newcomers(key, {replaced_id}):
+            if manifest.lookup(image['id']) == digest:
+                return image
+        return None
+
+    def __delete_replaced(self, replaced, image, manifest):
+        """ Deletes the image replaced by image. Machines still pointing at it
+            have to be moved by their owners; if MrP refuses, the upload
+            stands and the manifest keeps the old image, so the next upload
+            tries the deletion again rather than storing another copy """
+        try:
+            self.urlhandler.delete("/api/v1/image/{}".format(replaced['id']))
+        except URLhandlerError as err:
+            log.warning("Image {0} was replaced by {1} but cannot be deleted: {2}".format(
+                        replaced['id'], image['id'], err))
+            return
+        manifest.forget(replaced['id'])
+
+    def __report_newcomers(self, key, known):
+        try:
+            newcomers = self.__newcomers(key, known)
+        except (requests.exceptions.RequestException, URLhandlerError) as err:
+            log.warning("Cannot check MrP for images left by failed uploads of {0}: "
+                        "{1}".format(' '.join(key), err))
+            return
+        if newcomers:
+            self.__count(suspects=len(newcomers))
+            log.warning("Images {0} of {1} appeared while an upload of it failed; they may be "
+                        "copies stored by the failed tries".format(
+                        ', '.join(str(image['id']) for image in newcomers), ' '.join(key)))
+
+    def __count(self, **increments):
+        with self.stats_lock:
+            for name, value in increments.items():
+                self.retry_stats[name] += value
+
+    def __newcomers(self, key, known):
+        """ Images matching key whose id is not in known """
+        img_type, desc, arch = key
+        images = query_collection(self.urlhandler, 'image',
+                                  [('type', img_type), ('description', desc), ('arch', arch)],
+                                  cached=False)
+        if images is None:
+            listing = self.urlhandler.stream_list("/api/v1/image?show_all=true")
+            images = [image for image in listing
+                      if (image['type'], image['description'], image['arch']) == key]
+        return Image.from_list([image for image in images if image['id'] not in known])
+
+    def __post_image(self, url, data, path, key, known, progress, limiter):
+        """ POSTs the image, trying again with exponential backoff and jitter
+            when the connection drops or a gateway fails.
+
+            A failed try may still have been stored. MrP's image records carry
+            no size or digest, so an image that appeared meanwhile can't be
+            told from one someone else uploaded under the same description:
+            the file is sent again in full, and images that appeared during
+            the failed tries are logged as possible duplicates to check """
+        error = None
+        for attempt in range(self.upload_retries + 1):
+            if attempt:
+                time.sleep(self.upload_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                self.__count(retries=1)
+
+            with MultipartStream(data, 'file', path, progress=progress,
+                                 limiter=limiter) as body:
+                try:
+                    image = Image.from_json(self.urlhandler.post(
+                                url, data=body, headers={'Content-Type': body.content_type}))
+                    if attempt:
+                        self.__report_newcomers(key, known | {image['id']})
+                    return image
+                except (URLhandlerConnectionError, URLhandlerHTTPError) as err:
+                    if isinstance(err, URLhandlerHTTPError) and \
+                       err.status_code not in RETRY_STATUS_CODES:
+                        raise
+                    error = err
+                    self.__count(extra_bytes=body.sent)
+
+        raise error
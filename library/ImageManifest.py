@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import json
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+from library.common import *
+
+class ImageManifest(object):
+    """ Local record of the content digest of every image this client
+        uploaded, per MrP server. MrP itself does not expose a checksum, so
+        this is what lets upload_image tell an identical re-push (skip) from
+        a rebuilt image reusing the same description (replace).
+
+        The file is shared by concurrent clients: updates are serialised with
+        an advisory lock and written atomically. """
+
+    def __init__(self, server, path=None):
+        self.server = server
+        self.path = path or os.path.join(user_cache_dir(), 'image-manifest.json')
+
+    def __load(self):
+        try:
+            with open(self.path, 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def __locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                manifest = self.__load()
+                yield manifest
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(fd, 'w') as out:
+                    json.dump(manifest, out, indent=2, sort_keys=True)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def lookup(self, image_id):
+        """ Digest recorded for image_id on this server, or None """
+        return self.__load().get(self.server, {}).get(str(image_id))
+
+    def record(self, image_id, digest):
+        with self.__locked() as manifest:
+            manifest.setdefault(self.server, {})[str(image_id)] = digest
+
+    def forget(self, image_id):
+        with self.__locked() as manifest:
+            manifest.get(self.server, {}).pop(str(image_id), None)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+# Filtered queries a LazyIndex sends before it reads the whole listing instead
+QUERY_LIMIT = 5
+
+class LazyIndex(object):
+    """ Dict indexes over a streamed catalog listing, filled only as far as
+        lookups need: a lookup missing from the indexes reads on through the
+        listing and stops at the first match, so a catalog is only read to
+        the end for names it does not have. The listing stays open between
+        lookups and is fetched again if it broke off meanwhile.
+
+        fetch() returns an iterator over the catalog; keys maps index names
+        to functions of a record returning its key there. The first record
+        listed under a key wins. Lookups may come from several threads """
+
+    def __init__(self, fetch, keys, query_limit=QUERY_LIMIT):
+        self.fetch = fetch
+        self.keys = keys
+        self.query_limit = query_limit
+        self.queries = 0
+        self.indexes = {name: {} for name in keys}
+        self.lock = threading.RLock()
+        self.listing = None
+        self.complete = False
+        self.created = time.monotonic()
+
+    def __add(self, record):
+        for name, key in self.keys.items():
+            self.indexes[name].setdefault(key(record), record)
+
+    def __fill(self, done):
+        """ Reads on through the listing until done() or its end """
+        # A listing left open since an earlier lookup may have been dropped
+        # by the server meanwhile: start it over once, known records are kept
+        retry = self.listing is not None
+        while not done() and not self.complete:
+            if self.listing is None:
+                self.listing = self.fetch()
+            try:
+                record = next(self.listing)
+            except StopIteration:
+                self.complete = True
+                self.close()
+            except Exception:
+                self.close()
+                if not retry:
+                    raise
+                retry = False
+            else:
+                self.__add(record)
+
+    def get(self, name, key):
+        index = self.indexes[name]
+        with self.lock:
+            self.__fill(lambda: key in index)
+            return index.get(key)
+
+    def lookup(self, name, key, query):
+        """ get(), asking the server first: query() returns the records
+            matching key, filtered by MrP, or None if it can't filter. The
+            answer is kept in the index. After query_limit queries the
+            listing is read instead, one listing costing less than many
+            small requests. A miss is not kept: the record may be created
+            meanwhile, and the listing must still be able to index it """
+        index = self.indexes[name]
+        with self.lock:
+            if key in index or self.complete or self.queries >= self.query_limit:
+                return self.get(name, key)
+            self.queries += 1
+
+        records = query()
+        if records is None:
+            return self.get(name, key)
+
+        if not records:
+            return None
+        with self.lock:
+            return index.setdefault(key, records[0])
+
+    def load(self):
+        """ Reads the whole listing now """
+        with self.lock:
+            self.__fill(lambda: False)
+
+    def set(self, record, replaces=None):
+        """ Makes record the one indexed under its keys, as after an upload;
+            the keys of the record it replaces are dropped first """
+        with self.lock:
+            for name, key in self.keys.items():
+                if replaces is not None:
+                    self.indexes[name].pop(key(replaces), None)
+                self.indexes[name][key(record)] = record
+
+    def age(self):
+        return time.monotonic() - self.created
+
+    def close(self):
+        with self.lock:
+            if self.listing is not None:
+                self.listing.close()
+                self.listing = None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    In-process entry point to the library, for orchestrators and Ansible
+    modules that would otherwise run the command line client per task.
+
+    One MrPClient holds one URLhandler, so its keep-alive connections, the
+    credential check and the catalog indexes serve every call made through
+    it. Calls return records (read as dicts; to_dict() gives a plain one,
+    for json.dumps) and result dicts instead of printing, and report
+    failures as MrPError subclasses instead of exiting:
+        ClientError       bad arguments, URL or token
+        ProvisionerError  MrP does not have what was asked for
+        URLhandlerError   a request failed (URLhandlerHTTPError: MrP
+                          answered with an error status,
+                          URLhandlerConnectionError: no answer)
+    Bulk calls (provision, apply, sync) report each machine or file in its
+    own result dict rather than failing as a whole.
+"""
+
+import functools
+
+import requests
+
+from library.common import *
+from library.AdmissionControl import AdmissionController
+from library.ApplyControl import ApplyControl, check_desired_state
+from library.BulkStateControl import BulkStateControl
+from library.CatalogCache import CatalogCache
+from library.ImageControl import ImageControl
+from library.ImageManifest import ImageManifest
+from library.NetworkControl import NetworkControl, NetworkInventory
+from library.PreseedControl import PreseedControl
+from library.StateControl import StateControl
+from library.SyncControl import SyncControl
+from library.WaitControl import ProvisionWaiter
+
+def typed_errors(method):
+    """ Turns the transport's errors into URLhandlerConnectionError """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except requests.exceptions.RequestException as err:
+            request = getattr(err, 'request', None)
+            raise URLhandlerConnectionError(getattr(request, 'method', None),
+                                            getattr(request, 'url', None), err) from err
+    return wrapper
+
+
+class MrPClient(object):
+    """ cache=True keeps the catalogs in the on-disk cache between
+        processes, for cache_ttl seconds; index_ttl bounds how long this
+        client reuses its catalog lookups (default: until refresh()).
+        manifest is the image digest manifest's path, or False to compare
+        images by description only, as with --no-manifest.
+
+        Use it as a context manager, or call close() """
+
+    def __init__(self, mrp_url, mrp_token, pool_size=10, retries=3, cache=False, cache_ttl=300,
+                 cache_path=None, index_ttl=None, manifest=None, validate=False,
+                 max_in_flight=None, max_rate=None, urlhandler=None):
+        self.owns_urlhandler = urlhandler is None
+        if urlhandler is None:
+            admission = AdmissionController(max_in_flight or pool_size, rate=max_rate)
+            catalog_cache = CatalogCache(mrp_url, mrp_token, cache_path, cache_ttl) \
+                            if cache else None
+            urlhandler = URLhandler(mrp_url, mrp_token, pool_size=pool_size, retries=retries,
+                                    cache=catalog_cache, validate=validate,
+                                    admission=admission)
+        self.urlhandler = urlhandler
+        self.images = ImageControl(urlhandler, ttl=index_ttl)
+        if manifest is not False:
+            self.images.manifest = ImageManifest(urlhandler.base_url, manifest)
+        self.preseeds = PreseedControl(urlhandler, ttl=index_ttl)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.images.refresh()
+        self.preseeds.refresh()
+        if self.owns_urlhandler:
+            self.urlhandler.close()
+
+    @property
+    def metrics(self):
+        """ The RequestMetrics of every request made through this client """
+        return self.urlhandler.metrics
+
+    def refresh(self):
+        """ Forgets the catalog lookups, for changes made behind our back """
+        self.images.refresh()
+        self.preseeds.refresh()
+
+    @typed_errors
+    def get_image(self, image_type, description, arch):
+        """ The Image, or None if MrP has none such """
+        return self.images.get_image(image_type, description, arch)
+
+    @typed_errors
+    def upload_image(self, image_type, description, arch, path, public=False,
+                     known_good=False, progress=None, replace=False):
+        """ Returns (CREATED, UPDATED or UNCHANGED, the Image); see
+            ImageControl.upload_image for replace """
+        return self.images.sync_image(image_type, description, arch, path, public,
+                                      known_good, progress, replace=replace)
+
+    @typed_errors
+    def get_preseed(self, name, preseed_type=None):
+        """ The Preseed, or None if MrP has none such """
+        return self.preseeds.get_preseed(name, preseed_type)
+
+    @typed_errors
+    def upload_preseed(self, name, path, preseed_type, description='', public=False,
+                       known_good=False):
+        """ Returns (CREATED, UPDATED or UNCHANGED, the Preseed) """
+        return self.preseeds.sync_preseed(name, path, preseed_type, description, public,
+                                          known_good)
+
+    @typed_errors
+    def get_machine(self, machine_name):
+        """ The Machine with its provisioning parameters """
+        return StateControl(self.urlhandler, machine_name, self.images,
+                            self.preseeds).get_provisioning_state()
+
+    @typed_errors
+    def apply(self, desired, dry_run=False, concurrency=8):
+        """ Brings machines to desired parameters, a name -> dict of
+            DESIRED_KEYS mapping as read_desired_state returns, writing only
+            what differs. Returns ApplyControl's plan with dry_run, its
+            results otherwise """
+        check_desired_state(desired)
+        control = ApplyControl(self.urlhandler, desired, concurrency, self.images,
+                               self.preseeds)
+        plan = control.plan()
+        return plan if dry_run else control.apply(plan)
+
+    def set_machine(self, machine_name, **desired):
+        """ apply() on one machine; returns its result dict """
+        return self.apply({machine_name: desired})[0]
+
+    @typed_errors
+    def provision(self, machine_names, arch, subarch, initrd_desc, kernel_desc,
+                  kernel_opts='', preseed_name=None, concurrency=8, wait=False,
+                  wait_timeout=1800, interface=None):
+        """ Provisions machines as the state command does. Returns
+            BulkStateControl's result dicts; with wait, once the machines are
+            ready or timed out, each also carries the 'state' and 'ip' the
+            waiter saw, and 'ok' tells whether it came up """
+        bulk = BulkStateControl(self.urlhandler, machine_names, concurrency, self.images,
+                                self.preseeds)
+        waiter = None
+        if wait:
+            waiter = ProvisionWaiter(self.urlhandler, interface, timeout=wait_timeout)
+            waiter.snapshot(bulk.machine_ids, concurrency)
+        results = bulk.provision(arch, subarch, initrd_desc, kernel_desc, kernel_opts,
+                                 preseed_name)
+        if not wait:
+            return results
+
+        started = {result['machine']: bulk.machine_ids[result['machine']]
+                   for result in results if result['ok']}
+        waited = {result['machine']: result for result in waiter.wait(started)}
+        for result in results:
+            if result['machine'] in waited:
+                outcome = waited[result['machine']]
+                result.update(ok=outcome['ok'], error=outcome['error'], state=outcome['state'],
+                              ip=outcome['ip'], elapsed=result['elapsed'] + outcome['elapsed'])
+        return results
+
+    @typed_errors
+    def get_interface(self, machine_name, interface_name):
+        """ The Interface: lease_ipv4, mac, netmaskv4... """
+        return NetworkControl(self.urlhandler, get_machine_id(self.urlhandler, machine_name),
+                              interface_name).interface
+
+    @typed_errors
+    def network_inventory(self, machine_names=None, concurrency=8):
+        """ NetworkInventory rows of the given machines, or of all of them """
+        return list(NetworkInventory(self.urlhandler, concurrency).rows(machine_names))
+
+    @typed_errors
+    def sync(self, images, preseeds, concurrency=4, bandwidth=None, replace=False):
+        """ SyncControl.sync; entries as read_sync_manifest returns them """
+        return SyncControl(self.urlhandler, concurrency, bandwidth, self.images,
+                           self.preseeds, replace=replace).sync(images, preseeds)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import queue
+import threading
+import time
+
+import requests
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from library.common import *
+from library.AdmissionControl import AdmissionController
+from library.ImageControl import ImageControl
+from library.NetworkControl import NetworkControl
+from library.PreseedControl import PreseedControl
+
+# Seconds a server has to answer a query when its entry sets none
+DEFAULT_TIMEOUT = 10.0
+
+def read_server_list(path):
+    """ MrP servers from a JSON or YAML file (YAML needs PyYAML), a list of
+            {"url": ..., "token": ..., "name": ..., "timeout": ...}
+        name (default: the URL) and timeout (seconds) being optional """
+    try:
+        with open(path, 'r') as fd:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise ClientError("Reading {} needs the PyYAML package".format(path))
+                document = yaml.safe_load(fd)
+            else:
+                document = json.load(fd)
+    except (OSError, ValueError) + ((yaml.YAMLError,) if yaml is not None else ()) as err:
+        raise ClientError("Cannot read server list {}: {}".format(path, err))
+
+    if not isinstance(document, list):
+        raise ClientError("Invalid server list {}: expected a list of servers".format(path))
+    servers = []
+    for index, entry in enumerate(document):
+        if not isinstance(entry, dict) or not entry.get('url') or not entry.get('token'):
+            raise ClientError("Invalid server list {}: entry {} needs a url and a token".format(
+                              path, index))
+        servers.append({'name': entry.get('name') or entry['url'], 'url': entry['url'],
+                        'token': entry['token'], 'timeout': entry.get('timeout')})
+    return servers
+
+
+class MultiServerControl(object):
+    """ Runs the same lookup on several MrP servers at once, one thread and
+        one URLhandler per server, so that finding which site has a machine
+        or an image takes as long as the slowest answer rather than the sum
+        of them.
+
+        servers are dicts as read_server_list returns. Each server has its
+        own timeout (the default timeout if its entry sets none): past it,
+        the server is reported as timed out and left behind, without holding
+        up the others. The handlers, their catalog indexes and known machine
+        ids are kept between queries until close().
+
+        Queries yield one dict per server, as soon as it answers or times
+        out: {'server', 'url', 'ok', 'found', 'result', 'error', 'elapsed'}.
+        ok is whether the server answered, found whether it has what was
+        looked up """
+
+    def __init__(self, servers, timeout=DEFAULT_TIMEOUT, pool_size=4, retries=1):
+        if not servers:
+            raise ClientError("No MrP servers to query")
+        self.servers = []
+        for server in servers:
+            server_timeout = server.get('timeout') or timeout
+            # The handler's own timeout keeps a stalled server from holding
+            # its thread, and the process, long after it was left behind
+            urlhandler = URLhandler(server['url'], server['token'], pool_size=pool_size,
+                                    retries=retries, admission=AdmissionController(pool_size),
+                                    timeout=server_timeout)
+            self.servers.append({'name': server.get('name') or server['url'],
+                                 'url': server['url'], 'timeout': server_timeout,
+                                 'urlhandler': urlhandler,
+                                 'images': ImageControl(urlhandler),
+                                 'preseeds': PreseedControl(urlhandler)})
+
+    def close(self):
+        for server in self.servers:
+            server['urlhandler'].close()
+
+    def query(self, lookup):
+        """ Runs lookup(server) on every server, server being one of
+            self.servers. lookup returns what was found, or None; a
+            ProvisionerError also means not found """
+        answers = queue.Queue()
+        start = time.monotonic()
+        for index, server in enumerate(self.servers):
+            threading.Thread(target=self.__ask, args=(index, server, lookup, answers),
+                             daemon=True).start()
+
+        waiting = dict(enumerate(self.servers))
+        while waiting:
+            deadline = min(start + server['timeout'] for server in waiting.values())
+            try:
+                index, result = answers.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                now = time.monotonic()
+                for index, server in list(waiting.items()):
+                    if start + server['timeout'] <= now:
+                        del waiting[index]
+                        yield self.__result(server, False, None,
+                                            "timed out after {}s".format(server['timeout']),
+                                            now - start)
+                continue
+            # An answer past its deadline was already reported as timed out
+            if index in waiting:
+                del waiting[index]
+                yield result
+
+    def __ask(self, index, server, lookup, answers):
+        start = time.monotonic()
+        try:
+            found = lookup(server)
+            result = self.__result(server, True, found, None, time.monotonic() - start)
+        except ProvisionerError:
+            result = self.__result(server, True, None, None, time.monotonic() - start)
+        except Exception as err:
+            cause = err if isinstance(err, requests.exceptions.RequestException) \
+                    else err.__cause__
+            if isinstance(cause, requests.exceptions.Timeout):
+                error = "timed out after {}s".format(server['timeout'])
+            elif isinstance(cause, requests.exceptions.RequestException):
+                error = "{} ({})".format(err, type(cause).__name__)
+            else:
+                error = str(err)
+            result = self.__result(server, False, None, error, time.monotonic() - start)
+        answers.put((index, result))
+
+    def __result(self, server, ok, found, error, elapsed):
+        return {'server': server['name'], 'url': server['url'], 'ok': ok,
+                'found': found is not None, 'result': found, 'error': error,
+                'elapsed': elapsed}
+
+    def get_machine_id(self, machine_name):
+        return self.query(lambda server: get_machine_id(server['urlhandler'], machine_name))
+
+    def get_image(self, image_type, description, arch):
+        return self.query(lambda server: server['images'].get_image(image_type, description,
+                                                                    arch))
+
+    def get_preseed(self, name, preseed_type=None):
+        return self.query(lambda server: server['preseeds'].get_preseed(name, preseed_type))
+
+    def get_interface(self, machine_name, interface_name):
+        """ The Interface (lease_ipv4, mac, netmaskv4...) of a machine on
+            whichever servers know it """
+        def lookup(server):
+            urlhandler = server['urlhandler']
+            return NetworkControl(urlhandler, get_machine_id(urlhandler, machine_name),
+                                  interface_name).interface
+        return self.query(lookup)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import uuid
+
+CHUNK_SIZE = 1024 * 1024
+
+class MultipartStream(object):
+    """ File-like multipart/form-data body that reads the uploaded file in
+        fixed-size chunks as the transport asks for them, so memory stays
+        bounded by CHUNK_SIZE whatever the size of the image.
+
+        progress, if given, is called as progress(sent, total, elapsed) after
+        every chunk handed to the transport; limiter, a BandwidthLimiter,
+        holds every chunk back as long as the rate it allows requires. """
+
+    def __init__(self, fields, file_field, path, chunk_size=CHUNK_SIZE, progress=None,
+                 limiter=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.limiter = limiter
+
+        head = b''
+        for name, value in fields.items():
+            head += self.__part_header(name) + value.encode('utf-8') + b'\r\n'
+        head += self.__part_header(file_field, os.path.basename(path))
+
+        self.file_size = os.path.getsize(path)
+        self.parts = [head, None, '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')]
+        self.length = len(head) + self.file_size + len(self.parts[2])
+
+        self.fd = None
+        self.current = 0
+        self.offset = 0
+        self.sent = 0
+        self.started = None
+
+    def __part_header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        header = '--{}\r\nContent-Disposition: {}'.format(self.boundary, disposition)
+        if filename is not None:
+            header += '; filename="{}"\r\nContent-Type: application/octet-stream'.format(
+                      filename)
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def __next_part(self, limit):
+        """ Returns at most limit bytes of the current part, moving on to
+            the following part when the current one is exhausted """
+        while self.current < len(self.parts):
+            part = self.parts[self.current]
+            if part is None:
+                if self.fd is None:
+                    self.fd = open(self.path, 'rb')
+                data = self.fd.read(min(limit, self.chunk_size))
+                if data:
+                    return data
+                self.close()
+            elif self.offset < len(part):
+                data = part[self.offset:self.offset + limit]
+                self.offset += len(data)
+                return data
+            self.current += 1
+            self.offset = 0
+        return b''
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.monotonic()
+        if size is None or size < 0:
+            size = self.length
+
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.__next_part(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+
+        chunk = b''.join(chunks)
+        self.sent += len(chunk)
+
+        if chunk and self.limiter is not None:
+            self.limiter.consume(len(chunk))
+
+        if chunk and self.progress is not None:
+            self.progress(self.sent, self.length, time.monotonic() - self.started)
+
+        return chunk
+
+def print_progress(sent, total, elapsed):
+    """ Default progress callback for the CLI, prints on stderr """
+    rate = sent / elapsed if elapsed > 0 else 0
+    percent = 100.0 * sent / total if total else 100.0
+    sys.stderr.write('\r{:6.2f}% {:>12} bytes {:8.2f} MiB/s'.format(
+                     percent, sent, rate / (1024 * 1024)))
+    if sent >= total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
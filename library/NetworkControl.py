@@ -3,9 +3,14 @@
 
 import ipaddress
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from library.common import *
+from library.Records import Interface, as_records
 from urllib.parse import quote
 
+INVENTORY_FIELDS = ['machine', 'interface', 'ip', 'mac', 'netmask']
+
 class NetworkControl(object):
     def __init__(self, urlhandler, machine_id, interface_name):
         self.urlhandler = urlhandler
@@ -14,16 +19,19 @@ class NetworkControl(object):
 
     def get_interface(self, interface_name):
         url = "/api/v1/machine/{}/interface".format(self.machine_id)
-        interfaces = self.urlhandler.get(url)
-
-        if not interfaces:
-            raise ProvisionerError("No interfaces for machine id %s" %
-                                   self.machine_id)
+        interfaces = as_records(Interface, self.urlhandler.stream_list(url))
+        found = False
 
         for i in interfaces:
+            found = True
             if 'identifier' in i and str(i['identifier']) == interface_name:
+                interfaces.close()
                 return i
 
+        if not found:
+            raise ProvisionerError("No interfaces for machine id %s" %
+                                   self.machine_id)
+
         raise ProvisionerError("Couldn't find interface %s for machine ID %s" %
                                (interface_name, self.machine_id))
 
@@ -41,3 +49,40 @@ class NetworkControl(object):
         if 'netmaskv4' in self.interface:
             return self.interface['netmaskv4']
         return ''
+
+def get_interfaces(urlhandler, machine_id):
+    url = "/api/v1/machine/{}/interface".format(machine_id)
+    return Interface.from_list(urlhandler.get(url))
+
+class NetworkInventory(object):
+    """ Network settings of every interface of many machines, fetched from
+        a bounded pool of threads. Rows are yielded as soon as each
+        machine's interfaces arrive, so their order is not the machines' """
+
+    def __init__(self, urlhandler, concurrency=8):
+        self.urlhandler = urlhandler
+        self.concurrency = max(1, concurrency)
+
+    def get_machines(self, machine_names=None):
+        """ name -> id of the given machines, or of every machine visible
+            with this token """
+        if machine_names:
+            return get_machine_ids(self.urlhandler, machine_names)
+
+        machines = self.urlhandler.get("/api/v1/machine?show_all=true")
+        return {machine['name']: machine['id'] for machine in machines
+                if 'name' in machine and 'id' in machine}
+
+    def rows(self, machine_names=None):
+        machines = self.get_machines(machine_names)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(get_interfaces, self.urlhandler, machine_id): name
+                       for name, machine_id in machines.items()}
+            for future in as_completed(futures):
+                for interface in future.result():
+                    yield {'machine': futures[future],
+                           'interface': interface.get('identifier', ''),
+                           'ip': interface.get('lease_ipv4', ''),
+                           'mac': interface.get('mac', ''),
+                           'netmask': interface.get('netmaskv4', '')}
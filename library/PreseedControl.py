@@ -5,47 +5,101 @@ import json
 import os.path
 
 from library.common import *
+from library.LazyIndex import LazyIndex
+from library.Records import Preseed, as_records, content_digest
+
+def read_preseed_file(name, preseed_file, preseed_type, preseed_desc, public, knowngood):
+    """ Preseed record as MrP expects it, from a local file """
+    if preseed_type is None:
+        raise ClientError("No preseed_type specified")
+    if preseed_file == '':
+        raise ClientError("No preseed file given, nothing to upload")
+    if not os.path.isfile(preseed_file):
+        raise ClientError("Preseed file's path is invalid")
+
+    json_preseed = {}
+
+    with open(preseed_file, 'r') as fd:
+        contents = fd.read()
+
+    if preseed_desc != '':
+        json_preseed['description'] = preseed_desc
+
+    json_preseed['content'] = contents
+    json_preseed['name'] = name
+    json_preseed['type'] = preseed_type
+    json_preseed['public'] = public
+    json_preseed['known_good'] = knowngood
+
+    return json_preseed
+
+def preseed_changes(existing, preseed):
+    """ Fields of the local preseed record that differ from the existing
+        one on MrP; content is compared by digest. A field the local record
+        leaves out (no description given) is not a change """
+    changes = []
+    for field, value in preseed.items():
+        if field == 'content':
+            if isinstance(existing, Preseed):
+                digest = existing.content_digest()
+            else:
+                digest = content_digest(existing.get('content'))
+            if digest != content_digest(value):
+                changes.append(field)
+        elif existing.get(field) != value:
+            changes.append(field)
+    return changes
 
 class PreseedControl(object):
     """ This class handles the job of uploading a preseed file to MrP.
         It also handles the job of checking whether a preseed is already
         on MrP, and modify it in that eventuality"""
 
-    def __init__(self, urlhandler):
+    def __init__(self, urlhandler, ttl=None):
         self.urlhandler = urlhandler
-
-    def __get_preseed_from_file(self, name, preseed_file, preseed_type, preseed_desc,  public,
-                                knowngood):
-        json_preseed = {}
-        contents = ''
-
-        with open(preseed_file, 'r') as fd:
-            lines = fd.readlines()
-
-        for line in lines:
-            contents += line
-
-        if preseed_desc != '':
-            json_preseed['description'] = preseed_desc
-
-        json_preseed['content'] = contents
-        json_preseed['name'] = name
-        json_preseed['type'] = preseed_type
-        json_preseed['public'] = public
-        json_preseed['known_good'] = knowngood
-
-        return json_preseed
+        self.ttl = ttl
+        self.index = None
+
+    def __catalog(self):
+        """ Name and (name, type) indexes of the preseed catalog. The first
+            lookups are answered by filtered queries; past QUERY_LIMIT of
+            them, or if the server can't filter, they are filled from one
+            streamed listing as lookups need them. The first preseed listed
+            wins, as with the former linear scan """
+        if self.index is not None and self.ttl is not None and self.index.age() > self.ttl:
+            self.refresh()
+
+        if self.index is None:
+            url = '/api/v1/preseed?show_all=true'
+            self.index = LazyIndex(lambda: as_records(Preseed,
+                                                      self.urlhandler.stream_list(url, cached=True)),
+                                   {'name': lambda preseed: preseed['name'],
+                                    'name_type': lambda preseed: (preseed['name'],
+                                                                  preseed['type'])})
+        return self.index
+
+    def preload(self):
+        """ Reads the whole catalog listing now, rather than querying MrP
+            preseed by preseed, for callers about to look up many preseeds """
+        self.__catalog().load()
+
+    def refresh(self):
+        """ Drops the catalog indexes, the next lookup fetches them again """
+        if self.index is not None:
+            self.index.close()
+        self.index = None
 
     def get_preseed(self, name, preseed_type):
-        url = '/api/v1/preseed?show_all=true'
-        preseeds = self.urlhandler.get(url)
-
-        for preseed in preseeds:
-            if preseed['name'] == name:
-                if preseed_type is None or preseed['type'] == preseed_type:
-                    return preseed
+        if preseed_type is None:
+            index_name, key, fields = 'name', name, [('name', name)]
+        else:
+            index_name, key = 'name_type', (name, preseed_type)
+            fields = [('name', name), ('type', preseed_type)]
 
-        return None
+        return self.__catalog().lookup(index_name, key,
+                                       lambda: Preseed.from_list(
+                                               query_collection(self.urlhandler, 'preseed',
+                                                                fields)))
 
     def get_preseed_id(self, name):
         preseed = self.get_preseed(name, None)
@@ -57,24 +111,40 @@ class PreseedControl(object):
 
     def upload_preseed(self, name, preseed_file, preseed_type, preseed_desc,
                        public, knowngood):
-        """Uploads preseed. Should check first that preseed doesn't exist, else
-        it modifies preseed (separate function ?). Post to upload, Put to
-        modify (+ id). Maybe implement a jinja2 syntax check ? But that should
-        be done on mrp's side"""
+        """ Creates the preseed, or updates the one of the same name if its
+            content or metadata differ from the local file; a preseed that
+            is already as given is not written at all. Returns the preseed's
+            record """
+        return self.sync_preseed(name, preseed_file, preseed_type, preseed_desc, public,
+                                 knowngood)[1]
+
+    def sync_preseed(self, name, preseed_file, preseed_type, preseed_desc, public,
+                     knowngood):
+        """ upload_preseed, also telling what it did:
+            (CREATED, UPDATED or UNCHANGED, the preseed's record) """
         url = '/api/v1/preseed'
-        if preseed_type is None:
-            raise ClientError("No preseed_type specified")
-        if preseed_file == '':
-            raise ClientError("No preseed file given, nothing to upload")
-        if not os.path.isfile(preseed_file):
-            raise ClientError("Preseed file's path is invalid")
-
-        preseed = self.__get_preseed_from_file(name, preseed_file, preseed_type, preseed_desc,
-                                               public, knowngood)
-        preseed_id = self.get_preseed_id(name)
-
-        if preseed_id is None:
-            return self.urlhandler.post(url, data=json.dumps(preseed))
+        preseed = read_preseed_file(name, preseed_file, preseed_type, preseed_desc,
+                                    public, knowngood)
+        existing = self.get_preseed(name, None)
+
+        if existing is not None and existing.get('id') and \
+           not preseed_changes(existing, preseed):
+            return UNCHANGED, existing
+
+        if existing is None or not existing.get('id'):
+            result, existing = CREATED, None
+            record = self.urlhandler.post(url, data=json.dumps(preseed))
+        else:
+            url = url + '/' + str(existing['id'])
+            result = UPDATED
+            record = self.urlhandler.put(url, data=json.dumps(preseed))
+
+        # Keeps the indexes (and the rest of a preloaded catalog) current
+        if isinstance(record, dict) and 'name' in record and 'type' in record:
+            record = Preseed.from_json(record)
+            if self.index is not None:
+                self.index.set(record, existing)
         else:
-            url = url + '/' + str(preseed_id)
-            return self.urlhandler.put(url, data=json.dumps(preseed))
+            self.refresh()
+
+        return result, record
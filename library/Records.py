@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import sys
+import zlib
+
+from collections.abc import MutableMapping
+
+# Preseed content shorter than this is kept as is, zlib would not save much
+COMPRESS_MIN = 256
+
+# zlib level of preseed content: the fastest, it compresses text nearly as
+# well as the default at half the cost, and every listing pays it
+COMPRESS_LEVEL = 1
+
+# Field orders MrP sent, each kept once and shared by the records that came
+# with it
+FIELD_ORDERS = {}
+
+def content_digest(content):
+    return hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+
+class Record(MutableMapping):
+    """ A record MrP returned, in __slots__ rather than a dict: each field
+        of FIELDS gets a slot, any other field MrP sends goes to a dict made
+        only when there is one. Short strings of INTERNED fields (types,
+        architectures, users) are interned, so a catalog holds each once.
+
+        Records read like the dicts they replace: record['id'], 'id' in
+        record, record.get(), items(), dict(record), == with a dict, fields
+        coming in the order MrP sent them. They are not dicts though: use
+        to_dict() for json.dumps or isinstance checks. A field MrP left out
+        is missing here too, while one it sent as null is None. Fields are
+        also attributes (record.id) """
+
+    __slots__ = ('_extra', '_order')
+    FIELDS = ()
+    INTERNED = ()
+
+    def __init__(self, fields=None):
+        self._extra = None
+        fields = fields or {}
+        order = tuple(fields)
+        self._order = FIELD_ORDERS.setdefault(order, order)
+        # __setitem__ inlined: this runs for every row of every listing
+        known, interned = self.FIELDS, self.INTERNED
+        for key, value in fields.items():
+            if key not in known:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+            elif key in interned and isinstance(value, str):
+                setattr(self, key, sys.intern(value))
+            else:
+                setattr(self, key, value)
+
+    @classmethod
+    def from_json(cls, data):
+        """ data as a record of this class; None and records pass through """
+        if data is None or isinstance(data, cls):
+            return data
+        return cls(data)
+
+    @classmethod
+    def from_list(cls, rows):
+        """ A list of rows as records, None (a query MrP can't answer) as is """
+        if rows is None:
+            return None
+        return [cls.from_json(row) for row in rows]
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            if key in self.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def _has(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        # Fields set after the record was made follow those MrP sent
+        order = self._order
+        for key in order:
+            if self._has(key):
+                yield key
+        for key in self.FIELDS:
+            if key not in order and self._has(key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                if key not in order:
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+    def to_dict(self, without=()):
+        """ A plain dict of the fields but those in without, for json.dumps
+            and the like """
+        return {key: self[key] for key in self if key not in without}
+
+
+class Image(Record):
+    __slots__ = ('id', 'description', 'type', 'arch', 'filename', 'name', 'user',
+                 'known_good', 'public', 'upload_date')
+    FIELDS = __slots__
+    INTERNED = ('type', 'arch', 'user')
+
+
+class Preseed(Record):
+    """ The content is held zlib compressed and only decompressed when read,
+        as record['content'] or record.content; content_digest() is worked
+        out once, when first asked """
+
+    __slots__ = ('id', 'name', 'type', 'description', 'user', 'known_good', 'public',
+                 '_content', '_digest')
+    FIELDS = ('id', 'name', 'type', 'description', 'user', 'known_good', 'public', 'content')
+    INTERNED = ('type', 'user')
+
+    @property
+    def content(self):
+        content = self._content
+        if isinstance(content, bytes):
+            return zlib.decompress(content).decode('utf-8')
+        return content
+
+    @content.setter
+    def content(self, value):
+        if isinstance(value, str) and len(value) >= COMPRESS_MIN:
+            value = zlib.compress(value.encode('utf-8'), COMPRESS_LEVEL)
+        self._content = value
+        self._digest = None
+
+    @content.deleter
+    def content(self):
+        del self._content
+        self._digest = None
+
+    def _has(self, key):
+        # hasattr(self, 'content') would decompress it just to tell it is set
+        if key == 'content':
+            return hasattr(self, '_content')
+        return super(Preseed, self)._has(key)
+
+    def content_digest(self):
+        if getattr(self, '_digest', None) is None:
+            self._digest = content_digest(self.get('content'))
+        return self._digest
+
+
+class Machine(Record):
+    __slots__ = ('id', 'name', 'hostname', 'arch', 'subarch', 'kernel_id', 'initrd_id',
+                 'preseed_id', 'kernel_opts', 'netboot_enabled', 'state', 'bmc_id',
+                 'serial', 'serial_port')
+    FIELDS = __slots__
+    INTERNED = ('arch', 'subarch', 'state')
+
+
+class Interface(Record):
+    __slots__ = ('id', 'identifier', 'mac', 'machine_id', 'network_name', 'dhcpv4',
+                 'reserved_ipv4', 'lease_ipv4', 'netmaskv4', 'config_type_v4')
+    FIELDS = __slots__
+    INTERNED = ('identifier', 'network_name', 'netmaskv4', 'config_type_v4')
+
+
+def as_records(cls, rows):
+    """ Yields the rows of a listing as records of cls; closing it closes
+        the listing """
+    try:
+        for row in rows:
+            yield cls.from_json(row)
+    finally:
+        close = getattr(rows, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# One finished HTTP request. endpoint is the path with ids and query left out
+# ('/api/v1/machine/{id}/state'); status is None when no response came back;
+# retries counts the transport's retries of this request
+RequestEvent = namedtuple('RequestEvent', ['method', 'endpoint', 'path', 'status', 'latency',
+                                           'request_bytes', 'response_bytes', 'retries',
+                                           'error'])
+
+log = logging.getLogger(__name__)
+
+class EndpointStats(object):
+    """ Counters and latency histogram of one method and endpoint """
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.statuses = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * len(buckets)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.retries = 0
+
+    def add(self, event, bounds):
+        status = 'error' if event.status is None else str(event.status)
+        self.count += 1
+        self.errors += event.status is None or event.status >= 400
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency_sum += event.latency
+        self.latency_max = max(self.latency_max, event.latency)
+        for index, bound in enumerate(bounds):
+            if event.latency <= bound:
+                self.buckets[index] += 1
+                break
+        self.request_bytes += event.request_bytes
+        self.response_bytes += event.response_bytes
+        self.retries += event.retries
+
+
+class RequestMetrics(object):
+    """ Collects a RequestEvent for every request a URLhandler makes into
+        per-endpoint counters and latency histograms, and hands each event to
+        the registered hooks. Shared by the threads of one URLhandler.
+
+        Hooks are called with the event after it is counted, on the thread
+        that made the request; a failing hook is logged and otherwise
+        ignored, it never fails the request.
+
+        Gauges are values read when the metrics are exported, such as the
+        state of the URLhandler's admission controller """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.gauges = []
+        self.endpoints = {}
+        self.started = time.time()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def add_gauge(self, name, kind, help_text, read):
+        """ kind is the Prometheus type, 'gauge' or 'counter'; read() returns
+            the current value """
+        self.gauges.append((name, kind, help_text, read))
+
+    def gauge_values(self):
+        return {name: read() for name, _, _, read in self.gauges}
+
+    def record(self, event):
+        with self.lock:
+            key = (event.method, event.endpoint)
+            if key not in self.endpoints:
+                self.endpoints[key] = EndpointStats(self.bounds)
+            self.endpoints[key].add(event, self.bounds)
+
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as err:
+                log.warning("Request metrics hook %r failed: %s", hook, err)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.started = time.time()
+
+    def __quantile(self, stats, quantile):
+        """ Upper bound of the bucket holding the quantile, or the slowest
+            request if it is past the last bucket """
+        rank = quantile * stats.count
+        seen = 0
+        for bound, count in zip(self.bounds, stats.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return stats.latency_max
+
+    def summary(self):
+        """ One dict per method and endpoint, most total time first """
+        with self.lock:
+            rows = [{'method': method, 'endpoint': endpoint, 'count': stats.count,
+                     'errors': stats.errors, 'statuses': dict(stats.statuses),
+                     'latency_total': stats.latency_sum,
+                     'latency_avg': stats.latency_sum / stats.count,
+                     'latency_p50': self.__quantile(stats, 0.5),
+                     'latency_p95': self.__quantile(stats, 0.95),
+                     'latency_max': stats.latency_max,
+                     'request_bytes': stats.request_bytes,
+                     'response_bytes': stats.response_bytes,
+                     'retries': stats.retries}
+                    for (method, endpoint), stats in self.endpoints.items()]
+        return sorted(rows, key=lambda row: row['latency_total'], reverse=True)
+
+    def format_summary(self):
+        """ Human readable table of summary(); p50/p95 are bucket bounds """
+        rows = self.summary()
+        lines = ["{:<7} {:<36} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>10} {:>10} {:>7}".format(
+                 'method', 'endpoint', 'count', 'errors', 'total s', 'avg ms', 'p95 ms',
+                 'max ms', 'sent', 'received', 'retries')]
+        for row in rows:
+            lines.append("{:<7} {:<36} {:>6} {:>6} {:>9.3f} {:>8.1f} {:>8.1f} {:>8.1f} "
+                         "{:>10} {:>10} {:>7}".format(
+                         row['method'], row['endpoint'], row['count'], row['errors'],
+                         row['latency_total'], row['latency_avg'] * 1000,
+                         row['latency_p95'] * 1000, row['latency_max'] * 1000,
+                         row['request_bytes'], row['response_bytes'], row['retries']))
+        lines.append("{} requests, {} errors, {:.3f}s in requests".format(
+                     sum(row['count'] for row in rows), sum(row['errors'] for row in rows),
+                     sum(row['latency_total'] for row in rows)))
+        if self.gauges:
+            lines.append(', '.join('{} {}'.format(name, value)
+                                   for name, value in self.gauge_values().items()))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps({'started': self.started, 'buckets': list(self.bounds),
+                           'endpoints': self.summary(), 'gauges': self.gauge_values()},
+                          indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='mrp_client'):
+        """ Prometheus text exposition format """
+        def labels(method, endpoint, **extra):
+            pairs = [('method', method), ('endpoint', endpoint)] + sorted(extra.items())
+            return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                             .replace('"', '\\"'))
+                                  for name, value in pairs) + '}'
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = ['# HELP {0}_requests_total Requests made to MrP'.format(prefix),
+                     '# TYPE {0}_requests_total counter'.format(prefix)]
+            for (method, endpoint), stats in endpoints:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append('{0}_requests_total{1} {2}'.format(
+                                 prefix, labels(method, endpoint, status=status), count))
+
+            lines += ['# HELP {0}_request_duration_seconds Latency of requests to MrP'.format(prefix),
+                      '# TYPE {0}_request_duration_seconds histogram'.format(prefix)]
+            for (method, endpoint), stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(self.bounds, stats.buckets):
+                    cumulative += count
+                    lines.append('{0}_request_duration_seconds_bucket{1} {2}'.format(
+                                 prefix, labels(method, endpoint, le=bound), cumulative))
+                lines.append('{0}_request_duration_seconds_bucket{1} {2}'.format(
+                             prefix, labels(method, endpoint, le='+Inf'), stats.count))
+                lines.append('{0}_request_duration_seconds_sum{1} {2}'.format(
+                             prefix, labels(method, endpoint), stats.latency_sum))
+                lines.append('{0}_request_duration_seconds_count{1} {2}'.format(
+                             prefix, labels(method, endpoint), stats.count))
+
+            for name, attribute, help_text in (
+                    ('request_bytes_total', 'request_bytes', 'Request body bytes sent to MrP'),
+                    ('response_bytes_total', 'response_bytes', 'Response body bytes received from MrP'),
+                    ('retries_total', 'retries', 'Transport retries of requests to MrP')):
+                lines += ['# HELP {0}_{1} {2}'.format(prefix, name, help_text),
+                          '# TYPE {0}_{1} counter'.format(prefix, name)]
+                for (method, endpoint), stats in endpoints:
+                    lines.append('{0}_{1}{2} {3}'.format(prefix, name, labels(method, endpoint),
+                                                         getattr(stats, attribute)))
+
+        for name, kind, help_text, read in self.gauges:
+            lines += ['# HELP {0}_{1} {2}'.format(prefix, name, help_text),
+                      '# TYPE {0}_{1} {2}'.format(prefix, name, kind),
+                      '{0}_{1} {2}'.format(prefix, name, read())]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, output_format='prometheus'):
+        """ Replaces path atomically, so a Prometheus textfile collector or
+            another reader never sees half a file """
+        text = self.to_json() if output_format == 'json' else self.to_prometheus()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'w') as out:
+                out.write(text)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
@@ -6,17 +6,32 @@ import json
 from library.common import *
 from library.ImageControl import ImageControl
 from library.PreseedControl import PreseedControl
+from library.Records import Machine
 
 class StateControl(object):
-    def __init__(self, urlhandler, machine_name):
+    def __init__(self, urlhandler, machine_name, image_controller=None,
+                 preseed_controller=None, machine_id=None):
+        """ Controllers passed in are shared with the caller, so their
+            catalog indexes serve every machine handled in this process.
+            A machine_id already resolved by the caller skips the lookup, and
+            with no machine at all only resolve_parameters is usable """
         self.urlhandler = urlhandler
-        self.machine_id = get_machine_id(self.urlhandler, machine_name)
+        self.machine_id = machine_id
+        if self.machine_id is None and machine_name is not None:
+            self.machine_id = get_machine_id(self.urlhandler, machine_name)
+        self.image_controller = image_controller or ImageControl(urlhandler)
+        self.preseed_controller = preseed_controller or PreseedControl(urlhandler)
 
     def provision(self, arch, subarch, initrd_desc, kernel_desc,
                   kernel_opts="", preseed_name=None):
         """ enables netboot on the machine and pxe boots it """
-        self.set_provisioning_state(arch, subarch, initrd_desc, kernel_desc,
-                                    kernel_opts, preseed_name, True)
+        parameters = self.resolve_parameters(arch, subarch, initrd_desc, kernel_desc,
+                                             kernel_opts, preseed_name, True)
+        return self.provision_with(parameters)
+
+    def provision_with(self, parameters):
+        """ provision with parameters from resolve_parameters """
+        self.apply_parameters(parameters)
 
         url = "/api/v1/machine/{}/state".format(self.machine_id)
         data = json.dumps({'state': 'provision'})
@@ -26,16 +41,24 @@ class StateControl(object):
     def get_provisioning_state(self):
         """ Get parameters on machine specified by machine_id """
         url = "/api/v1/machine/{}".format(self.machine_id)
-        return self.urlhandler.get(url)
+        return Machine.from_json(self.urlhandler.get(url))
 
     def set_provisioning_state(self, arch, subarch, initrd_desc, kernel_desc,
                           kernel_opts="", preseed_name=None, netboot=None):
         """ Set parameters on machine specified by machine_id """
+        parameters = self.resolve_parameters(arch, subarch, initrd_desc, kernel_desc,
+                                             kernel_opts, preseed_name, netboot)
+        return self.apply_parameters(parameters)
+
+    def resolve_parameters(self, arch, subarch, initrd_desc, kernel_desc,
+                           kernel_opts="", preseed_name=None, netboot=None):
+        """ Turns image descriptions and preseed name into the machine
+            parameters MrP expects. Nothing here depends on the machine, so
+            the result can be applied to many of them """
         if arch == '' or subarch == '' or initrd_desc == '' or kernel_desc == '':
             raise ClientError("Missing arguments for setting machine's state")
 
-        image_controller = ImageControl(self.urlhandler)
-        url = "/api/v1/machine/{}".format(self.machine_id)
+        image_controller = self.image_controller
 
         if initrd_desc and kernel_desc:
             initrd_id = image_controller.get_image_id(
@@ -49,8 +72,7 @@ class StateControl(object):
         parameters = dict()
 
         if preseed_name is not None:
-            preseed_controller = PreseedControl(self.urlhandler)
-            preseed_id = preseed_controller.get_preseed_id(preseed_name)
+            preseed_id = self.preseed_controller.get_preseed_id(preseed_name)
             if preseed_name and preseed_id is None:
                 raise ProvisionerError("Preseed '{0}' unknown".format(preseed_name))
             parameters['preseed_id'] = preseed_id
@@ -65,6 +87,10 @@ class StateControl(object):
         if netboot is not None:
             parameters['netboot_enabled'] = netboot
 
+        return parameters
+
+    def apply_parameters(self, parameters):
+        url = "/api/v1/machine/{}".format(self.machine_id)
         data = json.dumps(parameters)
 
         return self.urlhandler.put(url, data)
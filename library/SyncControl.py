@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from library.common import *
+from library.BandwidthLimiter import BandwidthLimiter
+from library.ImageControl import ImageControl, IMAGE_TYPES
+from library.PreseedControl import PreseedControl
+
+PRESEED_TYPES = ['kickstart', 'preseed', 'autoyast']
+
+def read_sync_manifest(path, public=False, knowngood=False):
+    """ Images and preseeds listed in a JSON manifest:
+        {"images": [{"path", "type", "description", "arch", "public"?, "known_good"?}],
+         "preseeds": [{"path", "name", "type", "description"?, "public"?, "known_good"?}]}
+        Paths are relative to the manifest; public and known_good default
+        to the given values. Returns (images, preseeds) """
+    try:
+        with open(path, 'r') as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError) as err:
+        raise ClientError("Cannot read sync manifest {}: {}".format(path, err))
+
+    base = os.path.dirname(os.path.abspath(path))
+    images = []
+    preseeds = []
+    try:
+        for entry in manifest.get('images', []):
+            images.append({'path': os.path.join(base, entry['path']),
+                           'type': entry['type'], 'description': entry['description'],
+                           'arch': entry['arch'],
+                           'public': entry.get('public', public),
+                           'known_good': entry.get('known_good', knowngood)})
+        for entry in manifest.get('preseeds', []):
+            preseeds.append({'path': os.path.join(base, entry['path']),
+                             'name': entry['name'], 'type': entry['type'],
+                             'description': entry.get('description', ''),
+                             'public': entry.get('public', public),
+                             'known_good': entry.get('known_good', knowngood)})
+    except (KeyError, TypeError, AttributeError) as err:
+        raise ClientError("Invalid sync manifest {}: bad entry ({})".format(path, err))
+
+    return images, preseeds
+
+def scan_sync_directory(root, public=False, knowngood=False):
+    """ Images and preseeds laid out as
+            images/<arch>/<image type>/<file>    description: the file name
+            preseeds/<preseed type>/<file>       name: the file name without
+                                                 its extension
+        Returns (images, preseeds) """
+    types = {image_type.lower(): image_type for image_type in IMAGE_TYPES}
+    images = []
+    preseeds = []
+
+    images_dir = os.path.join(root, 'images')
+    for arch in sorted(os.listdir(images_dir)) if os.path.isdir(images_dir) else []:
+        for type_dir in sorted(os.listdir(os.path.join(images_dir, arch))):
+            if type_dir.lower() not in types:
+                raise ClientError("Unknown image type directory {}, must be one of {}".format(
+                                  os.path.join(images_dir, arch, type_dir), IMAGE_TYPES))
+            directory = os.path.join(images_dir, arch, type_dir)
+            for name in sorted(os.listdir(directory)):
+                if os.path.isfile(os.path.join(directory, name)):
+                    images.append({'path': os.path.join(directory, name),
+                                   'type': types[type_dir.lower()], 'description': name,
+                                   'arch': arch, 'public': public, 'known_good': knowngood})
+
+    preseeds_dir = os.path.join(root, 'preseeds')
+    for preseed_type in sorted(os.listdir(preseeds_dir)) if os.path.isdir(preseeds_dir) else []:
+        if preseed_type not in PRESEED_TYPES:
+            raise ClientError("Unknown preseed type directory {}, must be one of {}".format(
+                              os.path.join(preseeds_dir, preseed_type), PRESEED_TYPES))
+        directory = os.path.join(preseeds_dir, preseed_type)
+        for name in sorted(os.listdir(directory)):
+            if os.path.isfile(os.path.join(directory, name)):
+                preseeds.append({'path': os.path.join(directory, name),
+                                 'name': os.path.splitext(name)[0], 'type': preseed_type,
+                                 'description': '', 'public': public,
+                                 'known_good': knowngood})
+
+    return images, preseeds
+
+
+class SyncControl(object):
+    """ Brings MrP in line with a set of local images and preseeds: both
+        catalogs are read once, then whatever is missing or changed is
+        uploaded from a bounded pool of worker threads, at most bandwidth
+        bytes per second all together if set. A failed entry is reported
+        and does not stop the others.
+
+        sync() returns one result dict per entry, images first, in input
+        order: {'kind', 'entry', 'path', 'ok', 'result', 'error', 'bytes',
+        'elapsed'}, result being CREATED, UPDATED or UNCHANGED. manifest,
+        an ImageManifest, is handed to every image upload rather than set
+        on a controller other commands may share; replace is passed on to
+        ImageControl.sync_image """
+
+    def __init__(self, urlhandler, concurrency=4, bandwidth=None, image_controller=None,
+                 preseed_controller=None, manifest=None, replace=False):
+        self.urlhandler = urlhandler
+        self.concurrency = max(1, concurrency)
+        self.limiter = BandwidthLimiter(bandwidth) if bandwidth else None
+        self.image_controller = image_controller or ImageControl(urlhandler)
+        self.preseed_controller = preseed_controller or PreseedControl(urlhandler)
+        self.manifest = manifest
+        self.replace = replace
+
+    def __image(self, image):
+        result, _ = self.image_controller.sync_image(image['type'], image['description'],
+                                                     image['arch'], image['path'],
+                                                     image['public'], image['known_good'],
+                                                     limiter=self.limiter,
+                                                     manifest=self.manifest,
+                                                     replace=self.replace)
+        return result, os.path.getsize(image['path']) if result != UNCHANGED else 0
+
+    def __preseed(self, preseed):
+        result, _ = self.preseed_controller.sync_preseed(preseed['name'], preseed['path'],
+                                                         preseed['type'],
+                                                         preseed['description'],
+                                                         preseed['public'],
+                                                         preseed['known_good'])
+        return result, os.path.getsize(preseed['path']) if result != UNCHANGED else 0
+
+    def sync(self, images, preseeds):
+        if images:
+            self.image_controller.preload()
+        if preseeds:
+            self.preseed_controller.preload()
+
+        def run_one(job):
+            kind, label, entry, action = job
+            start = time.monotonic()
+            try:
+                result, sent = action(entry)
+                error = None
+            except Exception as err:
+                result, sent, error = None, 0, str(err)
+            return {'kind': kind, 'entry': label, 'path': entry['path'], 'ok': error is None,
+                    'result': result, 'error': error, 'bytes': sent,
+                    'elapsed': time.monotonic() - start}
+
+        jobs = [('image', '{type}/{arch}/{description}'.format(**image), image, self.__image)
+                for image in images] + \
+               [('preseed', preseed['name'], preseed, self.__preseed) for preseed in preseeds]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(run_one, jobs))
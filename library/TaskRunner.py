@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from library.common import *
+from library.ApplyControl import DESIRED_KEYS
+from library.Records import Record
+from library.SyncControl import read_sync_manifest, scan_sync_directory
+
+# action -> (required parameters, optional parameters and their defaults)
+TASK_PARAMETERS = {
+    'image': (('image_type', 'description', 'arch'),
+              {'path': None, 'public': False, 'known_good': False, 'replace': False}),
+    'preseed': (('preseed_name',),
+                {'path': None, 'preseed_type': None, 'description': '', 'public': False,
+                 'known_good': False}),
+    'machine': (('machines',),
+                dict({key: None for key in DESIRED_KEYS}, concurrency=8)),
+    'provision': (('machines', 'arch', 'subarch', 'initrd_desc', 'kernel_desc'),
+                  {'kernel_opts': '', 'preseed_name': None, 'wait': False,
+                   'wait_timeout': 1800, 'interface': None, 'concurrency': 8}),
+    'interface': (('machine', 'interface'), {}),
+    'sync': ((), {'manifest': None, 'directory': None, 'public': False, 'known_good': False,
+                  'concurrency': 4, 'bandwidth': None, 'replace': False}),
+}
+
+def plain(value):
+    """ value with records turned into dicts and tuples into lists, for
+        json.dumps """
+    if isinstance(value, Record):
+        value = value.to_dict()
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
+
+def without_content(preseed):
+    """ A preseed's fields but its content, which results need not carry """
+    if preseed is None:
+        return None
+    if isinstance(preseed, Record):
+        return preseed.to_dict(without=('content',))
+    return {key: value for key, value in preseed.items() if key != 'content'}
+
+def names(machines):
+    return [machines] if isinstance(machines, str) else list(machines)
+
+
+class TaskRunner(object):
+    """ Runs provisioning tasks the way Ansible runs modules, all through
+        one MrPClient, so they share its connections and catalog lookups.
+
+        A task is a dict: {'action': one of TASK_PARAMETERS, 'name': an
+        optional label, and the action's parameters}. Each gives back an
+        Ansible-style result dict: {'name', 'action', 'changed', 'failed',
+        'skipped', 'msg', 'elapsed'} and the action's data. In check_mode
+        machine tasks report the changes they would make, and tasks that
+        would upload or provision are skipped. After a failed task the rest
+        are skipped, unless keep_going """
+
+    def __init__(self, client, check_mode=False, keep_going=False):
+        self.client = client
+        self.check_mode = check_mode
+        self.keep_going = keep_going
+        self.actions = {'image': self.__image, 'preseed': self.__preseed,
+                        'machine': self.__machine, 'provision': self.__provision,
+                        'interface': self.__interface, 'sync': self.__sync}
+
+    def run(self, tasks):
+        results = []
+        failed = False
+        for index, task in enumerate(tasks):
+            if failed and not self.keep_going:
+                results.append(self.__result(task, index, skipped=True,
+                                             msg='skipped after an earlier failure'))
+                continue
+            result = self.run_task(task, index)
+            failed = failed or result['failed']
+            results.append(result)
+        return results
+
+    def run_task(self, task, index=0):
+        start = time.monotonic()
+        try:
+            action = task.get('action')
+            if action not in TASK_PARAMETERS:
+                raise ClientError("Unknown action {!r}, must be one of {}".format(
+                                  action, ', '.join(sorted(TASK_PARAMETERS))))
+            required, optional = TASK_PARAMETERS[action]
+            given = {key: value for key, value in task.items() if key not in ('action', 'name')}
+            missing = [key for key in required if given.get(key) is None]
+            if missing:
+                raise ClientError("Missing parameters: {}".format(', '.join(missing)))
+            unknown = [key for key in given if key not in required and key not in optional]
+            if unknown:
+                raise ClientError("Unsupported parameters: {}".format(', '.join(unknown)))
+            parameters = dict(optional, **given)
+            result = self.actions[action](**parameters)
+        except Exception as err:
+            result = {'failed': True, 'msg': str(err), 'exception': type(err).__name__}
+        result = self.__result(task, index, **plain(result))
+        result['elapsed'] = time.monotonic() - start
+        return result
+
+    def __result(self, task, index, **fields):
+        result = {'name': task.get('name', 'task {}'.format(index)),
+                  'action': task.get('action'), 'changed': False, 'failed': False,
+                  'skipped': False, 'msg': ''}
+        result.update(fields)
+        return result
+
+    def __skip_in_check_mode(self):
+        return {'skipped': True, 'msg': 'check mode: not run'}
+
+    def __image(self, image_type, description, arch, path, public, known_good, replace):
+        if path is None:
+            image = self.client.get_image(image_type, description, arch)
+            return {'exists': image is not None, 'image': image}
+        if self.check_mode:
+            return self.__skip_in_check_mode()
+        outcome, image = self.client.upload_image(image_type, description, arch, path,
+                                                  public, known_good, replace=replace)
+        return {'changed': outcome != UNCHANGED, 'result': outcome, 'image': image}
+
+    def __preseed(self, preseed_name, path, preseed_type, description, public, known_good):
+        if path is None:
+            preseed = self.client.get_preseed(preseed_name, preseed_type)
+            return {'exists': preseed is not None, 'preseed': without_content(preseed)}
+        if self.check_mode:
+            return self.__skip_in_check_mode()
+        outcome, preseed = self.client.upload_preseed(preseed_name, path, preseed_type,
+                                                      description, public, known_good)
+        return {'changed': outcome != UNCHANGED, 'result': outcome,
+                'preseed': without_content(preseed)}
+
+    def __machine(self, machines, concurrency, **desired):
+        state = {key: value for key, value in desired.items() if value is not None}
+        entries = self.client.apply({name: dict(state) for name in names(machines)},
+                                    self.check_mode, concurrency)
+        failed = [entry for entry in entries if entry['error'] is not None]
+        return {'changed': any(entry['changes'] and entry['error'] is None
+                               for entry in entries),
+                'failed': bool(failed),
+                'msg': '; '.join('{}: {}'.format(entry['machine'], entry['error'])
+                                 for entry in failed),
+                'machines': entries}
+
+    def __provision(self, machines, arch, subarch, initrd_desc, kernel_desc, kernel_opts,
+                    preseed_name, wait, wait_timeout, interface, concurrency):
+        if self.check_mode:
+            return self.__skip_in_check_mode()
+        results = self.client.provision(names(machines), arch, subarch, initrd_desc,
+                                        kernel_desc, kernel_opts, preseed_name, concurrency,
+                                        wait, wait_timeout, interface)
+        failed = [result for result in results if not result['ok']]
+        return {'changed': len(failed) < len(results), 'failed': bool(failed),
+                'msg': '; '.join('{}: {}'.format(result['machine'], result['error'])
+                                 for result in failed),
+                'machines': results}
+
+    def __interface(self, machine, interface):
+        found = self.client.get_interface(machine, interface)
+        return {'ip': found.get('lease_ipv4', ''), 'mac': found.get('mac', ''),
+                'netmask': found.get('netmaskv4', ''), 'interface': found}
+
+    def __sync(self, manifest, directory, public, known_good, concurrency, bandwidth,
+               replace):
+        if (manifest is None) == (directory is None):
+            raise ClientError("Give either a manifest or a directory to sync")
+        if self.check_mode:
+            return self.__skip_in_check_mode()
+        if manifest is not None:
+            images, preseeds = read_sync_manifest(manifest, public, known_good)
+        else:
+            images, preseeds = scan_sync_directory(directory, public, known_good)
+        results = self.client.sync(images, preseeds, concurrency, bandwidth, replace)
+        failed = [result for result in results if not result['ok']]
+        return {'changed': any(result['ok'] and result['result'] != UNCHANGED
+                               for result in results),
+                'failed': bool(failed),
+                'msg': '; '.join('{}: {}'.format(result['entry'], result['error'])
+                                 for result in failed),
+                'entries': results}
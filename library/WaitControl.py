@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from library.common import *
+
+# Machine states meaning MrP is still provisioning
+PROVISIONING_STATES = ('provision', 'provisioning')
+
+class ProvisionWaiter(object):
+    """ Follows any number of machines from a single thread until their
+        provisioning is over and an IPv4 lease shows on their interface.
+
+        Machines are polled from a schedule ordered by due time, the first
+        poll interval seconds after wait() starts; each machine's interval
+        grows by backoff after every unfinished poll, up to max_interval, so
+        a long install costs a handful of requests. Results are yielded as
+        soon as each machine is done or times out:
+        {'machine', 'ok', 'state', 'ip', 'error', 'elapsed'}
+
+        Call snapshot() before provisioning: on a MrP without a machine
+        state endpoint, only a lease that differs from the one seen then,
+        or that went away and came back, tells the new install is up """
+
+    def __init__(self, urlhandler, interface_name=None, interval=2.0, max_interval=30.0,
+                 backoff=1.5, timeout=1800):
+        self.urlhandler = urlhandler
+        self.interface_name = interface_name
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.state_supported = True
+        # machine id -> lease before provisioning (None: none); machines
+        # missing here must lose their lease and get one again
+        self.leases_before = {}
+        self.lease_lost = set()
+
+    def snapshot(self, machine_ids, concurrency=8):
+        """ Notes the leases machines have before they are provisioned;
+            machine_ids maps names to ids. A machine whose interfaces can't
+            be read is left out """
+        def lease(machine_id):
+            try:
+                return machine_id, self.__lease(machine_id)
+            except (URLhandlerError, requests.exceptions.RequestException):
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for seen in pool.map(lease, machine_ids.values()):
+                if seen is not None:
+                    self.leases_before[seen[0]] = seen[1]
+
+    def __state(self, machine_id):
+        """ Current machine state, or None if this MrP has no state endpoint """
+        if not self.state_supported:
+            return None
+        try:
+            return self.urlhandler.get("/api/v1/machine/{}/state".format(machine_id)).get('state')
+        except URLhandlerHTTPError as err:
+            if err.status_code not in (404, 405):
+                raise
+            self.state_supported = False
+            return None
+
+    def __lease(self, machine_id):
+        url = "/api/v1/machine/{}/interface".format(machine_id)
+        for interface in self.urlhandler.get(url):
+            if self.interface_name and str(interface.get('identifier')) != self.interface_name:
+                continue
+            if interface.get('lease_ipv4'):
+                return interface['lease_ipv4']
+        return None
+
+    def poll(self, machine_id):
+        """ Returns (done, state, ip) for one machine """
+        state = self.__state(machine_id)
+        if state in PROVISIONING_STATES:
+            return False, state, None
+
+        ip = self.__lease(machine_id)
+        if ip is None:
+            self.lease_lost.add(machine_id)
+            return False, state, None
+        if not self.state_supported and machine_id not in self.lease_lost and \
+           (machine_id not in self.leases_before or ip == self.leases_before[machine_id]):
+            # Maybe still the lease of the install before
+            return False, state, None
+        return True, state, ip
+
+    def wait(self, machine_ids):
+        """ machine_ids maps machine names to ids, as get_machine_ids returns """
+        start = time.monotonic()
+        # Right after the provision request MrP may not have moved yet
+        schedule = [(start + self.interval, name, self.interval) for name in machine_ids]
+        heapq.heapify(schedule)
+        last = {}
+
+        while schedule:
+            due, name, interval = heapq.heappop(schedule)
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+
+            error = None
+            try:
+                done, state, ip = self.poll(machine_ids[name])
+            except (URLhandlerError, requests.exceptions.RequestException) as err:
+                # The machine or the server may be busy; only the timeout
+                # gives up on a machine
+                done, state, ip = False, last.get(name), None
+                error = str(err)
+            last[name] = state
+
+            elapsed = time.monotonic() - start
+            if done:
+                yield {'machine': name, 'ok': True, 'state': state, 'ip': ip,
+                       'error': None, 'elapsed': elapsed}
+            elif elapsed >= self.timeout:
+                yield {'machine': name, 'ok': False, 'state': state, 'ip': None,
+                       'error': error or "Timed out after {:.0f}s".format(self.timeout),
+                       'elapsed': elapsed}
+            else:
+                due = min(time.monotonic() + interval, start + self.timeout)
+                heapq.heappush(schedule, (due, name,
+                                          min(interval * self.backoff, self.max_interval)))
@@ -1,31 +1,229 @@
 #!/usr/bin/env python3
 
 import requests
+import codecs
 import json
+import hashlib
+import logging
+import mmap
+import os
+import re
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 from urllib.parse import quote
 
+from library.AdmissionControl import AdmissionController
+from library.RequestMetrics import RequestMetrics, RequestEvent
+
+log = logging.getLogger(__name__)
+
+# Transient gateway errors worth retrying on idempotent requests
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# Bytes read from the socket at a time by streamed list responses
+STREAM_CHUNK_SIZE = 256 * 1024
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# What an upload did with an image or preseed
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+# Names resolved per machine query, keeps the q= expression to a sane URL length
+MACHINE_QUERY_BATCH = 50
+
 # TODO: This needs a more standard name (static method)
 # Or we need to make sure the IPGetter object is easy to use
 def get_machine_id(urlhandler, machine_name):
     """ Look up machine by name """
-    q = '(= name "{}")'.format(quote(machine_name))
-    path = "/api/v1/machine?q={}&show_all=false".format(q)
-    result = urlhandler.get(path)
-    if len(result) == 1 and 'id' in result[0]:
-        return result[0]['id']
-    else:
-        raise ProvisionerError("Machine {0} unknown to MrP".format(machine_name))
-
-class ProvisionerError(Exception):
+    return get_machine_ids(urlhandler, [machine_name])[machine_name]
+
+def get_machine_ids(urlhandler, machine_names, strict=True):
+    """ Look up many machines by name, returns a name -> id dict.
+        Names are resolved with one (or ...) query per MACHINE_QUERY_BATCH
+        names, or a single full listing if the server rejects the query, and
+        remembered on the urlhandler for later lookups. Every unknown name is
+        reported in the same error, or left out of the result if not strict """
+    known = urlhandler.machine_ids
+    missing = [name for name in dict.fromkeys(machine_names) if name not in known]
+
+    try:
+        for path in machine_query_paths(missing):
+            remember_machine_ids(known, urlhandler.get(path, cached=True))
+    except URLhandlerHTTPError as err:
+        if err.status_code != 400:
+            raise
+        remember_machine_ids(known, urlhandler.get(MACHINE_LIST_PATH, cached=True))
+
+    return machine_ids_result(known, machine_names, missing, strict)
+
+MACHINE_LIST_PATH = "/api/v1/machine?show_all=false"
+
+def query_path(collection, fields, show_all=True):
+    """ Listing of /api/v1/<collection> filtered by MrP on every (field,
+        value) pair of fields """
+    terms = ['(= {} "{}")'.format(field, quote(str(value))) for field, value in fields]
+    q = terms[0] if len(terms) == 1 else '(and {})'.format(' '.join(terms))
+    return "/api/v1/{}?q={}&show_all={}".format(collection, q, str(show_all).lower())
+
+def query_collection(urlhandler, collection, fields, cached=True):
+    """ Rows of /api/v1/<collection> matching every (field, value) pair of
+        fields, filtered on the server. Returns None if the server can't
+        filter on these fields (it rejects the query, or ignores it and
+        lists everything); that is remembered on the urlhandler and later
+        calls return None right away, callers then search a full listing """
+    support = (collection, tuple(field for field, _ in fields))
+    if urlhandler.query_support.get(support) is False:
+        return None
+
+    try:
+        rows = urlhandler.get(query_path(collection, fields), cached=cached)
+    except URLhandlerHTTPError as err:
+        if err.status_code != 400:
+            raise
+        urlhandler.query_support[support] = False
+        return None
+
+    matching = [row for row in rows
+                if all(str(row.get(field)) == str(value) for field, value in fields)]
+    # Rows that don't match mean the query was ignored; what came back is
+    # still the whole answer this time
+    urlhandler.query_support[support] = len(matching) == len(rows)
+    return matching
+
+# Cheapest authenticated request we know of: a machine query matching nothing
+VALIDATION_PATH = '/api/v1/machine?q=(= name "")&show_all=false'
+
+def machine_query_paths(machine_names):
+    """ Machine listing paths matching machine_names, MACHINE_QUERY_BATCH
+        names at a time """
+    for start in range(0, len(machine_names), MACHINE_QUERY_BATCH):
+        batch = machine_names[start:start + MACHINE_QUERY_BATCH]
+        terms = ['(= name "{}")'.format(quote(name)) for name in batch]
+        q = terms[0] if len(terms) == 1 else '(or {})'.format(' '.join(terms))
+        yield "/api/v1/machine?q={}&show_all=false".format(q)
+
+def remember_machine_ids(known, machines):
+    for machine in machines:
+        if 'name' in machine and 'id' in machine:
+            known[machine['name']] = machine['id']
+
+def machine_ids_result(known, machine_names, missing, strict):
+    unknown = [name for name in missing if name not in known]
+    if not strict:
+        return {name: known[name] for name in machine_names if name in known}
+    elif len(unknown) == 1:
+        raise ProvisionerError("Machine {0} unknown to MrP".format(unknown[0]))
+    elif unknown:
+        raise ProvisionerError("Machines {0} unknown to MrP".format(', '.join(unknown)))
+
+    return {name: known[name] for name in machine_names}
+
+def user_cache_dir():
+    """ Per-user directory for the client's local state (XDG layout) """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mr-provisioner-client')
+
+def file_digest(path, algorithm='sha256'):
+    """ Hex digest of a file's content. The file is mapped rather than read
+        so hashing a multi-GB image neither copies it nor grows the heap """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size > 0:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+def collection_path(path):
+    """ '/api/v1/image/12?x=y' -> '/api/v1/image', the listing a write to
+        path can change """
+    return '/'.join(path.split('?')[0].split('/')[:4])
+
+def endpoint_template(path):
+    """ '/api/v1/machine/12/state?x=y' -> '/api/v1/machine/{id}/state', the
+        name requests to path are counted under """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path.split('?')[0])
+
+def iter_json_list(chunks):
+    """ Yields the items of a JSON array as its text arrives in chunks of
+        UTF-8 bytes, holding only the text of the items not parsed yet.
+        Raises ValueError if the text is not a JSON array """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    position = 0
+    done = False
+    # '[', then 'first' (item or ']'), 'item' after a comma, 'next' (',' or ']')
+    expect = '['
+
+    while True:
+        position = JSON_WHITESPACE.match(buf, position).end()
+        if position < len(buf):
+            char = buf[position]
+            if expect == '[':
+                if char != '[':
+                    raise ValueError("Expected a JSON array")
+                position, expect = position + 1, 'first'
+                continue
+            if char == ']' and expect in ('first', 'next'):
+                return
+            if expect == 'next':
+                if char != ',':
+                    raise ValueError("Expected ',' or ']' in JSON array")
+                position, expect = position + 1, 'item'
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, position)
+            except ValueError:
+                if done:
+                    raise
+            else:
+                # Only trust an item once a ',' or ']' follows it: a number
+                # cut by a chunk boundary (after '.', 'e'...) would parse as
+                # a shorter one
+                after = JSON_WHITESPACE.match(buf, end).end()
+                if done or (after < len(buf) and buf[after] in ',]'):
+                    position, expect = end, 'next'
+                    yield item
+                    continue
+
+        if done:
+            raise ValueError("Truncated JSON array")
+        buf, position = buf[position:], 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            buf += utf8.decode(b'', final=True)
+            done = True
+        else:
+            buf += utf8.decode(chunk)
+
+def body_length(body):
+    """ Bytes in a prepared request body: str, bytes or a sized stream """
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+class MrPError(Exception):
+    """ Base of every error the library raises """
+
+class ProvisionerError(MrPError):
     def __init__(self, message):
         super(ProvisionerError, self).__init__(message)
 
-class ClientError(Exception):
+class ClientError(MrPError):
     def __init__(self, message):
         super(ClientError, self).__init__(message)
 
-class URLhandlerError(Exception):
+class URLhandlerError(MrPError):
     def __init__(self, message, method, url):
         super(URLhandlerError, self).__init__(message)
         self.method = method
@@ -39,6 +237,13 @@ class URLhandlerHTTPError(URLhandlerError):
         self.status_code = status_code
         self.response = response
 
+class URLhandlerConnectionError(URLhandlerError):
+    def __init__(self, method, url, error):
+        super(URLhandlerConnectionError, self).__init__("CONNECTION ERROR on %s request at %s: %s" %
+                                                       (str(method), str(url), str(error)),
+                                                       method, url)
+        self.error = error
+
 class URLhandlerJSONError(URLhandlerError):
     def __init__(self, method, url, response):
         super(URLhandlerJSONError, self).__init__("JSON ERROR on %s request at %s" %
@@ -47,81 +252,197 @@ class URLhandlerJSONError(URLhandlerError):
 
 
 class URLhandler(object):
-    def __init__(self, mrp_url, mrp_token):
-        try:
-            self.base_url = mrp_url
-            self.headers = {'Authorization': mrp_token}
-            self.get("/api/v1/machine?show_all=false")
-        except Exception as err:
-            raise ClientError("Invalid URL or token for MrP") from err
+    def __init__(self, mrp_url, mrp_token, pool_size=10, retries=3, backoff_factor=0.5,
+                 cache=None, validate=False, metrics=None, admission=None, timeout=None):
+        """ The URL and token are checked by the requests themselves: MrP
+            refusing them (401 or 403) raises ClientError, while a request
+            that gets no answer raises URLhandlerConnectionError whether or
+            not an earlier one went through. validate=True checks them right
+            away with a request that matches no machine, any failure of which
+            raises ClientError.
 
-    def get(self, path):
-        url = urljoin(self.base_url, path)
+            Every request is recorded in metrics (a RequestMetrics, one is
+            created if none is given), and waits for admission (an
+            AdmissionController, by default an adaptive one allowing up to
+            pool_size requests in flight). timeout bounds, in seconds, the
+            wait for a connection and for each read of an answer; by default
+            there is none """
+        self.base_url = mrp_url
+        self.timeout = timeout
+        self.headers = {'Authorization': mrp_token}
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+        self.admission = admission if admission is not None else AdmissionController(pool_size)
+        for gauge in self.admission.gauges():
+            self.metrics.add_gauge(*gauge)
+        self.machine_ids = {}
+        # (collection, fields) -> whether MrP filters listings on them, see
+        # query_collection
+        self.query_support = {}
+        self.session = self.__new_session(pool_size, retries, backoff_factor)
 
-        req = requests.get(url, headers=self.headers)
+        if validate:
+            try:
+                self.get(VALIDATION_PATH)
+            except Exception as err:
+                raise ClientError("Invalid URL or token for MrP") from err
 
-        try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError as herr:
-            raise URLhandlerHTTPError("GET", url, req.status_code, req.text) from herr
+    def __new_session(self, pool_size, retries, backoff_factor):
+        """ One keep-alive session per handler, shared by every controller.
+            Only idempotent methods are retried by the transport; POST is
+            never replayed behind the caller's back """
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
-        try:
-            data = req.json()
-        except ValueError as jsonerr:
-            raise URLhandlerJSONError("GET", url, req.text) from jsonerr
+    def close(self):
+        self.session.close()
 
-        return data
+    def __record(self, method, path, start, req=None, error=None, streamed=False):
+        latency = time.perf_counter() - start
+        if req is None:
+            event = RequestEvent(method, endpoint_template(path), path, None, latency,
+                                 0, 0, 0, str(error))
+        else:
+            history = getattr(getattr(req.raw, 'retries', None), 'history', None) or ()
+            # A streamed body is not read yet: count what the server announced
+            received = int(req.headers.get('Content-Length') or 0) if streamed else \
+                       len(req.content)
+            event = RequestEvent(method, endpoint_template(path), path, req.status_code,
+                                 latency, body_length(req.request.body), received,
+                                 len(history), None)
+        log.debug("%s %s -> %s in %.1fms", method, path, event.status or error,
+                  latency * 1000)
+        self.metrics.record(event)
+        return event
 
-    def put(self, path, data):
+    def __send(self, method, path, **kwargs):
         url = urljoin(self.base_url, path)
 
-        req = requests.put(url, headers=self.headers, data=data)
+        # The slot is given back once the answer's headers are in: a streamed
+        # listing left open by a catalog index must not hold it
+        ticket = self.admission.acquire()
+        event = None
+        start = time.perf_counter()
+        try:
+            req = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            event = self.__record(method, path, start, req, streamed=kwargs.get('stream', False))
+        except requests.exceptions.RequestException as err:
+            event = self.__record(method, path, start, error=err)
+            raise URLhandlerConnectionError(method, url, err) from err
+        finally:
+            self.admission.release(ticket, event)
 
         try:
             req.raise_for_status()
         except requests.exceptions.HTTPError as herr:
-            raise URLhandlerHTTPError("PUT", url, req.status_code, req.text) from herr
+            error = URLhandlerHTTPError(method, url, req.status_code, req.text)
+            if req.status_code in (401, 403):
+                raise ClientError("Invalid URL or token for MrP") from error
+            raise error from herr
+
+        if method != "GET" and self.cache is not None:
+            self.cache.invalidate(collection_path(path))
 
+        return req
+
+    def __decode(self, req):
         try:
-            data = req.json()
+            return req.json()
         except ValueError as jsonerr:
-            raise URLhandlerJSONError("PUT", url, req.text) from jsonerr
+            raise URLhandlerJSONError(req.request.method, req.url, req.text) from jsonerr
+
+    def __request(self, method, path, **kwargs):
+        return self.__decode(self.__send(method, path, **kwargs))
+
+    def get(self, path, cached=False):
+        """ GET path. With cached=True and a catalog cache configured, a fresh
+            cached copy is returned without contacting the server, and a stale
+            one is revalidated with the validators the server gave us """
+        if not cached or self.cache is None:
+            return self.__request("GET", path)
+
+        entry = self.cache.lookup(path)
+        if entry is not None and entry.fresh:
+            return entry.data
 
+        req = self.__send("GET", path, headers=self.__validators(entry))
+        if req.status_code == 304 and entry is not None:
+            self.cache.touch(path)
+            return entry.data
+
+        data = self.__decode(req)
+        self.cache.store(path, req.text, req.headers.get('ETag'),
+                         req.headers.get('Last-Modified'))
         return data
 
-    def post(self, path, data, files=None):
-        url = urljoin(self.base_url, path)
+    def __validators(self, entry):
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
 
-        if files is not None:
-            req = requests.post(url, headers=self.headers, files=files, data=data)
-        else:
-            req = requests.post(url, headers=self.headers, data=data)
+    def stream_list(self, path, cached=False):
+        """ GET a JSON list at path and yield its items as they are parsed
+            off the wire, instead of loading the whole response first. A
+            caller may stop early; closing the generator (or dropping it)
+            releases the connection.
 
-        try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError as herr:
-            raise URLhandlerHTTPError("POST", url, req.status_code, req.text) from herr
+            With cached=True the catalog cache is used as get() does; a
+            response only goes into the cache once it was read to the end """
+        entry = None
+        if cached and self.cache is not None:
+            entry = self.cache.lookup(path)
+            if entry is not None and entry.fresh:
+                yield from entry.data
+                return
 
+        req = self.__send("GET", path, headers=self.__validators(entry), stream=True)
         try:
-            data = req.json()
-        except ValueError as jsonerr:
-            raise URLhandlerJSONError("POST", url, req.text) from jsonerr
+            if req.status_code == 304 and entry is not None:
+                self.cache.touch(path)
+                yield from entry.data
+                return
 
-        return data
+            chunks = req.iter_content(STREAM_CHUNK_SIZE)
+            received = None
+            if cached and self.cache is not None:
+                received = []
+                chunks = self.__keep(chunks, received)
 
-    def delete(self, path):
-        url = urljoin(self.base_url, path)
+            try:
+                yield from iter_json_list(chunks)
+            except ValueError as jsonerr:
+                raise URLhandlerJSONError("GET", req.url, '') from jsonerr
 
-        req = requests.delete(url, headers=self.headers)
+            if received is not None:
+                self.cache.store(path, b''.join(received).decode('utf-8'),
+                                 req.headers.get('ETag'), req.headers.get('Last-Modified'))
+        finally:
+            req.close()
 
-        try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError as herr:
-            raise URLhandlerHTTPError("DELETE", url, req.status_code, req.text) from herr
+    def __keep(self, chunks, received):
+        for chunk in chunks:
+            received.append(chunk)
+            yield chunk
 
-        try:
-            data = req.json()
-        except ValueError as jsonerr:
-            raise URLhandlerJSONError("DELETE", url, req.text) from jsonerr
+    def put(self, path, data):
+        return self.__request("PUT", path, data=data)
 
-        return data
+    def post(self, path, data, files=None, headers=None):
+        if files is not None:
+            return self.__request("POST", path, files=files, data=data, headers=headers)
+        return self.__request("POST", path, data=data, headers=headers)
+
+    def delete(self, path):
+        return self.__request("DELETE", path)
@@ -1,37 +1,107 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import sys
 
-from library.PreseedControl import PreseedControl
-from library.StateControl import StateControl
-from library.NetworkControl import NetworkControl
-from library.ImageControl import ImageControl
+from library.Daemon import forward
 from helper.ClientLogger import ClientLogger
 
-from library.common import *
+# The library (and requests with it) is imported by the subcommand that needs
+# it, so that forwarding to a daemon or printing help does not pay for it
 
-import argparse
+# Options naming files, which the daemon resolves against its caller's
+# working directory
+PATH_ARGUMENTS = ('cache_path', 'metrics_file', 'image_path', 'manifest', 'preseed_path',
+                  'machines_file', 'from_manifest', 'from_dir', 'file')
 
 class Client(object):
-    def __init__(self, parser, args):
+    def __init__(self, parser, args, urlhandler=None, controllers=None):
+        """ urlhandler and controllers are passed in by callers running many
+            commands with the same connections and catalog indexes """
         self.parser = parser
         self.args = args
         self.log = ClientLogger(__name__, parser, args.verbose)
+        self.urlhandler = urlhandler
+        self.controllers = controllers if controllers is not None else {}
+        self.owns_urlhandler = urlhandler is None
+        if self.urlhandler is None:
+            self._new_urlhandler()
+        self._start_metrics()
+
+    def _new_urlhandler(self):
         try:
-            self.urlhandler = URLhandler(self.args.mrp_url, self.args.mrp_token)
+            from library.common import URLhandler
+            from library.AdmissionControl import AdmissionController
+            from library.CatalogCache import CatalogCache
+
+            cache = None
+            if self.args.cache:
+                cache = CatalogCache(self.args.mrp_url, self.args.mrp_token,
+                                     self.args.cache_path or None, self.args.cache_ttl)
+            pool_size = max(self.args.pool_size, getattr(self.args, 'concurrency', 0))
+            admission = AdmissionController(self.args.max_in_flight or pool_size,
+                                            rate=self.args.max_rate or None,
+                                            adaptive=not self.args.no_adaptive_concurrency)
+            self.urlhandler = URLhandler(self.args.mrp_url, self.args.mrp_token,
+                                         pool_size=pool_size, retries=self.args.retries,
+                                         cache=cache, validate=self.args.check_token,
+                                         admission=admission)
         except Exception as err:
             self.log.fatal(err)
             exit(1)
 
+    def _start_metrics(self):
+        """ This command's requests: a handler shared with other commands
+            (the daemon's) gets a hook feeding a fresh RequestMetrics """
+        self.metrics = None
+        self.metrics_hook = None
+        if not (self.args.stats or self.args.metrics_file):
+            return
+        if self.owns_urlhandler:
+            self.metrics = self.urlhandler.metrics
+        else:
+            from library.RequestMetrics import RequestMetrics
+            self.metrics = RequestMetrics()
+            for gauge in self.urlhandler.metrics.gauges:
+                self.metrics.add_gauge(*gauge)
+            self.metrics_hook = self.urlhandler.metrics.add_hook(self.metrics.record)
+
+    def report_metrics(self):
+        """ --stats summary on stderr and --metrics-file export """
+        if self.metrics_hook is not None:
+            self.urlhandler.metrics.remove_hook(self.metrics_hook)
+            self.metrics_hook = None
+        if self.metrics is None:
+            return
+        if self.args.stats:
+            sys.stderr.write(self.metrics.format_summary() + '\n')
+        if self.args.metrics_file:
+            try:
+                self.metrics.write(self.args.metrics_file, self.args.metrics_format)
+            except OSError as err:
+                self.log.error("Cannot write metrics to {0}: {1}".format(
+                               self.args.metrics_file, err))
+
     def parse(self):
         if self.args.subcommand == 'image':
             self.image(self.args.action, self.args.image_type, self.args.description,
                        self.args.arch, self.args.image_path, self.args.public,
-                       self.args.knowngood)
+                       self.args.knowngood, self.args.progress, self.args.replace)
         elif self.args.subcommand == 'preseed':
             self.preseed(self.args.action, self.args.preseed_name, self.args.preseed_path,
                          self.args.description, self.args.type, self.args.public,
                          self.args.knowngood)
+        elif self.args.subcommand == 'state' and self.args.machine is None:
+            from library.BulkStateControl import read_machine_list
+            machines = [name.strip() for name in self.args.machines.split(',')
+                        if name.strip()] if self.args.machines else \
+                       read_machine_list(self.args.machines_file)
+            self.bulk_machine_control(machines, self.args.concurrency,
+                                      self.args.action, self.args.preseed_name,
+                                      self.args.initrd_desc, self.args.kernel_desc,
+                                      self.args.kernel_opts, self.args.arch,
+                                      self.args.subarch, self.args.netboot)
         elif self.args.subcommand == 'state':
             self.machine_control(self.args.machine, self.args.action, self.args.preseed_name,
                                  self.args.initrd_desc, self.args.kernel_desc, self.args.kernel_opts,
@@ -39,17 +109,39 @@ class Client(object):
         elif self.args.subcommand == 'net':
             self.get_network_info(self.args.action, self.args.machine,
                                 self.args.interface)
+        elif self.args.subcommand == 'sync':
+            self.sync(self.args.from_manifest, self.args.from_dir, self.args.concurrency,
+                      self.args.bandwidth, self.args.public, self.args.knowngood,
+                      self.args.replace)
+        elif self.args.subcommand == 'apply':
+            self.apply(self.args.file, self.args.concurrency, self.args.dry_run)
+        elif self.args.subcommand == 'multi':
+            self.multi(self.args.servers, self.args.action, self.args.timeout)
+        elif self.args.subcommand == 'batch':
+            self.batch(self.args.file, self.args.jobs, self.args.keep_going)
+        elif self.args.subcommand == 'daemon':
+            self.daemon(self.args.socket, self.args.index_ttl)
         else:
             self.parser.print_help()
 
 
-    def image(self, command, image_type, desc, arch, path, public, knowngood):
-        image_controller = ImageControl(self.urlhandler)
+    def image(self, command, image_type, desc, arch, path, public, knowngood,
+              progress=False, replace=False):
+        from library.ImageManifest import ImageManifest
+        from library.MultipartStream import print_progress
+
+        manifest = None
+        if not self.args.no_manifest:
+            manifest = ImageManifest(self.args.mrp_url, self.args.manifest or None)
+        image_controller = self._image_controller()
         try:
             if command == 'upload':
                 rc = image_controller.upload_image(image_type, desc, arch, path, public,
-                                                 knowngood)
+                                                 knowngood,
+                                                 print_progress if progress else None,
+                                                 manifest=manifest, replace=replace)
                 self.log.debug(rc)
+                self._report_retries(image_controller)
             elif command == 'check':
                 if image_controller.get_image(image_type, desc, arch) is not None:
                     print('True')
@@ -58,17 +150,21 @@ class Client(object):
                     exit(2)
 
         except Exception as err:
+            if command == 'upload':
+                self._report_retries(image_controller)
             self.log.fatal(err)
             exit(1)
 
     def preseed(self, command, preseed_name, preseed_file, preseed_desc,
                 preseed_type, public, knowngood):
-        preseed_controller = PreseedControl(self.urlhandler)
+        preseed_controller = self._preseed_controller()
         try:
             if command == 'upload':
-                rc = preseed_controller.upload_preseed(preseed_name, preseed_file, preseed_type,
-                                                       preseed_desc, public, knowngood)
+                result, rc = preseed_controller.sync_preseed(preseed_name, preseed_file,
+                                                             preseed_type, preseed_desc,
+                                                             public, knowngood)
                 self.log.debug(rc)
+                print(result)
             elif command == 'check':
                 if preseed_controller.get_preseed(preseed_name, preseed_type) is not None:
                     print("True")
@@ -82,8 +178,11 @@ class Client(object):
 
     def machine_control(self, machine_name, action, preseed_name, initrd_desc, kernel_desc,
                              kernel_opts, arch, subarch, netboot):
+        from library.StateControl import StateControl
+
         try:
-            state = StateControl(self.urlhandler, machine_name)
+            state = StateControl(self.urlhandler, machine_name, self._image_controller(),
+                                 self._preseed_controller())
 
             if action == 'getparams':
                 machine_state = state.get_provisioning_state()
@@ -93,16 +192,116 @@ class Client(object):
                                      kernel_opts, preseed_name, netboot)
                 self.log.debug(rc)
             elif action == 'provision':
+                machine_ids = {machine_name: state.machine_id}
+                waiter = self._provision_waiter(machine_ids) if self.args.wait else None
                 rc = state.provision(arch, subarch, initrd_desc, kernel_desc,
                                      kernel_opts, preseed_name)
                 self.log.debug(rc)
+                if waiter is not None:
+                    self._wait_provisioned(waiter, machine_ids)
+
+        except Exception as err:
+            self.log.fatal(err)
+            exit(1)
+
+    def bulk_machine_control(self, machine_names, concurrency, action, preseed_name,
+                             initrd_desc, kernel_desc, kernel_opts, arch, subarch, netboot):
+        from library.BulkStateControl import BulkStateControl
+
+        try:
+            bulk = BulkStateControl(self.urlhandler, machine_names, concurrency,
+                                    self._image_controller(), self._preseed_controller())
+
+            if action == 'getparams':
+                results = bulk.get_provisioning_state()
+            elif action == 'setparams':
+                results = bulk.set_provisioning_state(arch, subarch, initrd_desc, kernel_desc,
+                                                      kernel_opts, preseed_name, netboot)
+            elif action == 'provision':
+                waiter = self._provision_waiter(bulk.machine_ids, concurrency) \
+                         if self.args.wait else None
+                results = bulk.provision(arch, subarch, initrd_desc, kernel_desc,
+                                         kernel_opts, preseed_name)
+        except Exception as err:
+            self.log.fatal(err)
+            exit(1)
+
+        self._print_bulk_report(results)
+        ok = all(result['ok'] for result in results)
+
+        if action == 'provision' and self.args.wait:
+            started = [result['machine'] for result in results if result['ok']]
+            try:
+                ok = self._wait_provisioned(waiter, {name: bulk.machine_ids[name]
+                                                     for name in started}) and ok
+            except Exception as err:
+                self.log.fatal(err)
+                exit(1)
+
+        if not ok:
+            exit(1)
+
+    def apply(self, path, concurrency, dry_run):
+        from library.common import UPDATED, UNCHANGED
+        from library.ApplyControl import ApplyControl, read_desired_state
 
+        try:
+            control = ApplyControl(self.urlhandler, read_desired_state(path), concurrency,
+                                   self._image_controller(), self._preseed_controller())
+            plan = control.plan()
         except Exception as err:
             self.log.fatal(err)
             exit(1)
 
+        failed = [entry for entry in plan if entry['error'] is not None]
+        changing = [entry for entry in plan if entry['changes'] and entry['error'] is None]
+        if dry_run:
+            for entry in plan:
+                if entry['error'] is not None:
+                    print("{0}: FAILED {1}".format(entry['machine'], entry['error']))
+                elif entry['changes']:
+                    print("{0}: {1}".format(entry['machine'], ', '.join(
+                          "{0} {1!r} -> {2!r}".format(field, current, wanted)
+                          for field, (current, wanted) in sorted(entry['changes'].items()))))
+                else:
+                    print("{0}: unchanged".format(entry['machine']))
+            print("{0} machines, {1} to change, {2} unchanged, {3} failed; planning made {4} "
+                  "requests, applying would make {5}".format(
+                  len(plan), len(changing), len(plan) - len(changing) - len(failed),
+                  len(failed), control.plan_requests, len(changing)))
+            if failed:
+                exit(1)
+            return
+
+        results = control.apply(plan)
+        for result in results:
+            if result['ok']:
+                print("{0}: {1}{2} ({3:.2f}s)".format(
+                      result['machine'], result['result'],
+                      ' ' + ', '.join(sorted(result['changes'])) if result['changes'] else '',
+                      result['elapsed']))
+            else:
+                print("{0}: FAILED ({1:.2f}s) {2}".format(result['machine'], result['elapsed'],
+                                                          result['error']))
+        counts = {outcome: len([result for result in results if result['result'] == outcome])
+                  for outcome in (UPDATED, UNCHANGED)}
+        failed = len([result for result in results if not result['ok']])
+        print("{0} machines, {1} updated, {2} unchanged, {3} failed; {4} requests".format(
+              len(results), counts[UPDATED], counts[UNCHANGED], failed,
+              control.plan_requests + len(changing)))
+        if failed:
+            exit(1)
+
     def get_network_info(self, command, machine_name, interface_name):
+        from library.common import ClientError, get_machine_id
+        from library.NetworkControl import NetworkControl
+
+        if command == 'getall':
+            return self.network_inventory(machine_name, self.args.format,
+                                          self.args.concurrency)
         try:
+            if not machine_name:
+                raise ClientError("--machine is required for %s" % command)
             machine_id = get_machine_id(self.urlhandler, machine_name)
             network = NetworkControl(self.urlhandler, machine_id, interface_name)
             if command == 'getip':
@@ -118,10 +317,338 @@ class Client(object):
             exit(1)
 
 
+    def network_inventory(self, machine_names, output_format, concurrency):
+        import csv
+        import json
+        from library.NetworkControl import NetworkInventory, INVENTORY_FIELDS
+
+        try:
+            inventory = NetworkInventory(self.urlhandler, concurrency)
+            names = [name.strip() for name in machine_names.split(',') if name.strip()] \
+                    if machine_names else None
+
+            if output_format == 'csv':
+                writer = csv.DictWriter(sys.stdout, fieldnames=INVENTORY_FIELDS)
+                writer.writeheader()
+            for row in inventory.rows(names):
+                if output_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    print(json.dumps(row))
+        except Exception as err:
+            self.log.fatal(err)
+            exit(1)
+
+    def sync(self, manifest_path, directory, concurrency, bandwidth, public, knowngood,
+             replace=False):
+        import time
+        from library.ImageManifest import ImageManifest
+        from library.SyncControl import SyncControl, read_sync_manifest, scan_sync_directory
+
+        try:
+            if manifest_path:
+                images, preseeds = read_sync_manifest(manifest_path, public, knowngood)
+            else:
+                images, preseeds = scan_sync_directory(directory, public, knowngood)
+
+            manifest = None
+            if not self.args.no_manifest:
+                manifest = ImageManifest(self.args.mrp_url, self.args.manifest or None)
+            syncer = SyncControl(self.urlhandler, concurrency, bandwidth,
+                                 self._image_controller(), self._preseed_controller(),
+                                 manifest, replace)
+            start = time.monotonic()
+            results = syncer.sync(images, preseeds)
+            elapsed = time.monotonic() - start
+        except Exception as err:
+            self.log.fatal(err)
+            exit(1)
+
+        for result in results:
+            if result['ok']:
+                print("{0} {1}: {2} ({3:.2f}s)".format(result['kind'], result['entry'],
+                                                       result['result'], result['elapsed']))
+            else:
+                print("{0} {1}: FAILED ({2:.2f}s) {3}".format(result['kind'], result['entry'],
+                                                              result['elapsed'],
+                                                              result['error']))
+        counts = {}
+        for result in results:
+            key = result['result'] if result['ok'] else 'failed'
+            counts[key] = counts.get(key, 0) + 1
+        sent = sum(result['bytes'] for result in results)
+        print("{0} entries: {1} created, {2} updated, {3} unchanged, {4} failed; "
+              "{5:.1f} MiB uploaded in {6:.1f}s ({7:.2f} MiB/s)".format(
+              len(results), counts.get('created', 0), counts.get('updated', 0),
+              counts.get('unchanged', 0), counts.get('failed', 0), sent / (1 << 20),
+              elapsed, sent / (1 << 20) / elapsed if elapsed > 0 else 0))
+
+        self._report_retries(syncer.image_controller)
+
+        if counts.get('failed'):
+            exit(1)
+
+    def batch(self, path, jobs, keep_going):
+        """ Runs one command per line of path ('-': stdin) with this client's
+            URLhandler and controllers, independent lines side by side, and
+            prints a JSON line per command in input order """
+        import json
+        import traceback
+        from library.BatchControl import BatchControl, read_batch_lines, line_resources
+        from library.BulkStateControl import read_machine_list
+        from helper.OutputCapture import OutputCapture
+
+        try:
+            if path == '-':
+                lines = list(read_batch_lines(sys.stdin))
+            else:
+                with open(path, 'r') as fd:
+                    lines = list(read_batch_lines(fd))
+        except OSError as err:
+            self.log.fatal(err)
+            exit(1)
+
+        # Lines run with the batch's server and token, whatever else they set
+        connection = ['--mrp-url', self.args.mrp_url, '--mrp-token', self.args.mrp_token]
+        parser = self.parser
+        controllers = {'image': self._image_controller(), 'preseed': self._preseed_controller()}
+        capture = OutputCapture()
+        jobs_list = []
+        resources = []
+        for number, argv in lines:
+            job = {'line': number, 'argv': argv, 'args': None, 'error': None}
+            touched = None
+            if isinstance(argv, ValueError):
+                job['argv'], job['error'] = None, str(argv)
+            else:
+                try:
+                    with capture, capture.capture() as (_, stderr):
+                        job['args'] = parser.parse_args(connection + argv)
+                except SystemExit:
+                    # argparse's usage, then its error on the last line
+                    job['error'] = (stderr.getvalue().strip().splitlines() or
+                                    ['invalid command line'])[-1]
+                else:
+                    if job['args'].subcommand in ('batch', 'daemon', None):
+                        job['error'] = "{0} can't run in a batch".format(
+                                       job['args'].subcommand or 'a line with no subcommand')
+                    else:
+                        job['args'].verbose = max(job['args'].verbose, self.args.verbose)
+                        try:
+                            touched = line_resources(job['args'], read_machine_list)
+                        except OSError:
+                            touched = None
+            if job['error'] is not None:
+                job['rc'], job['stdout'], job['stderr'] = None, '', job['error'] + '\n'
+            jobs_list.append(job)
+            resources.append(touched if job['error'] is None else (set(), set()))
+
+        def run(job):
+            if job['error'] is not None:
+                return False, job
+            with capture.capture() as (stdout, stderr):
+                try:
+                    run_command(parser, job['args'], self.urlhandler, controllers)
+                    rc = 0
+                except SystemExit as err:
+                    rc = err.code if isinstance(err.code, int) else 1
+                except Exception as err:
+                    rc = 1
+                    if job['args'].verbose:
+                        traceback.print_exc()
+                    else:
+                        sys.stderr.write("{0}: {1}\n".format(type(err).__name__, err))
+            job['rc'], job['stdout'], job['stderr'] = rc, stdout.getvalue(), stderr.getvalue()
+            return rc == 0, job
+
+        ok = True
+        with capture:
+            results = BatchControl(jobs, keep_going).results(jobs_list, resources, run)
+            for result in results:
+                job = result['job']
+                ok = ok and result['ok']
+                # A line that can't be parsed is reported as such, run or not
+                line = {'line': job['line'], 'argv': job['argv'],
+                        'rc': job.get('rc'), 'ok': result['ok'],
+                        'skipped': result['skipped'] and job['error'] is None,
+                        'elapsed': round(result['elapsed'], 6),
+                        'stdout': job.get('stdout', ''), 'stderr': job.get('stderr', '')}
+                capture.stdout.stream.write(json.dumps(line) + '\n')
+                capture.stdout.stream.flush()
+        if not ok:
+            exit(1)
+
+    def multi(self, servers_path, command, timeout):
+        """ Runs one lookup on this client's server and those listed in
+            servers_path at once, and prints a JSON line per server as it
+            answers or times out """
+        import json
+        from library.common import ClientError
+        from library.MultiServerControl import MultiServerControl, read_server_list
+        from library.Records import Record
+
+        args = self.args
+        fields = {'getip': 'lease_ipv4', 'getmac': 'mac', 'getnetmask': 'netmaskv4'}
+        try:
+            required = {'machine': ['machine'], 'image': ['image_type', 'description', 'arch'],
+                        'preseed': ['preseed_name']}.get(command, ['machine', 'interface'])
+            missing = ['--' + name.replace('_', '-') for name in required
+                       if not getattr(args, name)]
+            if missing:
+                raise ClientError("{0} needed for {1}".format(', '.join(missing), command))
+            servers = [{'name': args.mrp_url, 'url': args.mrp_url, 'token': args.mrp_token}]
+            servers += [server for server in read_server_list(servers_path)
+                        if server['url'] != args.mrp_url]
+            control = MultiServerControl(servers, timeout, args.pool_size, args.retries)
+        except Exception as err:
+            self.log.fatal(err)
+            exit(1)
+
+        if command == 'machine':
+            results = control.get_machine_id(args.machine)
+        elif command == 'image':
+            results = control.get_image(args.image_type, args.description, args.arch)
+        elif command == 'preseed':
+            results = control.get_preseed(args.preseed_name, args.type)
+        else:
+            results = control.get_interface(args.machine, args.interface)
+
+        answered, found = True, False
+        try:
+            for result in results:
+                answered = answered and result['ok']
+                found = found or result['found']
+                value = result['result']
+                if command in fields and value is not None:
+                    value = value.get(fields[command], '')
+                elif isinstance(value, Record):
+                    value = value.to_dict(without=('content',))
+                result['result'] = value
+                result['elapsed'] = round(result['elapsed'], 6)
+                print(json.dumps(result))
+                sys.stdout.flush()
+        finally:
+            control.close()
+        if not answered:
+            exit(1)
+        if not found:
+            exit(2)
+
+    def daemon(self, socket_path, index_ttl):
+        """ Serves commands on socket_path until killed, with this client's
+            URLhandler and controllers kept warm between them """
+        import threading
+        import traceback
+        from helper.OutputCapture import OutputCapture
+        from library.Daemon import ClientDaemon
+        from library.ImageControl import ImageControl
+        from library.PreseedControl import PreseedControl
+
+        parser = self.parser
+        urlhandler = self.urlhandler
+        controllers = {'image': ImageControl(urlhandler, ttl=index_ttl),
+                       'preseed': PreseedControl(urlhandler, ttl=index_ttl)}
+
+        capture = OutputCapture()
+        metrics_lock = threading.Lock()
+
+        def run(argv, cwd):
+            with capture.capture() as (stdout, stderr):
+                try:
+                    args = parser.parse_args(argv)
+                    for name in PATH_ARGUMENTS:
+                        if getattr(args, name, None):
+                            setattr(args, name, os.path.join(cwd, getattr(args, name)))
+                    run_command(parser, args, urlhandler, controllers)
+                    rc = 0
+                except SystemExit as err:
+                    rc = err.code if isinstance(err.code, int) else 1
+                except Exception:
+                    # Reported to the caller, which must not run it again
+                    traceback.print_exc()
+                    rc = 1
+            # Machine ids stay valid for the daemon's life unless a machine is
+            # deleted; a failed command drops them in case that was why
+            if rc == 1:
+                urlhandler.machine_ids.clear()
+            # Keeps a textfile collector current while the daemon runs
+            if self.args.metrics_file:
+                with metrics_lock:
+                    self.metrics.write(self.args.metrics_file, self.args.metrics_format)
+            return rc, stdout.getvalue(), stderr.getvalue()
+
+        with capture:
+            ClientDaemon(socket_path, self.args.mrp_url, self.args.mrp_token,
+                         run).serve_forever()
+
+    def _image_controller(self):
+        from library.ImageControl import ImageControl
+
+        if 'image' not in self.controllers:
+            self.controllers['image'] = ImageControl(self.urlhandler)
+        return self.controllers['image']
+
+    def _preseed_controller(self):
+        from library.PreseedControl import PreseedControl
+
+        if 'preseed' not in self.controllers:
+            self.controllers['preseed'] = PreseedControl(self.urlhandler)
+        return self.controllers['preseed']
+
+    def _provision_waiter(self, machine_ids, concurrency=8):
+        """ A ProvisionWaiter for --wait, with the machines' leases noted
+            before they are provisioned """
+        from library.WaitControl import ProvisionWaiter
+
+        waiter = ProvisionWaiter(self.urlhandler, self.args.interface or None,
+                                 timeout=self.args.wait_timeout)
+        waiter.snapshot(machine_ids, concurrency)
+        return waiter
+
+    def _wait_provisioned(self, waiter, machine_ids):
+        """ Prints each machine's outcome as soon as it is known, exits 1
+            on a single machine timeout, returns whether all made it """
+        ok = True
+        for result in waiter.wait(machine_ids):
+            if result['ok']:
+                print("{0}: ready {1} ({2:.0f}s)".format(result['machine'], result['ip'],
+                                                       result['elapsed']))
+            else:
+                print("{0}: NOT READY ({1:.0f}s) {2}".format(result['machine'],
+                                                            result['elapsed'],
+                                                            result['error']))
+                ok = False
+            sys.stdout.flush()
+
+        if not ok and len(machine_ids) == 1:
+            exit(1)
+        return ok
+
+    def _report_retries(self, image_controller):
+        stats = image_controller.retry_stats
+        if stats['retries']:
+            self.log.warning("Uploads retried {0} times, {1} possible duplicates left by "
+                             "failed tries, {2:.1f} MiB sent by failed tries".format(
+                             stats['retries'], stats['suspects'],
+                             stats['extra_bytes'] / (1 << 20)))
+
     def _print_machine_state(self, machine_state):
         for key in machine_state.keys():
             print("{0}: {1}".format(key, machine_state[key]))
 
+    def _print_bulk_report(self, results):
+        for result in results:
+            if result['ok']:
+                print("{0}: ok ({1:.2f}s)".format(result['machine'], result['elapsed']))
+                if self.args.action == 'getparams':
+                    self._print_machine_state(result['result'])
+            else:
+                print("{0}: FAILED ({1:.2f}s) {2}".format(result['machine'], result['elapsed'],
+                                                          result['error']))
+        failed = len([result for result in results if not result['ok']])
+        print("{0} machines, {1} ok, {2} failed".format(len(results), len(results) - failed,
+                                                        failed))
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -130,9 +657,24 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
-if __name__ == '__main__':
-    """This is the point of entry of our application, not much logic here"""
+def size2int(v):
+    """ '500K', '20M', '1G' (powers of 1024) or a plain number of bytes """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    try:
+        if v and v[-1].upper() in units:
+            return int(float(v[:-1]) * units[v[-1].upper()])
+        return int(v)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Size expected, such as 500K, 20M or 1G.')
+
+def run_command(parser, args, urlhandler=None, controllers=None):
+    client = Client(parser, args, urlhandler, controllers)
+    try:
+        client.parse()
+    finally:
+        client.report_metrics()
 
+def build_parser():
     parser = argparse.ArgumentParser(description='Client to the Mr Provisioner \
                                      server for provisioning baremetal \
                                      machines.', add_help=False)
@@ -142,6 +684,36 @@ if __name__ == '__main__':
                         required=True, help='The URL of the MrP server')
     parser.add_argument('--mrp-token', type=str,
                         required=True, help='The authentication token to use')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='Number of keep-alive connections to keep open to MrP')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Transport retries for idempotent requests on connection or 5xx errors')
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help='Most requests in flight to MrP at once (default: the pool size); '
+                             'lowered while MrP answers slowly or with overload errors')
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help='Most requests per second sent to MrP (default: no limit)')
+    parser.add_argument('--no-adaptive-concurrency', action='store_true', default=False,
+                        help='Keep the in-flight limit fixed instead of adapting it to MrP')
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='Cache image, preseed and machine catalogs on disk between runs')
+    parser.add_argument('--cache-ttl', type=int, default=300,
+                        help='Seconds a cached catalog is used before revalidating it')
+    parser.add_argument('--cache-path', type=str, default='',
+                        help='Path to the catalog cache database')
+    parser.add_argument('--check-token', action='store_true', default=False,
+                        help='Check the URL and token with a probe request before anything else, '
+                             'instead of on the first real request')
+    parser.add_argument('--daemon-socket', type=str, default='',
+                        help='Send commands to the client daemon on this socket when it is running '
+                             '(default: $MRP_CLIENT_SOCKET)')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='Print per-endpoint request counts, latencies and bytes on exit')
+    parser.add_argument('--metrics-file', type=str, default='',
+                        help='Write request metrics to this file on exit (the daemon: after '
+                             'every command), e.g. for a Prometheus textfile collector')
+    parser.add_argument('--metrics-format', type=str, choices=['prometheus', 'json'],
+                        default='prometheus', help='Format of --metrics-file')
 
     subparsers = parser.add_subparsers(dest='subcommand')
 
@@ -160,6 +732,15 @@ if __name__ == '__main__':
                               required=False, help='Switches the known good flag')
     parser_image.add_argument('--image-path', type=str, default='',
                               required=False, help='Path to the image file to upload')
+    parser_image.add_argument('--progress', action='store_true', default=False,
+                              required=False, help='Show upload progress and throughput')
+    parser_image.add_argument('--manifest', type=str, default='',
+                              required=False, help='Path to the local image digest manifest')
+    parser_image.add_argument('--no-manifest', action='store_true', default=False,
+                              required=False, help='Do not compare content digests, only descriptions')
+    parser_image.add_argument('--replace', action='store_true', default=False,
+                              required=False, help='Upload an image whose content changed and '
+                                                   'delete the one it replaces')
 
     parser_preseed = subparsers.add_parser('preseed')
     parser_preseed.add_argument('--action', type=str, choices=['check', 'upload'],
@@ -183,8 +764,21 @@ if __name__ == '__main__':
     parser_machine.add_argument('--action', type=str, default='', required=True,
                                 choices=['provision', 'setparams', 'getparams'],
                                 help='provision, setparams, getparams')
-    parser_machine.add_argument('--machine', type=str, default='',
-                                required=True, help='name of the machine')
+    machine_selection = parser_machine.add_mutually_exclusive_group(required=True)
+    machine_selection.add_argument('--machine', type=str, default=None,
+                                   help='name of the machine')
+    machine_selection.add_argument('--machines', type=str, default=None,
+                                   help='comma separated names of machines to handle concurrently')
+    machine_selection.add_argument('--machines-file', type=str, default=None,
+                                   help='file listing one machine name per line')
+    parser_machine.add_argument('--concurrency', type=int, default=8,
+                                required=False, help='number of machines handled at once in bulk mode')
+    parser_machine.add_argument('--wait', action='store_true', default=False,
+                                required=False, help='after provision, wait until machines are up with an IPv4 lease')
+    parser_machine.add_argument('--wait-timeout', type=int, default=1800,
+                                required=False, help='seconds to wait for each machine with --wait')
+    parser_machine.add_argument('--interface', type=str, default='',
+                                required=False, help='interface whose lease --wait looks for (default: any)')
     parser_machine.add_argument('--preseed-name', type=str, default=None,
                                 required=False, help='name of the preseed to use')
     parser_machine.add_argument('--initrd-desc', type=str, default='',
@@ -201,11 +795,111 @@ if __name__ == '__main__':
                                 required=False, help='Switches the netboot enabled flag on for setparams')
 
     parser_net = subparsers.add_parser('net')
-    parser_net.add_argument('--action', type=str, choices=['getip', 'getmac', 'getnetmask'],
+    parser_net.add_argument('--action', type=str, choices=['getip', 'getmac', 'getnetmask', 'getall'],
                            default='', required=True, help='getip, getmac, getnetmask, getall')
     parser_net.add_argument('--machine', type=str, default='',
-                           required=True, help='name of the machine')
+                           required=False, help='name of the machine (getall: comma separated, default all)')
+    parser_net.add_argument('--format', type=str, choices=['jsonl', 'csv'], default='jsonl',
+                           required=False, help='output format of getall')
+    parser_net.add_argument('--concurrency', type=int, default=8,
+                           required=False, help='machines queried at once by getall')
     parser_net.add_argument('--interface', type=str, default='',
                            help='name of the interface on the machine')
 
-    Client(parser, parser.parse_args()).parse()
+    parser_sync = subparsers.add_parser('sync')
+    sync_source = parser_sync.add_mutually_exclusive_group(required=True)
+    sync_source.add_argument('--from-manifest', type=str, default='',
+                             help='JSON file listing the images and preseeds to sync')
+    sync_source.add_argument('--from-dir', type=str, default='',
+                             help='directory laid out as images/<arch>/<type>/<file> and '
+                                  'preseeds/<type>/<file>')
+    parser_sync.add_argument('--concurrency', type=int, default=4,
+                             required=False, help='uploads running at once')
+    parser_sync.add_argument('--bandwidth', type=size2int, default=0,
+                             required=False, help='cap on the total upload rate in bytes per '
+                                                  'second, such as 20M (default: none)')
+    parser_sync.add_argument('--public', action='store_true', default=False,
+                             required=False, help='Default public flag of synced entries')
+    parser_sync.add_argument('--knowngood', action='store_true', default=False,
+                             required=False, help='Default known good flag of synced entries')
+    parser_sync.add_argument('--manifest', type=str, default='',
+                             required=False, help='Path to the local image digest manifest')
+    parser_sync.add_argument('--no-manifest', action='store_true', default=False,
+                             required=False, help='Do not compare image digests, only descriptions')
+    parser_sync.add_argument('--replace', action='store_true', default=False,
+                             required=False, help='Upload images whose content changed and '
+                                                  'delete the ones they replace')
+
+    parser_apply = subparsers.add_parser('apply')
+    parser_apply.add_argument('--file', type=str, required=True,
+                              help='JSON or YAML file of desired machine parameters')
+    parser_apply.add_argument('--dry-run', action='store_true', default=False,
+                              required=False, help='Print the changes and the requests they '
+                                                   'would take, change nothing')
+    parser_apply.add_argument('--concurrency', type=int, default=8,
+                              required=False, help='machines read and updated at once')
+
+    parser_multi = subparsers.add_parser('multi')
+    parser_multi.add_argument('--servers', type=str, required=True,
+                              help='JSON or YAML list of other MrP servers to query along with '
+                                   '--mrp-url: [{"url", "token", "name", "timeout"}, ...]')
+    parser_multi.add_argument('--action', type=str, required=True,
+                              choices=['machine', 'image', 'preseed', 'getip', 'getmac',
+                                       'getnetmask'],
+                              help='What to look up on every server. Prints a JSON line per '
+                                   'server as it answers; exits 1 if a server failed or timed '
+                                   'out, 2 if none has it')
+    parser_multi.add_argument('--timeout', type=float, default=10.0,
+                              help='Seconds a server has to answer, unless its entry sets its own')
+    parser_multi.add_argument('--machine', type=str, default='',
+                              help='Machine name, for machine and the net lookups')
+    parser_multi.add_argument('--interface', type=str, default='',
+                              help='Interface name, for getip, getmac and getnetmask')
+    parser_multi.add_argument('--image-type', type=str, default='',
+                              help='Image type, for image')
+    parser_multi.add_argument('--description', type=str, default='',
+                              help='Image description, for image')
+    parser_multi.add_argument('--arch', type=str, default='',
+                              help='Image architecture, for image')
+    parser_multi.add_argument('--preseed-name', type=str, default='',
+                              help='Preseed name, for preseed')
+    parser_multi.add_argument('--type', type=str, default=None,
+                              help='Preseed type, for preseed (default: any)')
+
+    parser_batch = subparsers.add_parser('batch')
+    parser_batch.add_argument('--file', type=str, default='-',
+                              help='File of command lines, one per line, as given to this '
+                                   'client without the server options (default: stdin)')
+    parser_batch.add_argument('--jobs', type=int, default=4,
+                              help='Lines run at once; lines on the same image, preseed or '
+                                   'machine still run in order')
+    parser_batch.add_argument('--keep-going', action='store_true', default=False,
+                              help='Run every line even after one failed, instead of '
+                                   'skipping those not started yet')
+
+    parser_daemon = subparsers.add_parser('daemon')
+    parser_daemon.add_argument('--socket', type=str, required=True,
+                               help='Unix socket to serve commands on')
+    parser_daemon.add_argument('--index-ttl', type=int, default=60,
+                               help='Seconds catalog lookups are reused between commands')
+
+    return parser
+
+if __name__ == '__main__':
+    """This is the point of entry of our application, not much logic here"""
+
+    parser = build_parser()
+    args = parser.parse_args()
+
+    socket_path = args.daemon_socket or os.environ.get('MRP_CLIENT_SOCKET')
+    # --wait prints each machine as it comes up, which a daemon could only
+    # send back at the end
+    if socket_path and args.subcommand in ('image', 'preseed', 'state', 'net', 'apply') and \
+       not getattr(args, 'wait', False):
+        reply = forward(socket_path, sys.argv[1:], args.mrp_url, args.mrp_token)
+        if reply is not None:
+            sys.stdout.write(reply['stdout'])
+            sys.stderr.write(reply['stderr'])
+            exit(reply['rc'])
+
+    run_command(parser, args)
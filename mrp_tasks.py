@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+    Runs a list of provisioning tasks in one process, as an Ansible module:
+    the arguments are a JSON object in the file named on the command line
+    (what Ansible hands a module) or on stdin, bare or under
+    ANSIBLE_MODULE_ARGS:
+
+        {"mrp_url": ..., "mrp_token": ..., "tasks": [{"action": ..., ...}],
+         "keep_going": false, "pool_size": 10, "retries": 3, "cache": false,
+         "manifest": null}
+
+    Tasks are described in library/TaskRunner.py. Prints one JSON object,
+    {"changed", "failed", "msg", "results"}, and exits 1 if a task failed.
+"""
+
+import json
+import sys
+
+from library.common import MrPError
+from library.MrPClient import MrPClient
+from library.TaskRunner import TaskRunner
+
+CLIENT_ARGUMENTS = ('pool_size', 'retries', 'cache', 'cache_ttl', 'cache_path', 'index_ttl',
+                    'manifest', 'validate', 'max_in_flight', 'max_rate')
+
+def read_arguments(argv):
+    if len(argv) > 1:
+        with open(argv[1], 'r') as fd:
+            arguments = json.load(fd)
+    else:
+        arguments = json.load(sys.stdin)
+    return arguments.get('ANSIBLE_MODULE_ARGS', arguments)
+
+def run(arguments):
+    """ The module's reply to arguments """
+    for required in ('mrp_url', 'mrp_token', 'tasks'):
+        if required not in arguments:
+            return {'changed': False, 'failed': True,
+                    'msg': 'missing required argument: {}'.format(required)}
+
+    options = {key: arguments[key] for key in CLIENT_ARGUMENTS if key in arguments}
+    try:
+        with MrPClient(arguments['mrp_url'], arguments['mrp_token'], **options) as client:
+            runner = TaskRunner(client, arguments.get('_ansible_check_mode', False),
+                                arguments.get('keep_going', False))
+            results = runner.run(arguments['tasks'])
+    except MrPError as err:
+        return {'changed': False, 'failed': True, 'msg': str(err)}
+
+    failed = [result for result in results if result['failed']]
+    return {'changed': any(result['changed'] for result in results),
+            'failed': bool(failed),
+            'msg': '; '.join('{}: {}'.format(result['name'], result['msg']) for result in failed),
+            'results': results}
+
+if __name__ == '__main__':
+    try:
+        reply = run(read_arguments(sys.argv))
+    except (OSError, ValueError) as err:
+        reply = {'changed': False, 'failed': True, 'msg': 'Cannot read arguments: {}'.format(err)}
+    print(json.dumps(reply))
+    exit(1 if reply['failed'] else 0)
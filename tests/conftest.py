@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# The client is run from its checkout rather than installed: tests import
+# library and helper from the repository root, wherever pytest starts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
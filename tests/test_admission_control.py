@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from library.AdmissionControl import AdmissionController, LATENCY_WARMUP
+from library.RequestMetrics import RequestEvent
+
+def event(status=200, latency=0.01, retries=0, request_bytes=0, endpoint='/api/v1/image'):
+    return RequestEvent('GET', endpoint, endpoint, status, latency, request_bytes, 0,
+                        retries, None)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_never_more_than_the_limit_in_flight(self):
+        admission = AdmissionController(3, adaptive=False)
+        lock = threading.Lock()
+        in_flight, highest = [0], [0]
+
+        def request():
+            ticket = admission.acquire()
+            with lock:
+                in_flight[0] += 1
+                highest[0] = max(highest[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            admission.release(ticket, event())
+
+        threads = [threading.Thread(target=request) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(highest[0], 3)
+        self.assertEqual((admission.in_flight, admission.waiting), (0, 0))
+
+    def test_a_burst_of_overloads_halves_the_limit_once(self):
+        admission = AdmissionController(8)
+        tickets = [admission.acquire() for _ in range(4)]
+        for ticket in tickets:
+            admission.release(ticket, event(status=503))
+        self.assertEqual((int(admission.limit), admission.decreases), (4, 1))
+
+        # Sent after the decrease: may lower it again
+        admission.release(admission.acquire(), event(status=None))
+        self.assertEqual((int(admission.limit), admission.lowest), (2, 2))
+
+    def test_floor_and_growth(self):
+        admission = AdmissionController(4, min_limit=2)
+        for _ in range(3):
+            admission.release(admission.acquire(), event(retries=1))
+        self.assertEqual(int(admission.limit), 2)
+        # One request at a time never fills the limit: no reason to raise it
+        for _ in range(10):
+            admission.release(admission.acquire(), event())
+        self.assertEqual(int(admission.limit), 2)
+        # Kept full, it grows back to the maximum and no further
+        for _ in range(20):
+            tickets = [admission.acquire() for _ in range(int(admission.limit))]
+            for ticket in tickets:
+                admission.release(ticket, event())
+        self.assertEqual(admission.limit, 4.0)
+
+    def test_slow_endpoint_is_congestion(self):
+        admission = AdmissionController(8)
+        for _ in range(LATENCY_WARMUP * 10):
+            admission.release(admission.acquire(), event(latency=0.1))
+        self.assertEqual(admission.decreases, 0)
+        # Slow uploads say nothing about the server's load
+        admission.release(admission.acquire(), event(latency=5.0, request_bytes=1 << 20))
+        self.assertEqual(admission.decreases, 0)
+        admission.release(admission.acquire(), event(latency=2.0))
+        self.assertEqual(admission.decreases, 1)
+        # Another endpoint has its own usual latency
+        admission.release(admission.acquire(), event(latency=2.0, endpoint='/api/v1/preseed'))
+        self.assertEqual(admission.decreases, 1)
+
+    def test_not_adaptive(self):
+        admission = AdmissionController(4, adaptive=False)
+        admission.release(admission.acquire(), event(status=503))
+        self.assertEqual((int(admission.limit), admission.decreases), (4, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from library.ApplyControl import ApplyControl
+from library.RequestMetrics import RequestEvent, RequestMetrics
+
+MACHINES = [{'id': 1, 'name': 'm1', 'subarch': 'efi'},
+            {'id': 2, 'name': 'm2', 'subarch': 'bios'}]
+
+
+class FakeHandler(object):
+    """ Machine queries and records; every request made while another
+        thread also sends requests through the same metrics """
+
+    def __init__(self):
+        self.metrics = RequestMetrics()
+        self.machine_ids = {}
+        self.query_support = {}
+        self.requests = 0
+
+    def request(self, path):
+        self.requests += 1
+        self.metrics.record(RequestEvent('GET', path, path, 200, 0.0, 0, 0, 0, None))
+
+    def get(self, path, cached=False):
+        self.request(path)
+        # Another command sharing the handler
+        other = threading.Thread(target=lambda: [self.metrics.record(
+                    RequestEvent('GET', '/other', '/other', 200, 0.0, 0, 0, 0, None))
+                    for _ in range(3)])
+        other.start()
+        other.join()
+        if path.startswith('/api/v1/machine/'):
+            machine_id = int(path.rsplit('/', 1)[1])
+            return [dict(machine) for machine in MACHINES if machine['id'] == machine_id][0]
+        return [{'id': machine['id'], 'name': machine['name']} for machine in MACHINES]
+
+
+class ApplyControlTest(unittest.TestCase):
+
+    def test_plan_counts_only_its_own_requests(self):
+        handler = FakeHandler()
+        control = ApplyControl(handler, {'m1': {'subarch': 'efi'}, 'm2': {'subarch': 'efi'}},
+                               concurrency=2)
+        plan = control.plan()
+        self.assertEqual([entry['changes'] for entry in plan],
+                         [{}, {'subarch': ('bios', 'efi')}])
+        self.assertEqual(control.plan_requests, handler.requests)
+        self.assertEqual(handler.requests, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import shlex
+import tempfile
+import threading
+import time
+import unittest
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+from library.BatchControl import (BatchControl, EVERYTHING, depends, line_resources,
+                                  read_batch_lines)
+from mrp_client import Client, build_parser
+
+PARSER = build_parser()
+
+def parse(line):
+    return PARSER.parse_args(['--mrp-url', 'http://mrp', '--mrp-token', 't'] +
+                             shlex.split(line))
+
+def resources(line, machines_file=None):
+    return line_resources(parse(line), lambda path: machines_file)
+
+STATE = ('state --action provision --arch arm64 --subarch generic --kernel-desc k1 '
+         '--initrd-desc i1 --preseed-name p1 ')
+
+
+class ReadBatchLinesTest(unittest.TestCase):
+
+    def test_comments_blank_lines_and_bad_quotes(self):
+        lines = list(read_batch_lines(io.StringIO(
+            '# header\n\nimage --action check  # trailing\nnet "unclosed\n')))
+        self.assertEqual(lines[0], (3, ['image', '--action', 'check']))
+        self.assertEqual(lines[1][0], 4)
+        self.assertIsInstance(lines[1][1], ValueError)
+        self.assertEqual(len(lines), 2)
+
+
+class LineResourcesTest(unittest.TestCase):
+
+    def test_image(self):
+        image = ('image', ('kernel', 'k1', 'arm64'))
+        self.assertEqual(resources('image --action check --image-type Kernel '
+                                   '--description k1 --arch arm64'), ({image}, set()))
+        self.assertEqual(resources('image --action upload --image-type Kernel '
+                                   '--description k1 --arch arm64 --image-path f'),
+                         (set(), {image}))
+
+    def test_preseed(self):
+        self.assertEqual(resources('preseed --action check --preseed-name p1'),
+                         ({('preseed', 'p1')}, set()))
+        self.assertEqual(resources('preseed --action upload --preseed-name p1 '
+                                   '--preseed-path f --type preseed'),
+                         (set(), {('preseed', 'p1')}))
+
+    def test_state(self):
+        reads, writes = resources(STATE + '--machines "m1, m2,"')
+        self.assertEqual(writes, {('machine', 'm1'), ('machine', 'm2')})
+        self.assertEqual(reads, {('image', ('kernel', 'k1', 'arm64')),
+                                 ('image', ('initrd', 'i1', 'arm64')), ('preseed', 'p1')})
+        self.assertEqual(resources('state --action getparams --machine m1'),
+                         ({('machine', 'm1')}, set()))
+        self.assertEqual(resources(STATE + '--machines-file list', ['m3'])[1],
+                         {('machine', 'm3')})
+
+    def test_net(self):
+        self.assertEqual(resources('net --action getip --machine m1 --interface eth0'),
+                         ({('machine', 'm1')}, set()))
+        self.assertEqual(resources('net --action getall --machine " m1 ,m2"'),
+                         ({('machine', 'm1'), ('machine', 'm2')}, set()))
+        self.assertEqual(resources('net --action getall'), ({('machine', '*')}, set()))
+
+    def test_sync_and_others(self):
+        self.assertEqual(resources('sync --from-dir d'),
+                         (set(), {('image', '*'), ('preseed', '*')}))
+        self.assertEqual(resources('apply --file f'), (set(), {EVERYTHING}))
+
+
+class DependsTest(unittest.TestCase):
+
+    def test_readers_of_the_same_thing_are_independent(self):
+        read = ({('machine', 'm1')}, set())
+        self.assertFalse(depends(read, read))
+
+    def test_write_then_read_or_write(self):
+        write = (set(), {('machine', 'm1')})
+        read = ({('machine', 'm1')}, set())
+        self.assertTrue(depends(write, read))
+        self.assertTrue(depends(read, write))
+        self.assertTrue(depends(write, write))
+
+    def test_other_keys_and_kinds(self):
+        write = (set(), {('machine', 'm1')})
+        self.assertFalse(depends(write, ({('machine', 'm2')}, set())))
+        self.assertFalse(depends(write, (set(), {('preseed', 'm1')})))
+
+    def test_wildcards(self):
+        self.assertTrue(depends((set(), {('image', '*')}),
+                                ({('image', ('kernel', 'k1', 'arm64'))}, set())))
+        self.assertTrue(depends(({('machine', '*')}, set()), (set(), {('machine', 'm1')})))
+        self.assertTrue(depends((set(), {EVERYTHING}), ({('preseed', 'p1')}, set())))
+        self.assertTrue(depends(({('preseed', 'p1')}, set()), (set(), {EVERYTHING})))
+        self.assertFalse(depends(({('machine', '*')}, set()), ({('machine', 'm1')}, set())))
+
+
+class BatchControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def record(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def job(self, name, ok=True, delay=0.0, barrier=None):
+        return {'name': name, 'ok': ok, 'delay': delay, 'barrier': barrier}
+
+    def run_job(self, job):
+        self.record('start', job['name'])
+        if job['barrier'] is not None:
+            job['barrier'].wait(timeout=2)
+        time.sleep(job['delay'])
+        self.record('end', job['name'])
+        if isinstance(job['ok'], Exception):
+            raise job['ok']
+        return job['ok'], job['name']
+
+    def results(self, jobs, touched, workers=4, keep_going=False):
+        return list(BatchControl(workers, keep_going).results(jobs, touched, self.run_job))
+
+    def test_independent_jobs_run_together(self):
+        barrier = threading.Barrier(3)
+        jobs = [self.job(name, barrier=barrier) for name in 'abc']
+        touched = [({('machine', name)}, {('machine', name)}) for name in 'abc']
+        results = self.results(jobs, touched)
+        self.assertTrue(all(result['ok'] for result in results))
+        self.assertFalse(barrier.broken)
+
+    def test_dependent_jobs_run_in_input_order(self):
+        jobs = [self.job('write', delay=0.1), self.job('read'), self.job('other')]
+        touched = [(set(), {('machine', 'm1')}), ({('machine', 'm1')}, set()),
+                   ({('machine', 'm2')}, set())]
+        results = self.results(jobs, touched)
+        events = self.events
+        self.assertLess(events.index(('end', 'write')), events.index(('start', 'read')))
+        self.assertLess(events.index(('end', 'other')), events.index(('end', 'write')))
+        self.assertEqual([result['result'] for result in results], ['write', 'read', 'other'])
+
+    def test_unknown_resources_run_alone(self):
+        jobs = [self.job('before', delay=0.05), self.job('alone'), self.job('after')]
+        touched = [({('machine', 'm1')}, set()), None, ({('machine', 'm2')}, set())]
+        self.results(jobs, touched)
+        events = self.events
+        self.assertLess(events.index(('end', 'before')), events.index(('start', 'alone')))
+        self.assertLess(events.index(('end', 'alone')), events.index(('start', 'after')))
+
+    def test_failure_skips_jobs_not_started(self):
+        jobs = [self.job('fails', ok=False), self.job('waits'), self.job('later')]
+        touched = [(set(), {('machine', 'm1')}), ({('machine', 'm1')}, set()), None]
+        results = self.results(jobs, touched)
+        self.assertEqual([(result['ok'], result['skipped']) for result in results],
+                         [(False, False), (False, True), (False, True)])
+        self.assertNotIn(('start', 'waits'), self.events)
+
+    def test_keep_going_runs_everything(self):
+        jobs = [self.job('fails', ok=RuntimeError('boom')), self.job('waits')]
+        touched = [(set(), {('machine', 'm1')}), ({('machine', 'm1')}, set())]
+        results = self.results(jobs, touched, keep_going=True)
+        self.assertFalse(results[0]['ok'])
+        self.assertIsInstance(results[0]['result'], RuntimeError)
+        self.assertEqual((results[1]['ok'], results[1]['skipped']), (True, False))
+
+
+
+class BatchCommandTest(unittest.TestCase):
+
+    def batch(self, text, *options):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fd:
+            fd.write(text)
+        self.addCleanup(os.unlink, fd.name)
+        args = PARSER.parse_args(['--mrp-url', 'http://mrp', '--mrp-token', 't'] +
+                                 list(options) + ['batch', '--file', fd.name, '--keep-going'])
+        output = io.StringIO()
+        with redirect_stdout(output), self.assertRaises(SystemExit):
+            Client(PARSER, args).batch(args.file, args.jobs, args.keep_going)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    @staticmethod
+    def fake_run_command(parser, args, urlhandler=None, controllers=None):
+        if args.preseed_name == 'boom':
+            raise KeyError('no such thing')
+        print('ran', args.preseed_name)
+
+    def test_line_raising_an_exception(self):
+        with mock.patch('mrp_client.run_command', self.fake_run_command):
+            lines = self.batch('preseed --action check --preseed-name boom\n'
+                               'preseed --action check --preseed-name fine\n')
+        self.assertEqual((lines[0]['rc'], lines[0]['ok']), (1, False))
+        self.assertEqual(lines[0]['stderr'], "KeyError: 'no such thing'\n")
+        self.assertEqual((lines[1]['rc'], lines[1]['stdout']), (0, 'ran fine\n'))
+
+    def test_traceback_when_verbose(self):
+        with mock.patch('mrp_client.run_command', self.fake_run_command):
+            lines = self.batch('preseed --action check --preseed-name boom\n', '--verbose')
+        self.assertIn('Traceback', lines[0]['stderr'])
+        self.assertIn("KeyError: 'no such thing'", lines[0]['stderr'])
+
+
+if __name__ == '__main__':
+    unittest.main()
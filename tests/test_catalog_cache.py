@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from library.CatalogCache import CatalogCache
+from library.common import URLhandler
+
+IMAGES = [{'id': 1, 'type': 'Kernel'}, {'id': 2, 'type': 'Initrd'}]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Serves the server's catalog with an ETag, and 304 when it matches """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        etag = '"v{}"'.format(self.server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.catalog).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.path, None))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class CatalogCacheTest(unittest.TestCase):
+
+    PATH = '/api/v1/image?show_all=true'
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests, self.server.catalog, self.server.version = [], IMAGES, 1
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_path = os.path.join(directory.name, 'catalog.sqlite')
+
+    def handler(self, ttl=300, token='t'):
+        cache = CatalogCache(self.url, token, self.cache_path, ttl)
+        urlhandler = URLhandler(self.url, token, retries=0, cache=cache, timeout=5)
+        self.addCleanup(urlhandler.close)
+        return urlhandler
+
+    def test_fresh_entry_is_used_without_asking(self):
+        self.assertEqual(self.handler().get(self.PATH, cached=True), IMAGES)
+        # Another process on the same host
+        self.assertEqual(self.handler().get(self.PATH, cached=True), IMAGES)
+        self.assertEqual(self.server.requests, [(self.PATH, None)])
+
+    def test_stale_entry_is_revalidated(self):
+        self.handler(ttl=0).get(self.PATH, cached=True)
+        self.assertEqual(self.handler(ttl=0).get(self.PATH, cached=True), IMAGES)
+        self.assertEqual(self.server.requests[1], (self.PATH, '"v1"'))
+
+        # Touched by the 304: fresh again for a cache with a real ttl
+        cache = CatalogCache(self.url, 't', self.cache_path, 300)
+        self.assertTrue(cache.lookup(self.PATH).fresh)
+
+    def test_changed_catalog_replaces_the_entry(self):
+        self.handler(ttl=0).get(self.PATH, cached=True)
+        self.server.catalog, self.server.version = IMAGES[:1], 2
+        self.assertEqual(list(self.handler(ttl=0).stream_list(self.PATH, cached=True)),
+                         IMAGES[:1])
+        self.assertEqual(self.handler().get(self.PATH, cached=True), IMAGES[:1])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_write_invalidates_every_token(self):
+        self.handler(token='a').get(self.PATH, cached=True)
+        self.handler(token='b').get(self.PATH, cached=True)
+        self.handler(token='a').post('/api/v1/image', data='{}')
+        for token in 'ab':
+            self.assertIsNone(CatalogCache(self.url, token, self.cache_path).lookup(self.PATH))
+
+    def test_entries_expire(self):
+        cache = CatalogCache(self.url, 't', self.cache_path, ttl=0.05)
+        cache.store(self.PATH, json.dumps(IMAGES), '"v1"')
+        self.assertTrue(cache.lookup(self.PATH).fresh)
+        time.sleep(0.1)
+        entry = cache.lookup(self.PATH)
+        self.assertEqual((entry.data, entry.etag, entry.fresh), (IMAGES, '"v1"', False))
+
+
+if __name__ == '__main__':
+    unittest.main()
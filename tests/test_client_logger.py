@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import threading
+import unittest
+
+from contextlib import redirect_stderr
+
+from helper.ClientLogger import ClientLogger
+
+
+class ClientLoggerTest(unittest.TestCase):
+
+    def test_verbosity_is_per_thread(self):
+        root = logging.getLogger()
+        root_level, root_handlers = root.level, list(root.handlers)
+        ready = threading.Barrier(2)
+        output = io.StringIO()
+
+        def command(verbosity, name):
+            ClientLogger('mrp_client', verbosity=verbosity)
+            ready.wait(timeout=2)
+            logging.getLogger('library.test').debug('debug from %s', name)
+            logging.getLogger('library.test').warning('warning from %s', name)
+
+        with redirect_stderr(output):
+            threads = [threading.Thread(target=command, args=(2, 'verbose')),
+                       threading.Thread(target=command, args=(0, 'quiet'))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        lines = sorted(output.getvalue().splitlines())
+        self.assertEqual(lines, ['debug from verbose', 'warning from quiet',
+                                 'warning from verbose'])
+        self.assertEqual((root.level, root.handlers), (root_level, root_handlers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import tempfile
+import unittest
+
+from library.common import (CREATED, UNCHANGED, UPDATED, ProvisionerError,
+                            URLhandlerHTTPError)
+from library.ImageControl import ImageControl
+from library.ImageManifest import ImageManifest
+
+
+class FakeHandler(object):
+    """ Just enough of URLhandler for ImageControl: no filtered queries, a
+        listing of self.images, and uploads appended to it """
+
+    def __init__(self):
+        self.images = []
+        self.query_support = {}
+        self.deleted = []
+        self.refuse_delete = False
+
+    def get(self, path, cached=True):
+        raise URLhandlerHTTPError('GET', path, 400, None)
+
+    def stream_list(self, path, cached=False):
+        return iter(list(self.images))
+
+    def post(self, path, data=None, headers=None):
+        body = data.read()
+        fields = json.loads(re.search(rb'name="q"\r\n\r\n(.*?)\r\n', body).group(1))
+        image = dict(fields, id=len(self.images) + 1)
+        self.images.append(image)
+        return image
+
+    def delete(self, path):
+        if self.refuse_delete:
+            raise URLhandlerHTTPError('DELETE', path, 409, 'image in use')
+        self.deleted.append(path)
+        image_id = int(path.rsplit('/', 1)[1])
+        self.images = [image for image in self.images if image['id'] != image_id]
+
+
+class ImageControlTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'vmlinuz')
+        self.write(b'first build')
+        self.manifest = ImageManifest('http://mrp', os.path.join(directory.name, 'm.json'))
+        self.handler = FakeHandler()
+
+    def write(self, content):
+        with open(self.path, 'wb') as fd:
+            fd.write(content)
+
+    def sync(self, controller, manifest=None, replace=False):
+        controller.refresh()
+        return controller.sync_image('Kernel', 'k1', 'arm64', self.path, False, False,
+                                     manifest=manifest, replace=replace)[0]
+
+    def test_manifest_given_per_call(self):
+        controller = ImageControl(self.handler)
+        self.assertEqual(self.sync(controller, self.manifest), CREATED)
+        self.assertIsNone(controller.manifest)
+        self.write(b'second build')
+        # Without a manifest, the description alone says it is there
+        self.assertEqual(self.sync(controller), UNCHANGED)
+        self.assertEqual(self.sync(controller, self.manifest, replace=True), UPDATED)
+        self.assertEqual(self.sync(controller, self.manifest), UNCHANGED)
+
+    def test_no_hashing_without_a_recorded_digest(self):
+        controller = ImageControl(self.handler, self.manifest)
+        self.assertEqual(self.sync(controller), CREATED)
+        self.manifest.forget(1)
+        os.unlink(self.path)
+        self.assertEqual(self.sync(controller), UNCHANGED)
+
+    def test_changed_image_is_only_replaced_when_asked(self):
+        controller = ImageControl(self.handler, self.manifest)
+        self.sync(controller)
+        self.write(b'second build')
+        with self.assertRaises(ProvisionerError):
+            self.sync(controller)
+        self.assertEqual((len(self.handler.images), self.handler.deleted), (1, []))
+
+        self.assertEqual(self.sync(controller, replace=True), UPDATED)
+        self.assertEqual([image['id'] for image in self.handler.images], [2])
+        self.assertEqual(self.handler.deleted, ['/api/v1/image/1'])
+        self.assertIsNone(self.manifest.lookup(1))
+
+    def test_refused_delete_is_tried_again_without_another_upload(self):
+        controller = ImageControl(self.handler, self.manifest)
+        self.sync(controller)
+        self.write(b'second build')
+        self.handler.refuse_delete = True
+        with self.assertLogs('library.common', 'WARNING'):
+            self.assertEqual(self.sync(controller, replace=True), UPDATED)
+        self.assertEqual(len(self.handler.images), 2)
+        self.assertIsNotNone(self.manifest.lookup(1))
+
+        self.handler.refuse_delete = False
+        self.assertEqual(self.sync(controller, replace=True), UPDATED)
+        self.assertEqual([image['id'] for image in self.handler.images], [2])
+        self.assertIsNone(self.manifest.lookup(1))
+        self.assertEqual(self.sync(controller), UNCHANGED)
+
+
+if __name__ == '__main__':
+    unittest.main()
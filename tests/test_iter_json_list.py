@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from library.common import iter_json_list
+
+DOCUMENTS = {
+    'objects': [{'id': 1, 'name': 'kernel', 'nested': {'list': [1, 2, {'a': None}]}},
+                {'id': 2, 'name': '', 'flags': [True, False]}],
+    'strings': ['plain', 'with "quotes" and \\ backslash', 'café ☃ \U0001f600',
+                '', ', ] [ {'],
+    'numbers': [0, -1, 1.5, -4500.0, 12345678901234567890, 1e10, -2.5e-3, 6.02E+23, 0.0],
+    'mixed': [None, True, False, [], {}, [[]], 'x', 3, -0.25],
+}
+
+def split_every_way(data):
+    """ data in two chunks, cut at each offset """
+    for cut in range(len(data) + 1):
+        yield [data[:cut], data[cut:]]
+
+
+class IterJsonListTest(unittest.TestCase):
+
+    def check_all_splits(self, items, text):
+        data = text.encode('utf-8')
+        for chunks in split_every_way(data):
+            with self.subTest(chunks=chunks):
+                self.assertEqual(list(iter_json_list(chunks)), items)
+        self.assertEqual(list(iter_json_list([data[i:i + 1] for i in range(len(data))])),
+                         items)
+
+    def test_documents_split_at_every_offset(self):
+        for name, items in DOCUMENTS.items():
+            with self.subTest(document=name):
+                self.check_all_splits(items, json.dumps(items))
+                self.check_all_splits(items, json.dumps(items, indent=2))
+                self.check_all_splits(items, json.dumps(items, ensure_ascii=False))
+
+    def test_number_cut_after_dot_or_exponent(self):
+        self.assertEqual(list(iter_json_list([b'[1.5, -4500.', b'0]'])), [1.5, -4500.0])
+        self.assertEqual(list(iter_json_list([b'[2e', b'3, 7]'])), [2000.0, 7])
+        self.assertEqual(list(iter_json_list([b'[12', b'34]'])), [1234])
+
+    def test_empty_array(self):
+        self.check_all_splits([], '[]')
+        self.check_all_splits([], ' [ \n ] ')
+
+    def test_items_come_before_the_end_of_the_stream(self):
+        def chunks():
+            yield b'[{"id": 1}, '
+            raise AssertionError("read past the first item")
+        self.assertEqual(next(iter_json_list(chunks())), {'id': 1})
+
+    def test_invalid_documents(self):
+        for text in ('{"id": 1}', '[1 2]', '[1,, 2]', '[1, 2', '[{"id": 1}', '', '[1.5, -4500.'):
+            data = text.encode('utf-8')
+            for chunks in split_every_way(data):
+                with self.subTest(chunks=chunks):
+                    with self.assertRaises(ValueError):
+                        list(iter_json_list(chunks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from library.LazyIndex import LazyIndex
+
+def record(name, number=0):
+    return {'name': name, 'number': number}
+
+
+class LazyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = [record('a'), record('b'), record('a', 1), record('c')]
+        self.fetches = 0
+        self.read = 0
+
+    def fetch(self):
+        self.fetches += 1
+        for item in list(self.catalog):
+            self.read += 1
+            yield item
+
+    def index(self, query_limit=0):
+        return LazyIndex(self.fetch, {'name': lambda item: item['name']}, query_limit)
+
+    def test_reads_only_as_far_as_needed(self):
+        index = self.index()
+        self.assertEqual(index.get('name', 'b'), record('b'))
+        self.assertEqual(self.read, 2)
+        self.assertEqual(index.get('name', 'a'), record('a'))
+        self.assertEqual(self.read, 2)
+        self.assertIsNone(index.get('name', 'z'))
+        self.assertEqual((self.read, self.fetches, index.complete), (4, 1, True))
+
+    def test_first_listed_wins_and_set_replaces(self):
+        index = self.index()
+        index.load()
+        self.assertEqual(index.get('name', 'a'), record('a'))
+        index.set(record('a', 2))
+        self.assertEqual(index.get('name', 'a'), record('a', 2))
+
+    def test_query_miss_is_not_kept(self):
+        index = self.index(query_limit=5)
+        self.assertIsNone(index.lookup('name', 'd', lambda: []))
+        # Created meanwhile, the listing has it
+        self.catalog.append(record('d'))
+        self.assertEqual(index.lookup('name', 'd', lambda: [record('d')]), record('d'))
+        self.assertEqual(self.fetches, 0)
+        index = self.index(query_limit=1)
+        self.assertIsNone(index.lookup('name', 'd', lambda: []))
+        self.assertEqual(index.lookup('name', 'd', lambda: []), record('d'))
+        self.assertEqual(self.fetches, 1)
+
+    def test_queries_until_the_limit_then_the_listing(self):
+        index = self.index(query_limit=2)
+        queries = []
+        def query(name):
+            queries.append(name)
+            return [item for item in self.catalog if item['name'] == name]
+        self.assertEqual(index.lookup('name', 'c', lambda: query('c')), record('c'))
+        self.assertEqual(index.lookup('name', 'c', lambda: query('c')), record('c'))
+        self.assertEqual(index.lookup('name', 'a', lambda: query('a')), record('a'))
+        self.assertEqual(index.lookup('name', 'b', lambda: query('b')), record('b'))
+        self.assertEqual((queries, self.fetches), (['c', 'a'], 1))
+        # Server can't filter: read the listing instead
+        self.assertIsNone(self.index(query_limit=2).lookup('name', 'z', lambda: None))
+
+    def test_broken_listing_is_fetched_again(self):
+        broken = [True]
+        def fetch():
+            self.fetches += 1
+            yield record('a')
+            if broken:
+                broken.pop()
+                raise ConnectionError("dropped")
+            yield from self.catalog[1:]
+        index = LazyIndex(fetch, {'name': lambda item: item['name']}, 0)
+        self.assertEqual(index.get('name', 'a'), record('a'))
+        self.assertEqual(index.get('name', 'c'), record('c'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_concurrent_lookups(self):
+        self.catalog = [record(str(number)) for number in range(500)]
+        index = self.index()
+        found = {}
+        def look(names):
+            for name in names:
+                found[name] = index.get('name', name)
+        threads = [threading.Thread(target=look, args=([str(n) for n in range(k, 500, 8)],))
+                   for k in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(found, {str(n): record(str(n)) for n in range(500)})
+        self.assertEqual((self.fetches, self.read), (1, 500))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from library.Records import Image, Machine, Preseed
+
+MACHINE = {'name': 'board-1', 'id': 7, 'state': 'ready', 'arch': 'arm64',
+           'location': 'rack 3', 'kernel_id': None}
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_fields_in_server_order(self):
+        machine = Machine(MACHINE)
+        self.assertEqual(list(machine), list(MACHINE))
+        self.assertEqual(json.dumps(machine.to_dict()), json.dumps(MACHINE))
+        self.assertEqual(machine, MACHINE)
+
+    def test_new_fields_come_last(self):
+        machine = Machine(MACHINE)
+        machine['subarch'] = 'efi'
+        machine['rack'] = 3
+        del machine['id']
+        machine.id = 8
+        self.assertEqual(list(machine), ['name', 'id', 'state', 'arch', 'location',
+                                         'kernel_id', 'subarch', 'rack'])
+
+    def test_order_is_shared(self):
+        first, second = Machine(dict(MACHINE)), Machine(dict(MACHINE, id=8))
+        self.assertIs(first._order, second._order)
+
+    def test_to_dict(self):
+        content = 'd-i debian-installer/locale string en_US\n' * 20
+        preseed = Preseed({'id': 1, 'content': content, 'name': 'p1'})
+        self.assertIsInstance(preseed._content, bytes)
+        self.assertEqual(preseed.to_dict(), {'id': 1, 'content': content, 'name': 'p1'})
+        self.assertEqual(list(preseed.to_dict(without=('content',))), ['id', 'name'])
+        image = Image({'id': 2, 'type': 'Kernel'})
+        self.assertEqual(type(image.to_dict()), dict)
+
+
+if __name__ == '__main__':
+    unittest.main()
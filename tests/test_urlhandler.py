@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import http.server
+import socket
+import threading
+import unittest
+
+from library.common import ClientError, URLhandler, URLhandlerConnectionError
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Answers with the status code given as the path: /200, /401... """
+
+    def do_GET(self):
+        status = int(self.path.strip('/').split('?')[0])
+        body = b'[]'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class URLhandlerErrorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def handler(self, url):
+        urlhandler = URLhandler(url, 't', retries=0, timeout=5)
+        self.addCleanup(urlhandler.close)
+        return urlhandler
+
+    def test_refused_credentials(self):
+        urlhandler = self.handler(self.url)
+        for status in (401, 403):
+            with self.assertRaises(ClientError):
+                urlhandler.get('/{}'.format(status))
+
+    def test_no_answer_is_a_connection_error(self):
+        urlhandler = self.handler('http://127.0.0.1:{}/'.format(unused_port()))
+        with self.assertRaises(URLhandlerConnectionError):
+            urlhandler.get('/200')
+
+    def test_no_answer_after_a_good_request(self):
+        urlhandler = self.handler(self.url)
+        self.assertEqual(urlhandler.get('/200'), [])
+        urlhandler.base_url = 'http://127.0.0.1:{}/'.format(unused_port())
+        with self.assertRaises(URLhandlerConnectionError):
+            urlhandler.get('/200')
+
+    def test_failed_probe(self):
+        with self.assertRaises(ClientError):
+            URLhandler('http://127.0.0.1:{}/'.format(unused_port()), 't', retries=0,
+                       validate=True)
+
+
+if __name__ == '__main__':
+    unittest.main()